@@ -0,0 +1,133 @@
+'''
+Registry of the accounts the MLOps platform deploys to.
+
+Only plain data and dictionary lookups live here, so the account mapping can be imported (by the
+tests, the stacks and the CodeBuild helpers) without loading the CDK or boto3.
+'''
+
+PIPELINE_ACCOUNT = "870955006425"
+PIPELINE_ACCOUNT_NAME = "WS-0197"
+PIPELINE_REGION = "eu-west-1"
+
+# dev account can be identical to pipeline account as we deploy sc to pipeline account, and then share
+# with all other. If we need to support different accounts, we need to bootstrap other account first, with
+# a predefined role, i.e.:
+
+# "AWS": "arn:aws:iam::387661743389:role/cdk-hnb659fds-deploy-role-387661743389-eu-west-1"
+# as pipeline bucket is encrypted by KMS, KMS needs to allow the account decrypt the bucket. Without the pre-configured
+# role in the destination account, KMS creation will fail.
+DEV_ACCOUNT = "870955006425" 
+DEV_ACCOUNT_NAME = "WS-0197"
+DEV_REGION = "eu-west-1"
+
+PREPROD_ACCOUNT = "870955006425"
+PREPROD_ACCOUNT_NAME = "WS-0197"
+PREPROD_REGION = "eu-west-1"
+
+PROD_ACCOUNT = "870955006425"
+PROD_ACCOUNT_NAME = "WS-0197"
+PROD_REGION = "eu-west-1"
+
+
+CLIENT_DEV_ACCOUNT = '817207393703'
+CLIENT_DEV_ACCOUNT_NAME = 'WS-00Z1'
+
+STAGING_CLIENT_DEV_ACCOUNT = '976382856353'
+STAGING_CLIENT_DEV_ACCOUNT_NAME = 'WS-00RI'
+
+# CLIENT_DEV_ACCOUNT = '495986650785'
+# CLIENT_DEV_ACCOUNT_NAME = 'WS-00Z5'
+
+CLIENT_PREPROD_ACCOUNT = '923203785550'
+STAGING_CLIENT_PREPROD_ACCOUNT = '142626708707'
+
+FEATURE_DEV_ACCOUNT = '857181544807'
+FEATURE_DEV_ACCOUNT_NAME = 'WS-00Z4'
+
+FEATURE_GOV_ACCOUNT = '900292470358'
+FEATURE_GOV_ACCOUNT_NAME = 'WS-00Z6'
+
+CLIENT_PROD_ACCOUNT = '128426030628'
+STAGING_CLIENT_PROD_ACCOUNT = 'TBD'
+
+STAGING_PIPELINE_ACCOUNT = "495986650785"
+STAGING_PIPELINE_ACCOUNT_NAME = "WS-00Z5"
+
+PROD_PIPELINE_ACCOUNT = "376571134915"
+PROD_PIPELINE_ACCOUNT_NAME = "WS-01G6"
+
+# account id -> account name, the first entry wins when environments share an account
+ACCOUNT_NAMES = {}
+for _act_id, _act_name in [
+    (PIPELINE_ACCOUNT, PIPELINE_ACCOUNT_NAME),
+    (STAGING_PIPELINE_ACCOUNT, STAGING_PIPELINE_ACCOUNT_NAME),
+    (PROD_PIPELINE_ACCOUNT, PROD_PIPELINE_ACCOUNT_NAME),
+    (DEV_ACCOUNT, DEV_ACCOUNT_NAME),
+    (FEATURE_DEV_ACCOUNT, FEATURE_DEV_ACCOUNT_NAME),
+    (FEATURE_GOV_ACCOUNT, FEATURE_GOV_ACCOUNT_NAME),
+]:
+    ACCOUNT_NAMES.setdefault(_act_id, _act_name)
+
+# accounts known, but whose name is not configured yet
+UNNAMED_ACCOUNTS = {PREPROD_ACCOUNT, PROD_ACCOUNT}
+
+# pipeline type -> client account of each stage
+CLIENT_ACCOUNTS = {
+    'DEV': {'dev': CLIENT_DEV_ACCOUNT, 'preprod': CLIENT_PREPROD_ACCOUNT, 'prod': CLIENT_PROD_ACCOUNT},
+    'FEATURE': {'dev': FEATURE_DEV_ACCOUNT, 'preprod': CLIENT_PREPROD_ACCOUNT, 'prod': CLIENT_PROD_ACCOUNT},
+    'STAGING': {'dev': STAGING_CLIENT_DEV_ACCOUNT, 'preprod': STAGING_CLIENT_PREPROD_ACCOUNT, 'prod': STAGING_CLIENT_PROD_ACCOUNT},
+}
+
+# role of the client accounts the management account runs the tests with
+AUTOMATION_ROLE_NAME = 'bootstrap-from-mgmt'
+
+# accounts hosting a shared code bucket
+CODE_BUCKET_ACCOUNTS = (PIPELINE_ACCOUNT, STAGING_PIPELINE_ACCOUNT, PROD_PIPELINE_ACCOUNT, FEATURE_GOV_ACCOUNT)
+
+
+def get_client_act_id(pipeline_type, stage):
+    '''
+    return the client account of the stage ('dev', 'preprod' or 'prod') for the pipeline type
+    '''
+    assert pipeline_type in CLIENT_ACCOUNTS, f"Unknown pipeline type: {pipeline_type}"
+    return CLIENT_ACCOUNTS[pipeline_type][stage]
+
+def get_client_act_ids(pipeline_type):
+    '''
+    return the distinct client accounts of the pipeline type, in stage order, the ones not configured yet excluded
+    '''
+    assert pipeline_type in CLIENT_ACCOUNTS, f"Unknown pipeline type: {pipeline_type}"
+    act_ids = []
+    for act_id in CLIENT_ACCOUNTS[pipeline_type].values():
+        if act_id != 'TBD' and act_id not in act_ids:
+            act_ids.append(act_id)
+    return act_ids
+
+def get_client_dev_act_id(pipeline_type):
+    return get_client_act_id(pipeline_type, 'dev')
+
+def get_client_preprod_act_id(pipeline_type):
+    return get_client_act_id(pipeline_type, 'preprod')
+
+def get_client_prod_act_id(pipeline_type):
+    return get_client_act_id(pipeline_type, 'prod')
+
+def get_act_name_from_id(act_id):
+    '''
+    return account name from account id
+    '''
+    if act_id in ACCOUNT_NAMES:
+        return ACCOUNT_NAMES[act_id]
+
+    if act_id in UNNAMED_ACCOUNTS:
+        assert False, 'TOBEIMPLEMENTED'
+
+    assert False, 'unknown account id'
+
+def get_code_bucket_name(act_id):
+    assert act_id in CODE_BUCKET_ACCOUNTS
+    ret = f"ml-ops-shared-code-{act_id}"
+    return ret
+
+def get_automation_role_arn(act_id):
+    return f"arn:aws:iam::{act_id}:role/{AUTOMATION_ROLE_NAME}"
@@ -0,0 +1,122 @@
+'''
+Local cache of the templates already released to Service Catalog.
+
+A provisioning artifact never changes once created, so its template is downloaded once and kept
+under its artifact id. Downloads are streamed to disk chunk by chunk, and verified against the
+size and checksum reported by S3 before they are made visible in the cache: the SHA-256 checksum
+of the object when it has one, else its ETag, which is only the MD5 of a single part upload stored
+without KMS (the CDK asset buckets use SSE-KMS by default) or customer key encryption.
+'''
+
+import base64
+import hashlib
+import os
+from os import path
+
+from mlops_sm_project_template_rt.scratch import scratch_dir
+from mlops_sm_project_template_rt.synth_cache import cache_root, cache_enabled
+
+CHUNK_SIZE = 1024 * 1024
+# the ETag of an object encrypted with these is not its MD5
+KMS_ENCRYPTIONS = ('aws:kms', 'aws:kms:dsse')
+
+def parse_template_url(template_url):
+    '''
+    return the (bucket, key) of a service catalog template url, i.e. https://s3.amazonaws.com/bucket/key
+    '''
+    s3_bucket = template_url.split('/')[-2]
+    s3_file = template_url.split('/')[-1]
+    return s3_bucket, s3_file
+
+
+def _etag_is_md5(response):
+    # the etag of a multipart upload is not the md5 of the object either (it contains a '-')
+    return ('-' not in response['ETag'] and response.get('ServerSideEncryption') not in KMS_ENCRYPTIONS
+            and 'SSECustomerAlgorithm' not in response)
+
+
+def download_verified(s3_client, bucket, key, target_path):
+    '''
+    stream s3://bucket/key to target_path, checking the size, and the sha256 checksum or md5 etag when
+    the object has one (see the module doc)
+
+    the object is written to a temporary file next to target_path, and only renamed into place once verified
+    '''
+    response = s3_client.get_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    etag = response['ETag'].strip('"')
+    expected_size = response['ContentLength']
+    # the checksum of a multipart upload is a checksum of the part checksums, ending with -<parts>
+    checksum = response.get('ChecksumSHA256')
+    if checksum is not None and '-' in checksum:
+        checksum = None
+
+    md5 = hashlib.md5(usedforsecurity=False)
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_path = f'{target_path}.{os.getpid()}.part'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                md5.update(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+
+        if size != expected_size:
+            raise ValueError(f"s3://{bucket}/{key}: downloaded {size} bytes, expected {expected_size}")
+        if checksum is not None:
+            actual = base64.b64encode(sha256.digest()).decode('ascii')
+            if actual != checksum:
+                raise ValueError(f"s3://{bucket}/{key}: sha256 {actual} does not match checksum {checksum}")
+        elif _etag_is_md5(response) and md5.hexdigest() != etag:
+            raise ValueError(f"s3://{bucket}/{key}: md5 {md5.hexdigest()} does not match etag {etag}")
+
+        os.replace(tmp_path, target_path)
+    finally:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return target_path
+
+
+class TemplateArtifactCache:
+    '''
+    released templates, one file per provisioning artifact
+    '''
+
+    def __init__(self, cache_dir=None, enabled=None):
+        self.enabled = cache_enabled() if enabled is None else enabled
+        self.cache_dir = cache_dir or path.join(cache_root(), 'artifacts')
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, artifact_id, sc_prod_name):
+        '''
+        return the path of the cached template of the provisioning artifact, or None if not downloaded yet
+        '''
+        if not self.enabled:
+            return None
+        target_path = path.join(self.cache_dir, f'{sc_prod_name}-{artifact_id}.json')
+        return target_path if path.isfile(target_path) else None
+
+    def fetch(self, s3_client, template_url, artifact_id, sc_prod_name):
+        '''
+        return the local path of the template of the provisioning artifact, downloading it if needed
+
+        Args:
+            s3_client: s3 client used for the download
+            template_url (str): template url of the provisioning artifact
+            artifact_id (str): id of the provisioning artifact
+            sc_prod_name (str): name of the product, kept in the file name
+
+        Returns:
+            [str]: path of the CFN template
+        '''
+        cached_path = self.get(artifact_id, sc_prod_name)
+        if cached_path is not None:
+            return cached_path
+
+        target_dir = self.cache_dir if self.enabled else scratch_dir('artifacts')
+        target_path = path.join(target_dir, f'{sc_prod_name}-{artifact_id}.json')
+        s3_bucket, s3_file = parse_template_url(template_url)
+        return download_verified(s3_client, s3_bucket, s3_file, target_path)
@@ -0,0 +1,192 @@
+'''
+Process wide registry of boto3 sessions, clients and resources.
+
+Creating a boto3 client resolves the credentials and loads the service model and endpoints, which
+takes hundreds of milliseconds. The registry creates one client per service, region and credential
+set and hands the same (thread-safe) client to every caller. Clients are configured with a larger
+connection pool and adaptive retries, so concurrent callers share connections and back off together
+when throttled.
+
+Resources are not thread-safe, so they are cached per thread.
+
+Clients of an assumed role (role_arn) share one session per role, whose credentials are assumed once
+and refreshed by botocore shortly before they expire, instead of calling sts.assume_role per client.
+The role is only assumed when its credentials are first used, outside the lock of the registry, so
+the STS call doesn't hold up the callers of the other clients.
+The clients requested without a role_arn assume the role of MLOPS_AWS_ROLE_ARN when it is set, e.g.
+by the tests running against a client account.
+'''
+
+import os
+import threading
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, CredentialResolver, DeferredRefreshableCredentials
+
+from mlops_sm_project_template_rt.synth_profiler import instrument_client
+
+MAX_POOL_CONNECTIONS = int(os.environ.get('MLOPS_BOTO_MAX_POOL_CONNECTIONS', '32'))
+MAX_ATTEMPTS = int(os.environ.get('MLOPS_BOTO_MAX_ATTEMPTS', '10'))
+
+ASSUME_ROLE_DURATION_S = 3600
+ASSUME_ROLE_SESSION_NAME = 'AssumeRoleSession1'
+# role assumed by default, read at call time like AWS_PROFILE
+ROLE_ENV = 'MLOPS_AWS_ROLE_ARN'
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS},
+    connect_timeout=10,
+    read_timeout=60,
+)
+
+_lock = threading.RLock()
+_sessions = {}
+_role_sessions = {}
+_clients = {}
+_thread_local = threading.local()
+
+
+def _session_key(profile_name, credentials, role_arn=None):
+    # the profile is read from the environment at call time, tests switch it with monkeypatch.setenv
+    profile_name = profile_name or os.environ.get('AWS_PROFILE')
+    return (profile_name, credentials.get('aws_access_key_id'), credentials.get('aws_session_token'), role_arn)
+
+
+def _region(region_name):
+    return region_name or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+
+
+def _role_arn(role_arn):
+    return role_arn or os.environ.get(ROLE_ENV) or None
+
+
+def get_session(profile_name=None, role_arn=None, **credentials):
+    '''
+    return the boto3 session of the profile / credential set, creating it on first use
+
+    args:
+        profile_name: aws profile, defaults to AWS_PROFILE
+        role_arn: role to assume with the credentials of the profile, see get_role_session
+        credentials: aws_access_key_id, aws_secret_access_key, aws_session_token
+    '''
+    if role_arn is not None:
+        return get_role_session(role_arn, profile_name)
+
+    key = _session_key(profile_name, credentials)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.session.Session(profile_name=key[0], **credentials)
+        return _sessions[key]
+
+
+def _assume_role_refresher(role_arn, profile_name, session_name, duration_s):
+    def refresh():
+        # the role is assumed with the credentials of the profile, never with the default role
+        ret = _get_client('sts', None, profile_name, None, {}).assume_role(
+            RoleArn=role_arn, RoleSessionName=session_name, DurationSeconds=duration_s
+        )
+        credentials = ret['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+    return refresh
+
+
+class _AssumeRoleProvider(CredentialProvider):
+    '''
+    the only credential provider of a role session, its credentials assume the role on first use
+    '''
+    METHOD = 'sts-assume-role'
+    CANONICAL_NAME = 'mlops-assume-role'
+
+    def __init__(self, refresh):
+        super().__init__()
+        self._credentials = DeferredRefreshableCredentials(refresh_using=refresh, method=self.METHOD)
+
+    def load(self):
+        return self._credentials
+
+
+def get_role_session(role_arn, profile_name=None, session_name=ASSUME_ROLE_SESSION_NAME, duration_s=ASSUME_ROLE_DURATION_S):
+    '''
+    return the session of the role assumed from the profile, the role is assumed when its credentials
+    are first used and they are refreshed before they expire
+    '''
+    profile_name = profile_name or os.environ.get('AWS_PROFILE')
+    key = (role_arn, profile_name)
+    with _lock:
+        if key not in _role_sessions:
+            refresh = _assume_role_refresher(role_arn, profile_name, session_name, duration_s)
+            botocore_session = botocore.session.get_session()
+            botocore_session.register_component('credential_provider', CredentialResolver([_AssumeRoleProvider(refresh)]))
+            _role_sessions[key] = boto3.session.Session(botocore_session=botocore_session)
+        return _role_sessions[key]
+
+
+def get_client(service_name, region_name=None, profile_name=None, role_arn=None, **credentials):
+    '''
+    return the shared client of the service, region and credential set (or assumed role, see ROLE_ENV)
+    '''
+    return _get_client(service_name, region_name, profile_name, _role_arn(role_arn), credentials)
+
+
+def _get_client(service_name, region_name, profile_name, role_arn, credentials):
+    region_name = _region(region_name)
+    key = (service_name, region_name) + _session_key(profile_name, credentials, role_arn)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        # session.client is not thread-safe, create clients under the lock
+        if key not in _clients:
+            session = get_session(profile_name, role_arn, **credentials)
+            _clients[key] = instrument_client(session.client(service_name, region_name=region_name, config=CLIENT_CONFIG))
+        return _clients[key]
+
+
+def register_client(service_name, client, region_name=None, profile_name=None, role_arn=None, **credentials):
+    '''
+    serve client for the service, region and credential set, e.g. a client wrapped in a botocore Stubber
+    '''
+    region_name = _region(region_name)
+    role_arn = _role_arn(role_arn)
+    key = (service_name, region_name) + _session_key(profile_name, credentials, role_arn)
+    with _lock:
+        _clients[key] = instrument_client(client)
+    return client
+
+
+def get_resource(service_name, region_name=None, profile_name=None, role_arn=None, **credentials):
+    '''
+    return the resource of the service, region and credential set for the calling thread
+    '''
+    region_name = _region(region_name)
+    role_arn = _role_arn(role_arn)
+    key = (service_name, region_name) + _session_key(profile_name, credentials, role_arn)
+    resources = getattr(_thread_local, 'resources', None)
+    if resources is None:
+        resources = _thread_local.resources = {}
+    if key not in resources:
+        with _lock:
+            session = get_session(profile_name, role_arn, **credentials)
+            resources[key] = session.resource(service_name, region_name=region_name, config=CLIENT_CONFIG)
+            instrument_client(resources[key].meta.client)
+    return resources[key]
+
+
+def clear():
+    '''
+    drop all cached sessions and clients, e.g. after the credentials of a profile are rotated
+    '''
+    with _lock:
+        _sessions.clear()
+        _role_sessions.clear()
+        _clients.clear()
+    _thread_local.resources = {}
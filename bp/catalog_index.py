@@ -0,0 +1,170 @@
+'''
+Name to id index of the Service Catalog portfolios, products and launch paths.
+
+ListPortfolios and the product searches are paginated: a single call silently misses what is on
+the next pages in accounts with many shared portfolios. The index pages through each listing once,
+keeps name -> details dictionaries, and serves the lookups from them. Entries expire after ttl
+seconds. A product name missing from the index is searched for on its own, rather than listing
+all the products again, and the portfolios are listed again at most every miss_refresh seconds.
+'''
+
+import threading
+import time
+import weakref
+
+
+class CatalogIndex:
+    '''
+    index of the catalog seen by client
+
+    Args:
+        client: servicecatalog client, the shared one of aws_clients by default
+        ttl (float): seconds after which a listing is refreshed
+        miss_refresh (float): minimum seconds between two listings caused by a missing name
+    '''
+
+    def __init__(self, client=None, ttl=300, miss_refresh=5, clock=time.monotonic):
+        if client is None:
+            from mlops_sm_project_template_rt.config.aws_clients import get_client
+            client = get_client('servicecatalog')
+        self.client = client
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self.clock = clock
+        self._lock = threading.RLock()
+        # display name -> [portfolio details], display names are not unique
+        self._portfolios = {}
+        self._portfolios_at = None
+        # product name -> (time, ProductViewSummary)
+        self._products = {}
+        self._products_at = None
+        # product id -> (time, [launch path summaries])
+        self._launch_paths = {}
+        # product id -> (time, [active provisioning artifacts])
+        self._artifacts = {}
+
+    def _age(self, at):
+        return float('inf') if at is None else self.clock() - at
+
+    def _list_portfolios(self):
+        portfolios = {}
+        for page in self.client.get_paginator('list_portfolios').paginate():
+            for portfolio in page['PortfolioDetails']:
+                portfolios.setdefault(portfolio['DisplayName'], []).append(portfolio)
+        self._portfolios = portfolios
+        self._portfolios_at = self.clock()
+
+    def portfolios(self, display_name):
+        '''
+        details of the portfolios named display_name
+        '''
+        with self._lock:
+            age = self._age(self._portfolios_at)
+            if age > self.ttl or (display_name not in self._portfolios and age > self.miss_refresh):
+                self._list_portfolios()
+            return list(self._portfolios.get(display_name, []))
+
+    def portfolio_id(self, display_name):
+        '''
+        id of the portfolio named display_name, raises KeyError unless exactly one portfolio has that name
+        '''
+        portfolios = self.portfolios(display_name)
+        if len(portfolios) != 1:
+            raise KeyError(f'{len(portfolios)} portfolios named {display_name}')
+        return portfolios[0]['Id']
+
+    def _search_products(self, **kwargs):
+        now = self.clock()
+        found = {}
+        for page in self.client.get_paginator('search_products_as_admin').paginate(ProductSource='ACCOUNT', **kwargs):
+            for detail in page['ProductViewDetails']:
+                summary = detail['ProductViewSummary']
+                found[summary['Name']] = (now, summary)
+        self._products.update(found)
+        return found
+
+    def refresh_products(self):
+        with self._lock:
+            self._products = {}
+            self._search_products()
+            self._products_at = self.clock()
+
+    def product(self, name):
+        '''
+        ProductViewSummary of the product, None when there is no such product
+        '''
+        with self._lock:
+            if self._age(self._products_at) > self.ttl:
+                self.refresh_products()
+            entry = self._products.get(name)
+            if entry is None or self._age(entry[0]) > self.ttl:
+                # the full text search also matches other products, keep them too
+                self._search_products(Filters={'FullTextSearch': [name]})
+                entry = self._products.get(name)
+            return entry[1] if entry is not None else None
+
+    def product_id(self, name):
+        product = self.product(name)
+        if product is None:
+            raise KeyError(f'product {name} not found')
+        return product['ProductId']
+
+    def provisioning_artifacts(self, product_id, refresh=False):
+        '''
+        active provisioning artifacts of the product, oldest first
+        '''
+        with self._lock:
+            entry = self._artifacts.get(product_id)
+            if refresh or entry is None or self._age(entry[0]) > self.ttl:
+                artifacts = self.client.list_provisioning_artifacts(ProductId=product_id)['ProvisioningArtifactDetails']
+                entry = (self.clock(), sorted([a for a in artifacts if a.get('Active', True)], key=lambda a: a['CreatedTime']))
+                self._artifacts[product_id] = entry
+            return list(entry[1])
+
+    def launch_paths(self, product_id, refresh=False):
+        '''
+        launch path summaries of the product for the caller, an empty result is not kept
+        '''
+        with self._lock:
+            entry = self._launch_paths.get(product_id)
+            if not refresh and entry is not None and self._age(entry[0]) <= self.ttl:
+                return list(entry[1])
+        paths = []
+        for page in self.client.get_paginator('list_launch_paths').paginate(ProductId=product_id):
+            paths += page['LaunchPathSummaries']
+        with self._lock:
+            if len(paths) > 0:
+                # no launch path yet usually means a principal association still propagating
+                self._launch_paths[product_id] = (self.clock(), paths)
+        return paths
+
+    def describe_product(self, name):
+        '''
+        the product as describe_product returns it: its summary and its provisioning artifacts
+        '''
+        product_id = self.product_id(name)
+        return {
+            'ProductViewSummary': self.product(name),
+            'ProvisioningArtifacts': self.provisioning_artifacts(product_id),
+        }
+
+    def invalidate(self):
+        with self._lock:
+            self._portfolios, self._portfolios_at = {}, None
+            self._products, self._products_at = {}, None
+            self._launch_paths = {}
+            self._artifacts = {}
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_catalog_index(client):
+    '''
+    the index shared by the callers of the same servicecatalog client
+    '''
+    with _indexes_lock:
+        if client not in _indexes:
+            _indexes[client] = CatalogIndex(client)
+        return _indexes[client]
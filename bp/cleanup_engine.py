@@ -0,0 +1,198 @@
+'''
+Parallel teardown of the resources of a SageMaker project, used by the cleanup custom resource.
+
+Versioned buckets holding training outputs can have millions of object versions. They are listed
+page by page and deleted with batched DeleteObjects calls (up to 1000 keys each) on a worker pool,
+while the other buckets and the model packages of the project are cleaned up concurrently.
+
+The listing never runs more than two batches per worker ahead of the deletes, so neither the
+listed keys nor the wait for the last deletes grow with the bucket. A Lambda invocation can't
+outlive its timeout: the engine stops listing shortly before the deadline and returns a checkpoint, the listing position of every resource not cleaned up yet.
+run_cleanup then re-invokes the function asynchronously with the checkpoint in the event, and only
+the invocation that finishes the cleanup reports back to CloudFormation.
+'''
+
+import json
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MAX_DELETE_KEYS = 1000
+CHECKPOINT_KEY = 'CleanupCheckpoint'
+# stop taking new work this many seconds before the Lambda timeout
+SAFETY_MARGIN_S = 60
+
+CLIENT_CONFIG = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+
+def lambda_time_left(context, margin_s=SAFETY_MARGIN_S):
+    '''
+    seconds left to the invocation before it has to stop taking new work
+    '''
+    if context is None:
+        return lambda: float('inf')
+    return lambda: context.get_remaining_time_in_millis() / 1000 - margin_s
+
+
+class CleanupEngine:
+    '''
+    empties buckets and deletes model packages concurrently, within the time left to the invocation
+
+    Args:
+        s3_client: client used to empty the buckets
+        sm_client: client used to delete the model packages
+        max_workers (int): number of concurrent delete calls
+        time_left (callable): seconds left before the work has to stop, see lambda_time_left
+    '''
+
+    def __init__(self, s3_client=None, sm_client=None, max_workers=16, time_left=None):
+        self.s3_client = s3_client or boto3.client('s3', config=CLIENT_CONFIG)
+        self.sm_client = sm_client or boto3.client('sagemaker', config=CLIENT_CONFIG)
+        self.max_workers = max_workers
+        self.time_left = time_left or lambda_time_left(None)
+        self.errors = []
+        self.deleted = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _delete_batch(self, bucket, objects):
+        res = self.s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        errors = res.get('Errors', [])
+        with self._lock:
+            self.errors += [f"s3://{bucket}/{e['Key']} ({e.get('VersionId')}): {e['Code']}" for e in errors]
+            self.deleted += len(objects) - len(errors)
+
+    def empty_bucket(self, bucket, marker=None):
+        '''
+        delete all the object versions and delete markers of the bucket, from the listing position marker
+
+        Returns:
+            [dict]: listing position to resume from when the time ran out, None once the bucket is empty
+        '''
+        kwargs = {'Bucket': bucket}
+        if marker:
+            kwargs.update(marker)
+        # listing position of the page being deleted
+        position = marker or {}
+        pending = set()
+        try:
+            paginator = self.s3_client.get_paginator('list_object_versions')
+            for i, page in enumerate(paginator.paginate(**kwargs, PaginationConfig={'PageSize': MAX_DELETE_KEYS})):
+                # the first page is always deleted, so each invocation makes progress
+                if i > 0 and self.time_left() <= 0:
+                    self._wait(pending)
+                    return position
+                objects = [{'Key': v['Key'], 'VersionId': v['VersionId']}
+                           for v in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+                for j in range(0, len(objects), MAX_DELETE_KEYS):
+                    pending.add(self._pool.submit(self._delete_batch, bucket, objects[j:j + MAX_DELETE_KEYS]))
+                    pending = self._throttle(pending)
+                if page.get('IsTruncated'):
+                    position = {'KeyMarker': page['NextKeyMarker'], 'VersionIdMarker': page['NextVersionIdMarker']}
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchBucket':
+                raise
+            print(f'bucket {bucket} does not exist, skip')
+        self._wait(pending)
+        return None
+
+    def delete_model_packages(self, mpg_name):
+        '''
+        delete the model packages of the model package group, so the group itself can be deleted
+
+        Returns:
+            [dict]: {} when the time ran out before all packages were listed, None once they are deleted
+        '''
+        pending = set()
+        paginator = self.sm_client.get_paginator('list_model_packages')
+        for i, page in enumerate(paginator.paginate(ModelPackageGroupName=mpg_name)):
+            if i > 0 and self.time_left() <= 0:
+                # the deleted packages are not listed anymore, resume from the start
+                self._wait(pending)
+                return {}
+            for pkg in page['ModelPackageSummaryList']:
+                pending.add(self._pool.submit(self._delete_model_package, pkg['ModelPackageArn']))
+                pending = self._throttle(pending)
+        self._wait(pending)
+        return None
+
+    def _delete_model_package(self, arn):
+        self.sm_client.delete_model_package(ModelPackageName=arn)
+        with self._lock:
+            self.deleted += 1
+
+    def _record(self, done):
+        errors = [repr(f.exception()) for f in done if f.exception() is not None]
+        with self._lock:
+            self.errors += errors
+
+    def _throttle(self, pending):
+        '''
+        wait until fewer than two delete calls per worker are pending, and return the pending ones
+        '''
+        while len(pending) >= self.max_workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            self._record(done)
+        return pending
+
+    def _wait(self, pending):
+        '''
+        wait for the delete calls, and record their errors
+        '''
+        self._record(wait(pending).done)
+
+    def run(self, bucket_names=(), mpg_name=None, checkpoint=None):
+        '''
+        clean up the buckets and the model package group, or what the checkpoint says is left of them
+
+        Returns:
+            [dict]: checkpoint to resume from in a new invocation, None once everything is cleaned up
+        '''
+        if checkpoint is None:
+            checkpoint = {'buckets': {b: None for b in bucket_names}}
+            if mpg_name:
+                checkpoint['model_packages'] = {mpg_name: None}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='cleanup') as self._pool:
+            resources = len(checkpoint.get('buckets', {})) + len(checkpoint.get('model_packages', {}))
+            with ThreadPoolExecutor(max_workers=max(1, resources), thread_name_prefix='resource') as executor:
+                buckets = {b: executor.submit(self.empty_bucket, b, m) for b, m in checkpoint.get('buckets', {}).items()}
+                packages = {g: executor.submit(self.delete_model_packages, g) for g in checkpoint.get('model_packages', {})}
+                left = {
+                    'buckets': {b: f.result() for b, f in buckets.items() if f.result() is not None},
+                    'model_packages': {g: f.result() for g, f in packages.items() if f.result() is not None},
+                }
+        self._pool = None
+
+        print(f'deleted {self.deleted} objects / model packages, {len(self.errors)} errors')
+        if len(left['buckets']) == 0 and len(left['model_packages']) == 0:
+            return None
+        return left
+
+
+def run_cleanup(event, context, lambda_client=None, max_workers=16):
+    '''
+    clean up the resources listed in the properties of the custom resource event
+
+    When the time of the invocation runs out, the function is invoked again (asynchronously) with the
+    checkpoint added to the event.
+
+    Returns:
+        [bool]: True when the cleanup is complete, False when it continues in another invocation
+    '''
+    props = event['ResourceProperties']
+    engine = CleanupEngine(max_workers=max_workers, time_left=lambda_time_left(context))
+    checkpoint = engine.run(props.get('bucket_names', []), props.get('mpg_name'), event.get(CHECKPOINT_KEY))
+    if len(engine.errors) > 0:
+        raise RuntimeError(f'cleanup failed: {engine.errors[:10]}')
+    if checkpoint is None:
+        return True
+
+    print(f'cleanup continues in a new invocation: {checkpoint}')
+    lambda_client = lambda_client or boto3.client('lambda')
+    lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                         Payload=json.dumps({**event, CHECKPOINT_KEY: checkpoint}))
+    return False
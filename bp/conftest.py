@@ -2,6 +2,7 @@ import pytest
 import os
 import boto3
 from mlops_sm_project_template_rt.config.constants import (
+    DEFAULT_DEPLOYMENT_REGION,
     CLIENT_PREPROD_ACCOUNT,
     CLIENT_PROD_ACCOUNT, 
     DEV_ACCOUNT, DEV_ACCOUNT_NAME, 
@@ -14,13 +15,18 @@ from mlops_sm_project_template_rt.config.constants import (
     FEATURE_DEV_ACCOUNT, FEATURE_DEV_ACCOUNT_NAME,
     FEATURE_GOV_ACCOUNT, FEATURE_GOV_ACCOUNT_NAME,
     get_client_preprod_act_id,
-    get_client_prod_act_id
+    get_client_prod_act_id,
+    get_automation_role_arn
 )
+from mlops_sm_project_template_rt.config.aws_clients import ROLE_ENV, get_client
 from unittest.mock import patch
+from contextlib import ExitStack
 
 def pytest_addoption(parser):
     parser.addoption("--targetact", action='store', default='DEV')
     # parser.addoption("--targetact", action='store', default='STAGING')
+    parser.addoption("--run-benchmarks", action='store_true', default=False, help="run the offline synth benchmarks")
+    parser.addoption("--update-benchmark-baseline", action='store_true', default=False, help="store the benchmark results as the new baseline")
 
 
 @pytest.fixture
@@ -122,29 +128,134 @@ def mgmt_dev_admin_env(monkeypatch, targetact_arg):
 
 
 @pytest.fixture
-def client_automation_role(mgmt_dev_env, targetact_arg):
+def client_automation_role(mgmt_dev_env, targetact_arg, monkeypatch):
     '''
     from management account assume the client automation role, so can run tests against client account
     '''
 
-    sts_client = boto3.client('sts')
-    assumed_role_obj = sts_client.assume_role(
-        RoleArn=f'arn:aws:iam::{get_client_dev_act(targetact_arg)}:role/bootstrap-from-mgmt',
-        RoleSessionName='AssumeRoleSession1',
-        DurationSeconds=60*60 # 1 hour
-    )
-    assumed_credential = assumed_role_obj['Credentials']
+    # the role is assumed once per session, and the clients are shared by the tests
+    role_arn = get_automation_role_arn(get_client_dev_act(targetact_arg))
 
-    myboto3client = boto3.client
+    def assumed_role_client(client_type: str, region_name="eu-west-1"):
+        return get_client(client_type, region_name, role_arn=role_arn)
 
-    def mocked_boto3_client(client_type: str, region_name="eu-west-1"):
-        ret = myboto3client(client_type,
-                            aws_access_key_id=assumed_credential['AccessKeyId'],
-                            aws_secret_access_key=assumed_credential['SecretAccessKey'],
-                            aws_session_token=assumed_credential['SessionToken']
-                            )
-        return ret
+    # the code under test gets its clients from the registry (see aws_clients), the remaining
+    # boto3.client call sites are patched
+    monkeypatch.setenv(ROLE_ENV, role_arn)
+    with patch('boto3.client', new=assumed_role_client):
+        yield assumed_role_client
 
-    with patch('boto3.client', new=mocked_boto3_client):
-        yield mocked_boto3_client
 
+class StackBuild:
+    '''
+    a stack (or stage) built once for the test session, shared by the tests: its templates are read only
+    '''
+
+    def __init__(self, stack, config, boundary_manifest=None):
+        self.stack = stack
+        self.config = config
+        # roles patched with the permission boundary of the configuration, see role_boundary
+        self.boundary_manifest = boundary_manifest
+        self._templates = {}
+        self._resources = {}
+        self._generated = {}
+
+    def template(self, attr=None):
+        '''
+        assertions.Template of the stack, or of the stack attribute attr of a stage, synthesized once
+        '''
+        from aws_cdk import assertions
+
+        if attr not in self._templates:
+            stack = self.stack if attr is None else getattr(self.stack, attr)
+            self._templates[attr] = assertions.Template.from_stack(stack)
+        return self._templates[attr]
+
+    def resources(self, attr=None):
+        if attr not in self._resources:
+            self._resources[attr] = self.template(attr).to_json()['Resources']
+        return self._resources[attr]
+
+    def generated_template(self, name):
+        '''
+        content of the generated template of the product name
+        '''
+        if name not in self._generated:
+            with open(self.stack.get_generated_template(name)) as f:
+                self._generated[name] = f.read()
+        return self._generated[name]
+
+
+class SynthesizedStacks:
+    '''
+    stacks built once per test session, keyed by their configuration: the account, the local / deployed
+    version mocks and the permission boundary aspect
+    '''
+
+    def __init__(self):
+        self._builds = {}
+
+    def _build(self, kind, config, build):
+        key = (kind, tuple(sorted(config.items())))
+        if key not in self._builds:
+            with ExitStack() as mocks:
+                if config.get('local_version') is not None:
+                    mocks.enter_context(patch('mlops_sm_project_template_rt.config.constants.get_local_prod_version',
+                                              return_value=config['local_version']))
+                if config.get('sc_version') is not None:
+                    mocks.enter_context(patch('mlops_sm_project_template_rt.config.constants.get_sc_prod_version',
+                                              return_value=config['sc_version']))
+                self._builds[key] = StackBuild(*build(), config=config)
+        return self._builds[key]
+
+    def service_catalog(self, account=PIPELINE_ACCOUNT, local_version=None, sc_version=None, boundary_arn=None):
+        '''
+        ServiceCatalogStack of the account, with the permission boundary boundary_arn on its roles if any
+        '''
+        import aws_cdk as cdk
+        from mlops_sm_project_template_rt.pipeline_stack import ServiceCatalogStack
+        from mlops_sm_project_template_rt.role_boundary import apply_permission_boundary
+
+        def build():
+            env = cdk.Environment(account=account, region=DEFAULT_DEPLOYMENT_REGION)
+            stack = ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=env)
+            manifest = apply_permission_boundary(stack, boundary_arn) if boundary_arn is not None else None
+            return stack, manifest
+
+        config = {'account': account, 'local_version': local_version, 'sc_version': sc_version, 'boundary_arn': boundary_arn}
+        return self._build('service_catalog', config, build)
+
+    def core_stage(self, account=PIPELINE_ACCOUNT, stage_name="DEV", local_version=None, sc_version=None):
+        '''
+        CoreStage of the account
+        '''
+        import aws_cdk as cdk
+        from mlops_sm_project_template_rt.pipeline_stack import CoreStage
+
+        def build():
+            return CoreStage(cdk.App(), stage_name, env=cdk.Environment(account=account, region=DEFAULT_DEPLOYMENT_REGION)), None
+
+        config = {'account': account, 'stage_name': stage_name, 'local_version': local_version, 'sc_version': sc_version}
+        return self._build('core_stage', config, build)
+
+
+@pytest.fixture(scope='session')
+def synthesized_stacks():
+    return SynthesizedStacks()
+
+
+@pytest.fixture(scope='session')
+def service_catalog_build(request, synthesized_stacks):
+    '''
+    ServiceCatalogStack of the configuration given with indirect parametrization (see SynthesizedStacks.service_catalog),
+    of the pipeline account by default
+    '''
+    return synthesized_stacks.service_catalog(**getattr(request, 'param', {}))
+
+
+@pytest.fixture(scope='session')
+def core_stage_build(request, synthesized_stacks):
+    '''
+    CoreStage of the configuration given with indirect parametrization (see SynthesizedStacks.core_stage)
+    '''
+    return synthesized_stacks.core_stage(**getattr(request, 'param', {}))
@@ -1,140 +1,68 @@
-from aws_cdk import (
-    aws_ec2 as _ec2,
-    Fn,
-    CfnParameter
+'''
+Settings and helpers shared by the stacks.
+
+The account registry lives in accounts (re-exported here). The CDK and boto3 are only imported by
+the helpers that need them, so importing the constants stays cheap.
+'''
+from mlops_sm_project_template_rt.config.accounts import (
+    PIPELINE_ACCOUNT,
+    PIPELINE_ACCOUNT_NAME,
+    PIPELINE_REGION,
+    DEV_ACCOUNT,
+    DEV_ACCOUNT_NAME,
+    DEV_REGION,
+    PREPROD_ACCOUNT,
+    PREPROD_ACCOUNT_NAME,
+    PREPROD_REGION,
+    PROD_ACCOUNT,
+    PROD_ACCOUNT_NAME,
+    PROD_REGION,
+    CLIENT_DEV_ACCOUNT,
+    CLIENT_DEV_ACCOUNT_NAME,
+    STAGING_CLIENT_DEV_ACCOUNT,
+    STAGING_CLIENT_DEV_ACCOUNT_NAME,
+    CLIENT_PREPROD_ACCOUNT,
+    STAGING_CLIENT_PREPROD_ACCOUNT,
+    FEATURE_DEV_ACCOUNT,
+    FEATURE_DEV_ACCOUNT_NAME,
+    FEATURE_GOV_ACCOUNT,
+    FEATURE_GOV_ACCOUNT_NAME,
+    CLIENT_PROD_ACCOUNT,
+    STAGING_CLIENT_PROD_ACCOUNT,
+    STAGING_PIPELINE_ACCOUNT,
+    STAGING_PIPELINE_ACCOUNT_NAME,
+    PROD_PIPELINE_ACCOUNT,
+    PROD_PIPELINE_ACCOUNT_NAME,
+    get_client_act_ids,
+    get_client_dev_act_id,
+    get_client_preprod_act_id,
+    get_client_prod_act_id,
+    get_act_name_from_id,
+    get_code_bucket_name,
+    get_automation_role_arn
 )
-import boto3
-import importlib
+from mlops_sm_project_template_rt.synth_profiler import profiled
 
 CODE_COMMIT_REPO_NAME = "ml-devops-sagemaker-studio-replica"
 
-PIPELINE_ACCOUNT = "870955006425"
-PIPELINE_ACCOUNT_NAME = "WS-0197"
-PIPELINE_REGION = "eu-west-1"
-
-# dev account can be identical to pipeline account as we deploy sc to pipeline account, and then share
-# with all other. If we need to support different accounts, we need to bootstrap other account first, with
-# a predefined role, i.e.:
-
-# "AWS": "arn:aws:iam::387661743389:role/cdk-hnb659fds-deploy-role-387661743389-eu-west-1"
-# as pipeline bucket is encrypted by KMS, KMS needs to allow the account decrypt the bucket. Without the pre-configured
-# role in the destination account, KMS creation will fail.
-DEV_ACCOUNT = "870955006425" 
-DEV_ACCOUNT_NAME = "WS-0197"
-DEV_REGION = "eu-west-1"
-
-PREPROD_ACCOUNT = "870955006425"
-PREPROD_ACCOUNT_NAME = "WS-0197"
-PREPROD_REGION = "eu-west-1"
-
-PROD_ACCOUNT = "870955006425"
-PROD_ACCOUNT_NAME = "WS-0197"
-PROD_REGION = "eu-west-1"
-
-
 DEFAULT_DEPLOYMENT_REGION = "eu-west-1"
 APP_PREFIX = "mlops"
 sc_prod_launch_role_name = "MLOpsServiceCatalog-ProductLaunchRole"
-
-
-CLIENT_DEV_ACCOUNT = '817207393703'
-CLIENT_DEV_ACCOUNT_NAME = 'WS-00Z1'
-
-STAGING_CLIENT_DEV_ACCOUNT = '976382856353'
-STAGING_CLIENT_DEV_ACCOUNT_NAME = 'WS-00RI'
-
-# CLIENT_DEV_ACCOUNT = '495986650785'
-# CLIENT_DEV_ACCOUNT_NAME = 'WS-00Z5'
-
-CLIENT_PREPROD_ACCOUNT = '923203785550'
-STAGING_CLIENT_PREPROD_ACCOUNT = '142626708707'
-
-FEATURE_DEV_ACCOUNT = '857181544807'
-FEATURE_DEV_ACCOUNT_NAME = 'WS-00Z4'
-
-FEATURE_GOV_ACCOUNT = '900292470358'
-FEATURE_GOV_ACCOUNT_NAME = 'WS-00Z6'
-
-CLIENT_PROD_ACCOUNT = '128426030628'
-STAGING_CLIENT_PROD_ACCOUNT = 'TBD'
-
-def get_client_dev_act_id(pipeline_type):
-    if pipeline_type == 'DEV':
-        return CLIENT_DEV_ACCOUNT
-    elif pipeline_type == 'STAGING':
-        return STAGING_CLIENT_DEV_ACCOUNT
-    elif pipeline_type == 'FEATURE':
-        return FEATURE_DEV_ACCOUNT
-    else:
-        assert False, f"Unknown pipeline type: {pipeline_type}"
-
-def get_client_preprod_act_id(pipeline_type):
-    if pipeline_type == 'DEV' or pipeline_type == 'FEATURE':
-        return CLIENT_PREPROD_ACCOUNT
-    elif pipeline_type == 'STAGING':
-        return STAGING_CLIENT_PREPROD_ACCOUNT         
-    else:
-        assert False, f"Unknown pipeline type: {pipeline_type}"
-
-def get_client_prod_act_id(pipeline_type):
-    if pipeline_type == 'DEV' or pipeline_type == 'FEATURE':
-        return CLIENT_PROD_ACCOUNT
-    elif pipeline_type == 'STAGING':
-        return STAGING_CLIENT_PROD_ACCOUNT         
-    else:
-        assert False, f"Unknown pipeline type: {pipeline_type}"
-
-def get_act_name_from_id(act_id):
-    '''
-    return account name from account id
-    '''
-    if act_id == PIPELINE_ACCOUNT:
-        return PIPELINE_ACCOUNT_NAME
-
-    if act_id == STAGING_PIPELINE_ACCOUNT:
-        return STAGING_PIPELINE_ACCOUNT_NAME
-
-    if act_id == PROD_PIPELINE_ACCOUNT:
-        return PROD_PIPELINE_ACCOUNT_NAME
-
-    if act_id == DEV_ACCOUNT:
-        return DEV_ACCOUNT_NAME
-
-    if act_id == DEV_ACCOUNT:
-        return DEV_ACCOUNT_NAME
-
-    if act_id == FEATURE_DEV_ACCOUNT:
-        return FEATURE_DEV_ACCOUNT_NAME
-
-    if act_id == FEATURE_GOV_ACCOUNT:
-        return FEATURE_GOV_ACCOUNT_NAME
-
-    if act_id == PREPROD_ACCOUNT:
-        assert False, 'TOBEIMPLEMENTED'
-
-    if act_id == PROD_ACCOUNT:
-        assert False, 'TOBEIMPLEMENTED'
-
-    assert False, 'unknown account id'
-
-STAGING_PIPELINE_ACCOUNT = "495986650785"
-STAGING_PIPELINE_ACCOUNT_NAME = "WS-00Z5"
-
-PROD_PIPELINE_ACCOUNT = "376571134915"
-PROD_PIPELINE_ACCOUNT_NAME = "WS-01G6"
-
-def get_code_bucket_name(act_id):
-    assert act_id in [PIPELINE_ACCOUNT, STAGING_PIPELINE_ACCOUNT, PROD_PIPELINE_ACCOUNT, FEATURE_GOV_ACCOUNT]
-    ret = f"ml-ops-shared-code-{act_id}"
-    return ret
+# display name of the portfolio of the products, see ServiceCatalogStack
+sc_portfolio_name = "SageMaker Organization Templates"
 
 def get_vpc_info(the_stack):
     '''
     Get VPC info from the connected account so the lambda can be deployed in the same VPC
+
+    the VPC lookup is read from cdk.context.json, pre-warmed by config.vpc_context
     '''
+    from aws_cdk import aws_ec2 as _ec2, Fn, CfnParameter
+    from mlops_sm_project_template_rt.config.vpc_context import check_vpc_lookup
 
     bp_tags = {'aws:cloudformation:logical-id': 'ConnectedTgwVPC'}
     tgw_vpc = _ec2.Vpc.from_lookup(the_stack, 'my-vpc', region='eu-west-1', tags=bp_tags)
+    check_vpc_lookup(the_stack, tgw_vpc, f'of the VPC tagged {bp_tags} in eu-west-1')
 
     app_subnet_ids = CfnParameter(
         the_stack, "subnet-ids", type="AWS::SSM::Parameter::Value<List<String>>",
@@ -151,6 +79,8 @@ def get_vpc_info(the_stack):
 
 
 def get_branch_info(the_stack):
+    from aws_cdk import CfnParameter
+
     experiment_parent = CfnParameter(
         the_stack, 
         "experiment-parent", 
@@ -168,16 +98,19 @@ def get_branch_info(the_stack):
         ).value_as_string
     return experiment_parent, experiment_branch
     
+@profiled('get_local_prod_version', 'template_dir')
 def get_local_prod_version(templates_root, template_dir):
     '''
     get service catalog product version from local __version__.py file
+
+    the file is parsed rather than imported, and cached for the synth, see versions
     '''
     new_version = '0.0.0'
     from os import path
     version_path = path.join(templates_root, template_dir, '__version__.py')
     if path.exists(version_path):
-        module = importlib.import_module(f'templates.{template_dir}.__version__')
-        new_version = module.version
+        from mlops_sm_project_template_rt.config.versions import version_index
+        new_version = version_index.get(version_path)
     
     return new_version
 
@@ -185,23 +118,10 @@ def get_sc_prod_version(prod_name):
     '''
     get the current version of the product from service catalog
 
+    the versions of all products are fetched once per synth, see sc_version_resolver
+
     args:
         prod_name: the product name
     '''
-    ret = '0.0.0'
-    try:
-        _sc = boto3.client('servicecatalog')
-        prod_desc=_sc.describe_product(Name=prod_name)
-        provisioning_artifact_id = prod_desc['ProvisioningArtifacts'][0]['Id']
-
-        pa_desc = _sc.describe_provisioning_artifact(
-            ProductId=prod_desc['ProductViewSummary']['ProductId'],
-            ProvisioningArtifactId=provisioning_artifact_id
-        )
-
-        ret = pa_desc['ProvisioningArtifactDetail']['Name']
-
-    except Exception as e:
-        print(f"failed to get the product version of {prod_name}, use default version: 0.0.0, error: {e}")
-
-    return ret
+    from mlops_sm_project_template_rt.config.sc_version_resolver import get_version_resolver
+    return get_version_resolver().get_version(prod_name)
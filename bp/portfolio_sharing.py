@@ -0,0 +1,178 @@
+'''
+Sharing a Service Catalog portfolio with all the client accounts at once.
+
+Sharing is a create_portfolio_share call in the owner account, then an accept_portfolio_share call
+in the target account. Account shares are synchronous. The shares are created concurrently, and the
+accepts run concurrently too: rolling a portfolio out to every account takes about one share latency
+rather than one per account.
+
+Sharing again is harmless. The accounts the portfolio is already shared with are skipped, a share
+created meanwhile (DuplicateResourceException) counts as shared, and shares already accepted are not
+accepted again.
+
+Rolling the portfolio out to the client accounts of a pipeline type:
+
+    python -m utils.portfolio_sharing --pipeline-type DEV --accept
+'''
+
+import argparse
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+PORTFOLIO_NAME = 'SageMaker Organization Templates'
+ACCOUNT_ID = re.compile(r'^\d{12}$')
+
+
+class ShareResult:
+    '''
+    outcome of sharing the portfolio with one account
+
+    share is 'existing' when the portfolio was already shared with the account, 'created' when the
+    share was created by this run
+    '''
+
+    def __init__(self, account, share=None, accepted=False, error=None):
+        self.account = account
+        self.share = share
+        self.accepted = accepted
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.share in ('existing', 'created')
+
+    def to_dict(self):
+        return {
+            'account': self.account,
+            'share': self.share,
+            'accepted': self.accepted,
+            'error': None if self.error is None else repr(self.error),
+        }
+
+
+class PortfolioSharing:
+    '''
+    share portfolios of the owner account with many accounts concurrently
+
+    Args:
+        sc_client: servicecatalog client of the portfolio owner account
+        accept_client (callable): account -> servicecatalog client in that account, None to leave the shares unaccepted
+            (or when it returns None for the account)
+        max_workers (int): number of concurrent share / accept calls
+    '''
+
+    def __init__(self, sc_client, accept_client=None, max_workers=8):
+        self.sc_client = sc_client
+        self.accept_client = accept_client
+        self.max_workers = max_workers
+
+    def existing_shares(self, portfolio_id):
+        '''
+        account -> accepted of the accounts the portfolio is shared with
+        '''
+        shares = {}
+        kwargs = {'PortfolioId': portfolio_id, 'Type': 'ACCOUNT'}
+        while True:
+            page = self.sc_client.describe_portfolio_shares(**kwargs)
+            for share in page.get('PortfolioShareDetails', []):
+                shares[share['PrincipalId']] = share.get('Accepted', False)
+            if not page.get('NextPageToken'):
+                return shares
+            kwargs['PageToken'] = page['NextPageToken']
+
+    def _create(self, portfolio_id, result):
+        try:
+            self.sc_client.create_portfolio_share(
+                PortfolioId=portfolio_id, AccountId=result.account, ShareTagOptions=True
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'DuplicateResourceException':
+                raise
+            result.share = 'existing'
+            return
+        result.share = 'created'
+
+    def _accept(self, portfolio_id, result):
+        client = self.accept_client(result.account) if self.accept_client is not None else None
+        if client is None:
+            return
+        client.accept_portfolio_share(PortfolioId=portfolio_id, PortfolioShareType='IMPORTED')
+        result.accepted = True
+
+    def _fan_out(self, fn, portfolio_id, results):
+        '''
+        run fn for each result concurrently, a failure is recorded on its result
+        '''
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(results))), thread_name_prefix='share') as executor:
+            futures = {executor.submit(fn, portfolio_id, r): r for r in results}
+        for future, result in futures.items():
+            if future.exception() is not None:
+                result.error = future.exception()
+
+    def share(self, portfolio_id, accounts):
+        '''
+        share the portfolio with the accounts, and accept the shares in them
+
+        Args:
+            portfolio_id (str): id of the portfolio in the owner account
+            accounts ([str]): 12 digit ids of the accounts, organization nodes are not supported
+
+        Returns:
+            [dict]: account -> ShareResult, in the order of accounts
+        '''
+        invalid = [a for a in accounts if not ACCOUNT_ID.match(a)]
+        if len(invalid) > 0:
+            raise ValueError(f'not account ids: {invalid}')
+        results = {a: ShareResult(a) for a in dict.fromkeys(accounts)}
+        existing = self.existing_shares(portfolio_id)
+        for account, accepted in existing.items():
+            if account in results:
+                results[account].share = 'existing'
+                results[account].accepted = accepted
+
+        to_create = [r for r in results.values() if r.share is None]
+        self._fan_out(self._create, portfolio_id, to_create)
+
+        to_accept = [r for r in results.values() if r.succeeded and not r.accepted]
+        if self.accept_client is not None and len(to_accept) > 0:
+            self._fan_out(self._accept, portfolio_id, to_accept)
+        return results
+
+
+def share_portfolio(sc_client, portfolio_id, accounts, accept_client=None, **kwargs):
+    '''
+    share the portfolio with the accounts concurrently, see PortfolioSharing
+    '''
+    return PortfolioSharing(sc_client, accept_client, **kwargs).share(portfolio_id, accounts)
+
+
+def main(argv=None):
+    from mlops_sm_project_template_rt.config.accounts import get_automation_role_arn, get_client_act_ids
+    from mlops_sm_project_template_rt.config.aws_clients import get_client
+    from utils.catalog_index import get_catalog_index
+
+    parser = argparse.ArgumentParser(description='share the portfolio with the client accounts of a pipeline type')
+    parser.add_argument('--pipeline-type', default='DEV')
+    parser.add_argument('--portfolio-name', default=PORTFOLIO_NAME)
+    parser.add_argument('--accept', action='store_true', help='accept the shares through the automation role of each account')
+    args = parser.parse_args(argv)
+
+    client = get_client('servicecatalog')
+    portfolios = get_catalog_index(client).portfolios(args.portfolio_name)
+    if len(portfolios) != 1:
+        raise SystemExit(f'{len(portfolios)} portfolios named {args.portfolio_name}')
+
+    accept_client = None
+    if args.accept:
+        accept_client = lambda act_id: get_client('servicecatalog', role_arn=get_automation_role_arn(act_id))
+    results = share_portfolio(client, portfolios[0]['Id'], get_client_act_ids(args.pipeline_type), accept_client)
+    for result in results.values():
+        print(result.to_dict())
+    if not all(r.succeeded for r in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
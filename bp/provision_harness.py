@@ -0,0 +1,124 @@
+'''
+Concurrent end to end provisioning of the Service Catalog products.
+
+The lifecycle of each product (delete the previous provisioning, associate the principal, provision,
+wait for CloudFormation and the pipelines, check the model package) is a list of stages run as an
+independent asyncio task, and a semaphore bounds how many products run at the same time. The
+stages are blocking boto3 calls and waits, so they run in worker threads: the end to end time
+approaches the slowest product rather than the sum of all of them.
+
+The latency of every stage is recorded, and reported once all products are done.
+'''
+
+import asyncio
+import time
+from datetime import datetime
+
+
+class StageResult:
+    '''
+    latency of one stage of a product lifecycle
+    '''
+
+    def __init__(self, stage, started_s, seconds, error=None):
+        self.stage = stage
+        self.started_s = started_s
+        self.seconds = seconds
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'started_s': round(self.started_s, 1),
+            'seconds': round(self.seconds, 1),
+            'error': None if self.error is None else repr(self.error),
+        }
+
+
+class ProductRun:
+    '''
+    stages run for one product, the lifecycle stops at the first failed stage
+    '''
+
+    def __init__(self, product):
+        self.product = product
+        self.stages = []
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {
+            'product': self.product,
+            'seconds': round(self.seconds, 1),
+            'succeeded': self.succeeded,
+            'stages': [s.to_dict() for s in self.stages],
+        }
+
+
+class ProvisionHarness:
+    '''
+    run the lifecycles of many products concurrently, at most max_concurrency at a time
+    '''
+
+    def __init__(self, max_concurrency=3):
+        self.max_concurrency = max_concurrency
+        self.wall_s = 0.0
+
+    async def _run_product(self, product, stages, semaphore, started):
+        run = ProductRun(product)
+        async with semaphore:
+            product_start = time.perf_counter()
+            for stage, fn in stages:
+                print(f"   - {datetime.now()}: {product}: {stage}", flush=True)
+                stage_start = time.perf_counter()
+                try:
+                    await asyncio.to_thread(fn)
+                except Exception as e:
+                    run.error = e
+                finally:
+                    run.stages.append(StageResult(stage, stage_start - started, time.perf_counter() - stage_start, run.error))
+                if run.error is not None:
+                    print(f"   - {datetime.now()}: {product}: {stage} failed: {run.error!r}", flush=True)
+                    break
+            run.seconds = time.perf_counter() - product_start
+        return run
+
+    async def run_async(self, lifecycles):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        started = time.perf_counter()
+        runs = await asyncio.gather(*[
+            self._run_product(product, stages, semaphore, started) for product, stages in lifecycles.items()
+        ])
+        self.wall_s = time.perf_counter() - started
+        return list(runs)
+
+    def run(self, lifecycles):
+        '''
+        args:
+            lifecycles (dict): product -> [(stage name, callable)], the stages of a product run in order
+
+        returns:
+            [list]: ProductRun of each product, in the order of lifecycles
+        '''
+        return asyncio.run(self.run_async(lifecycles))
+
+    def report(self, runs):
+        '''
+        print the latency of each stage, and return the report
+        '''
+        report = {
+            'wall_s': round(self.wall_s, 1),
+            'sum_s': round(sum(r.seconds for r in runs), 1),
+            'products': [r.to_dict() for r in runs],
+        }
+        print(f"\nprovisioned {len(runs)} products in {report['wall_s']}s (sequential: {report['sum_s']}s)")
+        print(f"{'product':<24} {'stage':<24} {'start s':>8} {'took s':>8}")
+        for run in runs:
+            for stage in run.stages:
+                status = '' if stage.error is None else ' FAILED'
+                print(f"{run.product[:24]:<24} {stage.stage[:24]:<24} {stage.started_s:>8.1f} {stage.seconds:>8.1f}{status}")
+        return report
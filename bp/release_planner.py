@@ -0,0 +1,287 @@
+'''
+Release plan of the Service Catalog products, computed once per synth.
+
+ServiceCatalogStack and SharedCodeStack both decide, for each product under the templates root,
+whether to release its local version or to keep the deployed one. The planner reads the local and
+deployed versions once, hashes the stack source and the seed code of the released products, and
+records the decision in one manifest entry per product:
+
+    template_action: 'synth'     synthesize the product template
+                     'reuse'     reuse the template of a previous synth, stack source and version are unchanged
+                     'deployed'  keep the template of the deployed version
+                     'skip'      the product is not released to this account
+    seed_action:     'synth'     build the seed code archives
+                     'reuse'     reuse the archives of a previous synth, the seed code and the archives are
+                                 unchanged
+                     'deployed'  keep the deployed seed code bundles
+                     'skip'      the product has no seed code
+
+The manifest of the last synth of each account and region is kept in the synth cache
+(release-manifest-{account}-{region}.json). That is what lets the dev accounts, where the local
+version is always released but rarely bumped, skip the products nobody touched. Set
+MLOPS_SYNTH_CACHE=0 to always synthesize.
+
+The seed code archives are shared by the accounts and checkouts, the synth of another account can
+rebuild them from other seed code. The manifest also records the hash each archive was built from
+(its .sha256 file, see zip_builder), and an archive is only reused while it still matches.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import weakref
+from os import path, listdir
+
+from mlops_sm_project_template_rt.config import constants
+from mlops_sm_project_template_rt.config.versions import is_newer, parse_version
+from mlops_sm_project_template_rt.synth_cache import cache_enabled, cache_root, hash_files, hash_tree, list_tree_files
+from mlops_sm_project_template_rt.synth_profiler import phase
+from mlops_sm_project_template_rt.zip_builder import archive_hash
+
+SYNTH = 'synth'
+REUSE = 'reuse'
+DEPLOYED = 'deployed'
+SKIP = 'skip'
+
+SEED_DIR = 'seed_code'
+
+# lowest version released to the non-dev accounts
+MIN_RELEASE_VERSION = '1.0'
+
+# the product templates also depend on the shared constructs and post processing of this package
+_PACKAGE_DIR = path.dirname(path.abspath(__file__))
+
+
+class ProductPlan:
+    '''
+    manifest entry of one product
+    '''
+
+    def __init__(self, name, local_version, deployed_version):
+        self.name = name
+        self.local_version = local_version
+        self.deployed_version = deployed_version
+        self.stack_hash = None
+        self.seed_hash = None
+        self.template_action = None
+        self.seed_action = None
+        # stack name -> path, stack hash and version of the processed template
+        self.templates = {}
+        # seed code folder -> path of its archive, and the tree hash it was built from
+        self.seed_archives = {}
+        self.seed_archive_hashes = {}
+
+    def to_dict(self):
+        return {
+            'local_version': self.local_version,
+            'deployed_version': self.deployed_version,
+            'stack_hash': self.stack_hash,
+            'seed_hash': self.seed_hash,
+            'template_action': self.template_action,
+            'seed_action': self.seed_action,
+            'templates': dict(self.templates),
+            'seed_archives': dict(self.seed_archives),
+            'seed_archive_hashes': dict(self.seed_archive_hashes),
+        }
+
+    def template_path(self, stack_name):
+        template = self.templates.get(stack_name)
+        return template['path'] if template is not None else None
+
+    def __str__(self):
+        return self.name
+
+
+class ReleasePlanner:
+    '''
+    plans the release of the products under templates_root to the account act_id
+    '''
+
+    def __init__(self, templates_root, act_id, region=None, cache_dir=None, enabled=None):
+        self.templates_root = templates_root
+        self.act_id = act_id
+        self.region = region or ''
+        self.enabled = cache_enabled() if enabled is None else enabled
+        self.manifest_path = path.join(cache_dir or cache_root(), f'release-manifest-{act_id}-{self.region}.json')
+        self._lock = threading.Lock()
+        self._products = None
+        self._package_hash = None
+        self.previous = self._load_previous()
+
+    def _load_previous(self):
+        if not self.enabled or not path.isfile(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f).get('products', {})
+        except ValueError:
+            # a corrupt manifest only costs a full synth
+            return {}
+
+    def product_dirs(self):
+        '''
+        folders of the products, in listdir order
+        '''
+        return [d for d in listdir(self.templates_root)
+                if path.isfile(path.join(self.templates_root, d, f'{d}Stack.py'))]
+
+    def products(self):
+        '''
+        ProductPlan of each product, the local and deployed versions are only read once
+        '''
+        with self._lock:
+            if self._products is None:
+                with phase('release_plan'):
+                    # through the module, so the version lookups can be patched in the tests
+                    self._products = {
+                        d: ProductPlan(d, constants.get_local_prod_version(self.templates_root, d), constants.get_sc_prod_version(d))
+                        for d in self.product_dirs()
+                    }
+            return self._products
+
+    def package_hash(self):
+        if self._package_hash is None:
+            digest = hashlib.sha256()
+            hash_tree(digest, _PACKAGE_DIR)
+            self._package_hash = digest.hexdigest()
+        return self._package_hash
+
+    def stack_hash(self, template_dir):
+        '''
+        hash of the source the product template is generated from, its seed code excluded
+        '''
+        digest = hashlib.sha256(self.package_hash().encode('utf-8'))
+        hash_files(digest, [f for f in list_tree_files(path.join(self.templates_root, template_dir))
+                            if not f[0].startswith(f'{SEED_DIR}/')])
+        return digest.hexdigest()
+
+    def seed_hash(self, template_dir):
+        '''
+        hash of the seed code of the product, and of the version file copied into it
+        '''
+        digest = hashlib.sha256()
+        version_path = path.join(self.templates_root, template_dir, '__version__.py')
+        if path.isfile(version_path):
+            hash_files(digest, [('__version__.py', version_path)])
+        hash_tree(digest, path.join(self.templates_root, template_dir, SEED_DIR))
+        return digest.hexdigest()
+
+    def _is_released(self, plan, release_all):
+        return release_all or is_newer(plan.local_version, plan.deployed_version)
+
+    def plan_templates(self, stage_name, release_all):
+        '''
+        set the template action of each product
+
+        Args:
+            stage_name (str): stage the templates are generated for, part of their stack names
+            release_all (bool): release the local version of every product, even when it is not newer (dev accounts)
+
+        Returns:
+            [list]: ProductPlan of the products in the portfolio, sorted by name
+        '''
+        plans = []
+        for plan in sorted(self.products().values(), key=lambda p: p.name):
+            if not release_all and parse_version(plan.local_version) < parse_version(MIN_RELEASE_VERSION):
+                # we only release version 1.0 or above to non-dev account
+                plan.template_action = SKIP
+                continue
+            plans.append(plan)
+            if not self._is_released(plan, release_all):
+                plan.template_action = DEPLOYED
+                continue
+
+            plan.stack_hash = self.stack_hash(plan.name)
+            stack_name = f'{plan.name}-{stage_name}'
+            previous = self.previous.get(plan.name, {}).get('templates', {}).get(stack_name)
+            if (previous is not None and previous['stack_hash'] == plan.stack_hash
+                    and previous['version'] == plan.local_version and path.isfile(previous['path'])):
+                plan.template_action = REUSE
+                plan.templates[stack_name] = previous
+            else:
+                plan.template_action = SYNTH
+        return plans
+
+    def plan_seeds(self, release_all):
+        '''
+        set the seed action of each product
+
+        Args:
+            release_all (bool): release the local seed code of every product, even when it is not newer (dev accounts)
+
+        Returns:
+            [list]: ProductPlan of the products, in listdir order
+        '''
+        plans = list(self.products().values())
+        for plan in plans:
+            seed_dir = path.join(self.templates_root, plan.name, SEED_DIR)
+            if not path.isdir(seed_dir):
+                plan.seed_action = SKIP
+                continue
+            if not self._is_released(plan, release_all):
+                plan.seed_action = DEPLOYED
+                continue
+
+            plan.seed_hash = self.seed_hash(plan.name)
+            previous = self.previous.get(plan.name, {})
+            archives = previous.get('seed_archives', {})
+            hashes = previous.get('seed_archive_hashes', {})
+            # the archive may have been rebuilt since, by the synth of another account or checkout
+            if (previous.get('seed_hash') == plan.seed_hash and sorted(archives) == sorted(listdir(seed_dir))
+                    and all(hashes.get(d) is not None and archive_hash(p) == hashes[d] for d, p in archives.items())):
+                plan.seed_action = REUSE
+                plan.seed_archives.update(archives)
+                plan.seed_archive_hashes.update(hashes)
+            else:
+                plan.seed_action = SYNTH
+        return plans
+
+    def record_template(self, plan, stack_name, template_path):
+        plan.templates[stack_name] = {'path': template_path, 'stack_hash': plan.stack_hash, 'version': plan.local_version}
+
+    def record_seed_archive(self, plan, seed_dir, archive_path):
+        plan.seed_archives[seed_dir] = archive_path
+        plan.seed_archive_hashes[seed_dir] = archive_hash(archive_path)
+
+    def save(self):
+        '''
+        write the manifest, the entries of the previous synth are updated with what this synth planned
+        '''
+        if not self.enabled:
+            return
+        products = {name: dict(entry) for name, entry in self.previous.items()}
+        for plan in self.products().values():
+            entry = products.setdefault(plan.name, {})
+            for key, value in plan.to_dict().items():
+                if key == 'templates':
+                    entry['templates'] = {**entry.get('templates', {}), **value}
+                elif value is not None and value != {}:
+                    entry[key] = value
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'account': self.act_id, 'region': self.region, 'products': products}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+
+# app -> {(templates_root, act_id, region): planner}, the planners go with their app
+_planners = weakref.WeakKeyDictionary()
+_planners_lock = threading.Lock()
+
+
+def get_release_planner(scope, templates_root, act_id, region=None):
+    '''
+    return the planner shared by the stacks of the app scope belongs to, one plan per synth
+    '''
+    root = scope.node.root
+    with _planners_lock:
+        planners = _planners.setdefault(root, {})
+        key = (templates_root, act_id, region)
+        if key not in planners:
+            planners[key] = ReleasePlanner(templates_root, act_id, region)
+        return planners[key]
+
+
+def reset_release_planners():
+    with _planners_lock:
+        _planners.clear()
@@ -0,0 +1,92 @@
+'''
+Permission boundary of the IAM roles of a stack, applied by a single walk of the construct tree.
+
+A CDK aspect is called back (through jsii) for every construct of the tree it is added to, although
+only the IAM roles need a boundary. RoleBoundaryVisitor lists the constructs once, once the stack is
+fully built and right before it is synthesized, and only sets the PermissionsBoundary of the role
+resources: the L1 CfnRole of iam.Role, and the raw CfnResource roles of the custom resource providers.
+
+The visitor keeps a manifest of the roles it patched. It is written next to the template (see
+write_manifest), so the roles of a cached template or of one synthesized in another process can be
+checked without parsing the template again. The manifest helpers don't load the CDK.
+'''
+
+import json
+import os
+from os import path
+
+ROLE_TYPE = 'AWS::IAM::Role'
+
+
+class RoleBoundaryVisitor:
+    '''
+    set the permission boundary boundary_arn on the roles under a scope
+    '''
+
+    def __init__(self, boundary_arn):
+        self.boundary_arn = boundary_arn
+        self.roles = []
+
+    def visit(self, scope):
+        '''
+        patch the roles under scope, only call once scope is complete: roles added later are not patched
+
+        Returns:
+            [list]: the roles patched, see manifest
+        '''
+        from aws_cdk import CfnResource, Stack, aws_iam as iam
+
+        patched = []
+        for construct in scope.node.find_all():
+            # the custom resource providers declare their roles as plain CfnResource
+            if not (isinstance(construct, iam.CfnRole)
+                    or (type(construct) is CfnResource and construct.cfn_resource_type == ROLE_TYPE)):
+                continue
+            construct.add_property_override('PermissionsBoundary', self.boundary_arn)
+            stack = Stack.of(construct)
+            patched.append({
+                'stack': stack.stack_name,
+                'logical_id': stack.resolve(construct.logical_id),
+                'path': construct.node.path,
+            })
+        self.roles += patched
+        return patched
+
+    def manifest(self):
+        return {'boundary_arn': self.boundary_arn, 'roles': list(self.roles)}
+
+
+def apply_permission_boundary(scope, boundary_arn):
+    '''
+    set the permission boundary on the roles under scope, and return the manifest of the patched roles
+    '''
+    visitor = RoleBoundaryVisitor(boundary_arn)
+    visitor.visit(scope)
+    return visitor.manifest()
+
+
+def manifest_path(template_path):
+    '''
+    path of the manifest kept next to the template
+    '''
+    return f'{path.splitext(template_path)[0]}.boundary.json'
+
+
+def write_manifest(template_path, manifest):
+    target = manifest_path(template_path)
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, target)
+    return target
+
+
+def read_manifest(template_path):
+    '''
+    manifest of the roles of the template, None when the template was not synthesized here (e.g. a deployed template)
+    '''
+    target = manifest_path(template_path)
+    if not path.isfile(target):
+        return None
+    with open(target, 'r') as f:
+        return json.load(f)
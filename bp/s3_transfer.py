@@ -0,0 +1,157 @@
+'''
+Download of the already deployed seed code bundles from the shared code bucket.
+
+Bundles can carry model artifacts and get large, so downloads use tuned multipart settings, and a
+local copy of each bundle is kept with its ETag: the next synth only asks S3 whether the bundle
+changed (conditional request with If-None-Match) instead of downloading it again.
+
+The downloaded bytes are written straight into the outer zip expected by the BucketDeployment
+(and into the local copy at the same time), rather than being saved and zipped again.
+'''
+
+import os
+import stat
+import zipfile
+from os import path
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from mlops_sm_project_template_rt.zip_builder import FIXED_DATE_TIME
+
+MB = 1024 * 1024
+
+
+def transfer_config():
+    '''
+    multipart settings of the downloads, from MLOPS_S3_MULTIPART_THRESHOLD_MB, MLOPS_S3_MULTIPART_CHUNKSIZE_MB
+    and MLOPS_S3_MAX_CONCURRENCY
+    '''
+    return TransferConfig(
+        multipart_threshold=int(os.environ.get('MLOPS_S3_MULTIPART_THRESHOLD_MB', '16')) * MB,
+        multipart_chunksize=int(os.environ.get('MLOPS_S3_MULTIPART_CHUNKSIZE_MB', '16')) * MB,
+        max_concurrency=int(os.environ.get('MLOPS_S3_MAX_CONCURRENCY', '10')),
+        use_threads=True,
+    )
+
+
+class _TeeWriter:
+    '''
+    non seekable file object writing to several files, s3transfer writes the parts to it in order
+    '''
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+    def seekable(self):
+        return False
+
+
+def _read(file_path):
+    if not path.isfile(file_path):
+        return None
+    with open(file_path, 'r') as f:
+        return f.read().strip()
+
+
+def _write(file_path, content):
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+
+
+def _zip_entry(key, size):
+    # the bundle is already a zip file, store it as is
+    info = zipfile.ZipInfo(key, date_time=FIXED_DATE_TIME)
+    # a regular file, as the entries of zip_builder
+    info.external_attr = (stat.S_IFREG | 0o644) << 16
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = size
+    return info
+
+
+def head_if_modified(s3_client, bucket, key, etag):
+    '''
+    return the head of s3://bucket/key, or None when its ETag still is etag
+    '''
+    try:
+        if etag is None:
+            return s3_client.head_object(Bucket=bucket, Key=key)
+        return s3_client.head_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None
+        raise
+
+
+def check_unchanged(s3_client, bucket, key, etag):
+    '''
+    raise when the ETag of s3://bucket/key is no longer etag
+    '''
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key, IfMatch=etag)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('412', 'PreconditionFailed'):
+            raise RuntimeError(f's3://{bucket}/{key} was replaced during its download, run the synth again') from e
+        raise
+
+
+def download_into_zip(s3_client, bucket, key, cache_path, outer_path):
+    '''
+    wrap s3://bucket/key into the zip file outer_path, as its only entry named key
+
+    Args:
+        s3_client: s3 client used for the download
+        bucket (str): bucket of the bundle
+        key (str): key of the bundle
+        cache_path (str): local copy of the bundle, its ETag is kept in cache_path.etag
+        outer_path (str): path of the outer zip file, its ETag is kept in outer_path.etag
+
+    Returns:
+        [str]: outer_path
+    '''
+    cache_etag = _read(f'{cache_path}.etag') if path.isfile(cache_path) else None
+    head = head_if_modified(s3_client, bucket, key, cache_etag)
+
+    if head is None:
+        # not modified: reuse the outer zip, or wrap the local copy
+        if path.isfile(outer_path) and _read(f'{outer_path}.etag') == cache_etag:
+            print(f'Reusing s3://{bucket}/{key}: {outer_path}')
+            return outer_path
+        print(f'Wrapping the local copy of s3://{bucket}/{key}: {outer_path}')
+        tmp_outer = f'{outer_path}.{os.getpid()}.tmp'
+        with zipfile.ZipFile(tmp_outer, 'w') as zf:
+            zf.write(cache_path, arcname=key, compress_type=zipfile.ZIP_STORED)
+        os.replace(tmp_outer, outer_path)
+        _write(f'{outer_path}.etag', cache_etag)
+        return outer_path
+
+    etag = head['ETag']
+    print(f'Downloading s3://{bucket}/{key} ({head["ContentLength"]} bytes): {outer_path}')
+    os.makedirs(path.dirname(cache_path), exist_ok=True)
+    tmp_outer = f'{outer_path}.{os.getpid()}.tmp'
+    tmp_cache = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with zipfile.ZipFile(tmp_outer, 'w') as zf, \
+                zf.open(_zip_entry(key, head['ContentLength']), 'w') as entry, \
+                open(tmp_cache, 'wb') as cache_file:
+            s3_client.download_fileobj(bucket, key, _TeeWriter(entry, cache_file), Config=transfer_config())
+        # the transfer can't be made conditional, fail rather than keep a mix of two versions if the
+        # bundle was replaced during the download
+        check_unchanged(s3_client, bucket, key, etag)
+        os.replace(tmp_cache, cache_path)
+        os.replace(tmp_outer, outer_path)
+    finally:
+        for tmp_path in (tmp_cache, tmp_outer):
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    _write(f'{cache_path}.etag', etag)
+    _write(f'{outer_path}.etag', etag)
+    return outer_path
@@ -0,0 +1,138 @@
+'''
+Resolve the deployed version of every Service Catalog product in one sweep.
+
+Both ServiceCatalogStack and SharedCodeStack need the current version of each product. Rather than
+describing each product (and its provisioning artifact) one by one, the resolver pages through the
+products of the portfolio (search_products_as_admin) once, lists the artifacts of each of them, and
+keeps the result for the lifetime of the synth process. The other products of the account are not
+looked at: Service Catalog has no batch listing of the artifacts, each product costs one call.
+
+The current version of a product is its active provisioning artifact created last, whatever order
+the artifacts are listed in. (It used to be the first artifact listed by describe_product, in no
+documented order. Both agree for the products of ServiceCatalogStack, which keep one active artifact.)
+'''
+
+import os
+import threading
+
+from mlops_sm_project_template_rt.config.aws_clients import get_client
+from mlops_sm_project_template_rt.config.constants import sc_portfolio_name
+from mlops_sm_project_template_rt.synth_profiler import phase
+
+DEFAULT_VERSION = '0.0.0'
+
+
+class ProductVersion:
+    '''
+    the current provisioning artifact of a service catalog product
+    '''
+
+    def __init__(self, product_name, product_id, artifact_id, version):
+        self.product_name = product_name
+        self.product_id = product_id
+        self.artifact_id = artifact_id
+        self.version = version
+
+    def __repr__(self):
+        return f'ProductVersion({self.product_name}, {self.product_id}, {self.artifact_id}, {self.version})'
+
+
+class ScVersionResolver:
+    '''
+    snapshot of the deployed product versions, fetched on first use
+    '''
+
+    def __init__(self, client_factory=None, portfolio_name=sc_portfolio_name):
+        self._client_factory = client_factory or (lambda: get_client('servicecatalog'))
+        self.portfolio_name = portfolio_name
+        self._lock = threading.Lock()
+        self._products = None
+
+    def snapshot(self):
+        '''
+        return product name -> ProductVersion, fetching it from service catalog on first call
+        '''
+        with self._lock:
+            if self._products is None:
+                try:
+                    with phase('sc_version_lookup'):
+                        self._products = self._fetch()
+                except Exception as e:
+                    # remember the failure, so the products don't each retry (and time out) on their own
+                    print(f"failed to resolve the service catalog product versions, use default version: {DEFAULT_VERSION}, error: {e}")
+                    self._products = {}
+            return self._products
+
+    def refresh(self):
+        with self._lock:
+            self._products = None
+        return self.snapshot()
+
+    def get(self, prod_name):
+        '''
+        return the ProductVersion of prod_name, or None if the product is not deployed
+        '''
+        return self.snapshot().get(prod_name)
+
+    def get_version(self, prod_name):
+        prod = self.get(prod_name)
+        return prod.version if prod is not None else DEFAULT_VERSION
+
+    def _fetch(self):
+        _sc = self._client_factory()
+        products = {}
+        paginator = _sc.get_paginator('search_products_as_admin')
+        for portfolio_id in self._portfolio_ids(_sc):
+            for page in paginator.paginate(PortfolioId=portfolio_id):
+                for detail in page['ProductViewDetails']:
+                    summary = detail['ProductViewSummary']
+                    artifact = self._current_artifact(_sc, summary['ProductId'])
+                    if artifact is None:
+                        continue
+                    products[summary['Name']] = ProductVersion(summary['Name'], summary['ProductId'], artifact['Id'], artifact['Name'])
+        print(f"resolved the version of {len(products)} service catalog products: {list(products.values())}")
+        return products
+
+    def _portfolio_ids(self, _sc):
+        # none before the first deployment of the portfolio, all products are then at the default version
+        ids = []
+        for page in _sc.get_paginator('list_portfolios').paginate():
+            ids += [p['Id'] for p in page['PortfolioDetails'] if p['DisplayName'] == self.portfolio_name]
+        return ids
+
+    @staticmethod
+    def _current_artifact(_sc, product_id):
+        # the active artifact created last is the version currently released
+        artifacts = _sc.list_provisioning_artifacts(ProductId=product_id)['ProvisioningArtifactDetails']
+        active = [a for a in artifacts if a.get('Active', True)]
+        if len(active) == 0:
+            return None
+        return max(active, key=lambda a: a['CreatedTime'])
+
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+
+def _credential_context():
+    # tests switch account by changing the profile / region between tests
+    return (os.environ.get('AWS_PROFILE'), os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION'))
+
+
+def get_version_resolver():
+    '''
+    the resolver shared by all stacks of the synth process (one per aws profile and region)
+    '''
+    with _resolvers_lock:
+        context = _credential_context()
+        if context not in _resolvers:
+            _resolvers[context] = ScVersionResolver()
+        return _resolvers[context]
+
+
+def reset_version_resolver():
+    '''
+    drop the cached snapshots, so the versions are fetched again on next use
+    '''
+    with _resolvers_lock:
+        _resolvers.clear()
@@ -0,0 +1,86 @@
+'''
+Scratch space of a synth: CDK output folders, downloads and other files only needed while it runs.
+
+Each process tree gets its own root, named after the pytest-xdist worker (PYTEST_XDIST_WORKER) it
+runs in, so concurrent synths and test workers never write to the same paths. The root is created
+on first use under MLOPS_SCRATCH_DIR (the system temp folder by default) and removed when the
+process that created it exits. Child processes, e.g. the synth process pool, inherit the root of
+their parent through the environment, so the files they return outlive them.
+
+The persistent caches (synth_cache, artifact_cache, archives) are not scratch space: they are
+shared between runs and workers, and written atomically.
+'''
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from os import path
+
+SCRATCH_ENV_DIR = 'MLOPS_SCRATCH_DIR'
+# root of the process tree, set by the process owning it
+SCRATCH_ENV_ROOT = 'MLOPS_SCRATCH_ROOT'
+
+_lock = threading.Lock()
+# roots created by this process
+_owned_roots = []
+
+
+def worker_id():
+    '''
+    pytest-xdist worker running this process, 'main' outside of xdist
+    '''
+    return os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+
+def _prefix():
+    return f'mlops-scratch-{worker_id()}-'
+
+
+def scratch_root():
+    '''
+    scratch root of this process tree, created on first use
+    '''
+    with _lock:
+        root = os.environ.get(SCRATCH_ENV_ROOT)
+        # a root inherited from another worker (e.g. the xdist controller) is not ours
+        if root is not None and path.basename(root).startswith(_prefix()) and path.isdir(root):
+            return root
+
+        parent = os.environ.get(SCRATCH_ENV_DIR) or tempfile.gettempdir()
+        os.makedirs(parent, exist_ok=True)
+        root = tempfile.mkdtemp(prefix=_prefix(), dir=parent)
+        os.environ[SCRATCH_ENV_ROOT] = root
+        if len(_owned_roots) == 0:
+            atexit.register(cleanup)
+        _owned_roots.append(root)
+        return root
+
+
+def scratch_dir(*parts):
+    '''
+    folder under the scratch root, created if needed
+    '''
+    ret = path.join(scratch_root(), *parts)
+    os.makedirs(ret, exist_ok=True)
+    return ret
+
+
+def scratch_mkdtemp(prefix, *parts):
+    '''
+    new, unique folder under the scratch folder parts
+    '''
+    return tempfile.mkdtemp(prefix=prefix, dir=scratch_dir(*parts))
+
+
+def cleanup():
+    '''
+    remove the scratch roots created by this process, the inherited roots are left to their owner
+    '''
+    with _lock:
+        for root in _owned_roots:
+            shutil.rmtree(root, ignore_errors=True)
+        if os.environ.get(SCRATCH_ENV_ROOT) in _owned_roots:
+            del os.environ[SCRATCH_ENV_ROOT]
+        _owned_roots.clear()
@@ -37,7 +37,8 @@ from aws_cdk import (
 import aws_cdk
 import json
 from datetime import datetime
-from os import path, listdir, sys
+from os import path, sys, environ, cpu_count, getpid
+from concurrent.futures import ThreadPoolExecutor
 import inspect
 import importlib
 import boto3
@@ -46,7 +47,17 @@ import requests
 from constructs import Construct
 
 from mlops_sm_project_template_rt.constructs.ssm_construct import SSMConstruct
-from mlops_sm_project_template_rt.permission_boundary import PermissionBoundaryAspect
+from mlops_sm_project_template_rt.role_boundary import apply_permission_boundary, read_manifest, write_manifest
+from mlops_sm_project_template_rt.synth_cache import SynthCache, write_missing_context
+from mlops_sm_project_template_rt.artifact_cache import TemplateArtifactCache
+from mlops_sm_project_template_rt.template_rules import cross_account_transformer
+from mlops_sm_project_template_rt.synth_profiler import phase, profiled, propagate
+from mlops_sm_project_template_rt.config.sc_version_resolver import get_version_resolver
+from mlops_sm_project_template_rt.config.aws_clients import get_client
+from mlops_sm_project_template_rt.release_planner import DEPLOYED, REUSE, SYNTH, get_release_planner
+from mlops_sm_project_template_rt.synth_worker import synthesize_isolated, synthesize_warm, worker_address
+from mlops_sm_project_template_rt.scratch import scratch_mkdtemp
+from mlops_sm_project_template_rt.config.vpc_context import missing_context
 
 from mlops_sm_project_template_rt.config.constants import (
     DEV_ACCOUNT,
@@ -58,6 +69,7 @@ from mlops_sm_project_template_rt.config.constants import (
     PROD_ACCOUNT_NAME,
     PROD_REGION,
     sc_prod_launch_role_name,
+    sc_portfolio_name,
     get_code_bucket_name,
     get_act_name_from_id,
     get_sc_prod_version,
@@ -72,6 +84,7 @@ from mlops_sm_project_template_rt.config.constants import (
 # Create a Portfolio and Product
 # see: https://docs.aws.amazon.com/cdk/api/latest/python/aws_cdk.aws_servicecatalog.html
 class ServiceCatalogStack(Stack):
+    @profiled('ServiceCatalogStack')
     def __init__(
         self,
         scope: Construct,
@@ -81,6 +94,10 @@ class ServiceCatalogStack(Stack):
         super().__init__(scope, construct_id, **kwargs)
         self.act_id = kwargs['env'].account
         assert len(self.act_id) == 12
+        self.synth_cache = SynthCache()
+        # the templates depend on the context of the synth (feature flags, lookups), see get_template_cache_key
+        self.synth_context = self.node.get_all_context()
+        self.artifact_cache = TemplateArtifactCache()
 
         stage_name = Stage.of(self).stage_name.lower()
 
@@ -98,7 +115,7 @@ class ServiceCatalogStack(Stack):
             "PortfolioName",
             type="String",
             description="The name of the portfolio",
-            default="SageMaker Organization Templates",
+            default=sc_portfolio_name,
             min_length=1,
         )
 
@@ -142,30 +159,27 @@ class ServiceCatalogStack(Stack):
         # a service catalog could contain multiple products, below code loop through all folders under
         # templates, and add each as a product
         parent_dir = path.dirname(path.abspath(inspect.getfile(inspect.currentframe())))  # type: ignore
-        templates_root = f'{path.dirname(parent_dir)}/templates'
+        templates_root = environ.get('MLOPS_TEMPLATES_ROOT', f'{path.dirname(parent_dir)}/templates')
+        self.templates_root = templates_root
         product_id_list = []
         self.generated_template_path_list = []
-        if templates_root not in sys.path:
-            sys.path.insert(0, templates_root)
 
+        # the local / deployed versions and the action on each product are planned once per synth,
+        # and shared with the SharedCodeStack (see release_planner)
+        self.release_planner = get_release_planner(self, templates_root, self.act_id, self.region)
+        products = self.release_planner.plan_templates(stage_name, release_all=self.account in [PIPELINE_ACCOUNT, FEATURE_GOV_ACCOUNT])
 
-        from mlops_sm_project_template_rt.config.constants import get_sc_prod_version, get_local_prod_version
-        for template_dir in listdir(templates_root):
-            if not path.isdir(path.join(templates_root, template_dir)):
-                continue
-
-            for template_file in listdir(path.join(templates_root, template_dir)):
-                if template_file == f'{template_dir}Stack.py': 
-
-                    new_version = get_local_prod_version(templates_root, template_dir)
-                    cur_version = get_sc_prod_version(template_dir)
-
-                    if self.account not in[PIPELINE_ACCOUNT, FEATURE_GOV_ACCOUNT] and new_version < '1.0':
-                        # we only release version 1.0 or above to non-dev account
-                        continue
+        # products are independent of each other, so their templates can be synthesized concurrently,
+        # they are then added to the portfolio in the (sorted) folder order
+        prebuilt_templates = {}
+        synth_workers = get_synth_workers(self)
+        if synth_workers > 1:
+            prebuilt_templates = self.synthesize_templates(templates_root, stage_name, products, synth_workers, **kwargs)
 
-                    templ_prod_id = self.add_template_to_portfolio(stage_name, template_dir, cur_version, new_version, **kwargs)
-                    product_id_list.append(templ_prod_id)
+        for plan in products:
+            templ_prod_id = self.add_template_to_portfolio(stage_name, plan, json_path=prebuilt_templates.get(plan.name), **kwargs)
+            product_id_list.append(templ_prod_id)
+        self.release_planner.save()
 
         # role_constraint.add_depends_on(portfolio_association)
         if self.account == PIPELINE_ACCOUNT:
@@ -175,19 +189,28 @@ class ServiceCatalogStack(Stack):
 
 
 
-    def add_template_to_portfolio(self, stage_name, template_dir, current_version, new_version, **kwargs):
+    @profiled('add_template_to_portfolio', 'plan')
+    def add_template_to_portfolio(self, stage_name, plan, json_path=None, **kwargs):
         '''
         one portfolio can have multiple products, here we add the product to the portfolio
-        
+
+        plan is the release plan of the product (see release_planner), json_path the template already
+        synthesized for the new version (see synthesize_templates), if any
         '''
-        module = importlib.import_module(f'{template_dir}.{template_dir}Stack')
-        template_class = getattr(module, f'{template_dir}Stack')
-        if new_version > current_version or self.account in [PIPELINE_ACCOUNT, FEATURE_GOV_ACCOUNT]:
-            json_path = self.generate_template(template_class, f"{template_dir}-{stage_name}", version=new_version, **kwargs)   
-            final_version = new_version
-        else:
+        template_dir = plan.name
+        template_class = import_template_class(self.templates_root, template_dir)
+        if plan.template_action == DEPLOYED:
             json_path = self.get_existing_template(template_dir)
-            final_version = current_version
+            final_version = plan.deployed_version
+        else:
+            stack_name = f"{template_dir}-{stage_name}"
+            if json_path is None and plan.template_action == REUSE:
+                json_path = plan.template_path(stack_name)
+                print (f'Reusing unchanged CFN template for stack: {stack_name}: {json_path}')
+            if json_path is None:
+                json_path = self.generate_template(template_class, stack_name, version=plan.local_version, **kwargs)
+            self.release_planner.record_template(plan, stack_name, json_path)
+            final_version = plan.local_version
 
         self.generated_template_path_list.append(json_path)
         deploy_product = servicecatalog_alpha.CloudFormationProduct(
@@ -236,6 +259,12 @@ class ServiceCatalogStack(Stack):
                 return template
         raise ValueError(f"template {name} not found")
 
+    def get_boundary_manifest(self, name: str):
+        '''
+        roles of the generated template that got the permission boundary, None for a deployed template
+        '''
+        return read_manifest(self.get_generated_template(name))
+
     def get_products_launch_role(self):
         '''
         cross account sharing of service catalog requires create launch contraint by role name (rather than by arn)
@@ -249,6 +278,19 @@ class ServiceCatalogStack(Stack):
     def export_ssm(self, key: str, param_name: str, value: str):
         param = ssm.StringParameter(self, key, parameter_name=param_name, string_value=value)
 
+    def get_boundary_arn(self):
+        return f"arn:aws:iam::{self.act_id}:policy/{get_act_name_from_id(self.act_id)}-pol_PlatformUserBoundary"
+
+    def get_template_cache_key(self, template_file, stack_name, version):
+        '''
+        cache key of the template generated from the stack defined in template_file
+        '''
+        # the template depends on its own folder, and on the shared constructs / post processing in this package
+        source_dirs = [path.dirname(path.abspath(template_file)), path.dirname(path.abspath(__file__))]
+        return self.synth_cache.key(source_dirs, stack_name, version, self.act_id, self.get_boundary_arn(), self.region,
+                                    context=self.synth_context)
+
+    @profiled('generate_template', 'stack_name')
     def generate_template(self, stack: Stack, stack_name: str, version, **kwargs):
         """Create a CFN template from a stack
 
@@ -260,23 +302,95 @@ class ServiceCatalogStack(Stack):
             [str]: path of the CFN template
         """
 
+        cache_key = self.get_template_cache_key(inspect.getfile(stack), stack_name, version)
+        cached_path = self.synth_cache.get(stack_name, cache_key)
+        if cached_path is not None:
+            print (f'Reusing cached CFN template for stack: {stack_name}: {cached_path}')
+            return cached_path
+
         print (f'Generating CFN template for stack: {stack_name}, with kwargs: {kwargs}')
-        stage = aws_cdk.App()
-        stack = stack(stage, stack_name, version, **kwargs)
-        # stack = stack(stage, stack_name, synthesizer=aws_cdk.BootstraplessSynthesizer(), **kwargs)        
-        aws_cdk.Aspects.of(stack).add(
-            PermissionBoundaryAspect(
-                f"arn:aws:iam::{self.act_id}:policy/{get_act_name_from_id(self.act_id)}-pol_PlatformUserBoundary"
-            )
-        )
+        if worker_address() is not None and set(kwargs) <= {'env'}:
+            # the job is pickled to the warm worker (see synth_worker), only the env can be passed along
+            env = kwargs.get('env')
+            templates_root, stack_class = stack_class_ref(stack)
+            processed_path = synthesize_warm({
+                'templates_root': templates_root,
+                'stack_class': stack_class,
+                'stack_name': stack_name,
+                'version': version,
+                'act_id': self.act_id,
+                'account': env.account if env is not None else None,
+                'region': env.region if env is not None else None,
+                'boundary_arn': self.get_boundary_arn(),
+                'context': self.synth_context,
+            })
+        else:
+            processed_path = synthesize_stack(stack, stack_name, version, self.act_id, self.get_boundary_arn(),
+                                              context=self.synth_context, **kwargs)
+
+        return self.synth_cache.put(stack_name, cache_key, processed_path)
+
+    @profiled('synthesize_templates')
+    def synthesize_templates(self, templates_root, stage_name, products, max_workers, **kwargs):
+        """Synthesize the templates of the released products in a pool of processes
 
-        assembly = stage.synth()
-        template_full_path = assembly.stacks[0].template_full_path
+        Each product is synthesized in its own process (see synth_worker.synthesize_isolated), with its own
+        aws_cdk.App and output directory, and the CDK context of this app. Only the 'env' kwarg can be
+        forwarded to the template stacks, as the jsii objects can't be serialized: other kwargs raise a
+        ValueError.
 
-        processed_path = self.post_processing(template_full_path)
+        Args:
+            templates_root (str): folder containing one sub folder per product
+            stage_name (str): name of the stage, used in the stack names
+            products (list): ProductPlan of the products in the portfolio, see release_planner
+            max_workers (int): maximum number of concurrent synth processes
 
-        return processed_path
+        Returns:
+            [dict]: template_dir -> path of the processed CFN template
+        """
+        if not set(kwargs) <= {'env'}:
+            raise ValueError(f"only the env can be passed to the templates synthesized in a process pool, got: {sorted(kwargs)}, "
+                             f"set MLOPS_SYNTH_WORKERS=1 to synthesize them in process")
+        env = kwargs['env']
+        templates = {}
+        jobs = []
+        for plan in products:
+            if plan.template_action != SYNTH:
+                continue
+            template_dir, new_version = plan.name, plan.local_version
+            stack_name = f"{template_dir}-{stage_name}"
+            template_file = path.join(templates_root, template_dir, f'{template_dir}Stack.py')
+            cache_key = self.get_template_cache_key(template_file, stack_name, new_version)
+            cached_path = self.synth_cache.get(stack_name, cache_key)
+            if cached_path is not None:
+                print (f'Reusing cached CFN template for stack: {stack_name}: {cached_path}')
+                templates[template_dir] = cached_path
+                continue
+            jobs.append({
+                'templates_root': templates_root,
+                'template_dir': template_dir,
+                'stack_name': stack_name,
+                'version': new_version,
+                'act_id': self.act_id,
+                'account': env.account,
+                'region': env.region,
+                'boundary_arn': self.get_boundary_arn(),
+                'context': self.synth_context,
+                'cache_key': cache_key,
+            })
+
+        if len(jobs) == 0:
+            return templates
+
+        print (f'Generating {len(jobs)} CFN templates with {min(max_workers, len(jobs))} processes')
+        # a thread per job, each waiting for the python process synthesizing it
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+            for job, processed_path in zip(jobs, executor.map(propagate(synthesize_isolated), jobs)):
+                templates[job['template_dir']] = self.synth_cache.put(job['stack_name'], job['cache_key'], processed_path)
+
+        return templates
     
+    @profiled('get_existing_template', 'sc_prod_name')
     def get_existing_template(self, sc_prod_name):
         """when the product version is not changed, we can use the existing template
 
@@ -289,29 +403,32 @@ class ServiceCatalogStack(Stack):
 
         print (f'Retrieve CFN template from sc_prod: {sc_prod_name}')
 
-        # get the existing template from service catalog
-        _sc = boto3.client("servicecatalog")
+        # get the existing template from service catalog, the product and artifact ids are already known
+        # from the version lookup
+        _sc = get_client("servicecatalog")
+
+        prod = get_version_resolver().get(sc_prod_name)
+        if prod is not None:
+            product_id, provisioning_artifact_id = prod.product_id, prod.artifact_id
+        else:
+            prod_desc=_sc.describe_product(Name=sc_prod_name)
+            product_id = prod_desc['ProductViewSummary']['ProductId']
+            provisioning_artifact_id = prod_desc['ProvisioningArtifacts'][0]['Id']
 
-        prod_desc=_sc.describe_product(Name=sc_prod_name)
-        provisioning_artifact_id = prod_desc['ProvisioningArtifacts'][0]['Id']
+        template_full_path = self.artifact_cache.get(provisioning_artifact_id, sc_prod_name)
+        if template_full_path is not None:
+            print (f'Reusing cached CFN template of {sc_prod_name}, artifact {provisioning_artifact_id}: {template_full_path}')
+            return template_full_path
 
         pa_desc = _sc.describe_provisioning_artifact(
-            ProductId=prod_desc['ProductViewSummary']['ProductId'],
+            ProductId=product_id,
             ProvisioningArtifactId=provisioning_artifact_id
         )
 
         template_url = pa_desc['Info']['TemplateUrl']
 
-        _s3 = boto3.resource('s3')
-
-        s3_bucket = template_url.split('/')[-2]
-        s3_file = template_url.split('/')[-1]
-        content_object = _s3.Object(s3_bucket, s3_file)
-        file_content = content_object.get()['Body'].read().decode('utf-8')
-        json_content = json.loads(file_content)
-        template_full_path = f'/tmp/{sc_prod_name}.json'
-        with open(template_full_path, 'w') as f:
-            f.write(file_content)
+        # the artifact is immutable, so its template is only downloaded once (see artifact_cache)
+        template_full_path = self.artifact_cache.fetch(get_client('s3'), template_url, provisioning_artifact_id, sc_prod_name)
 
         return template_full_path
     
@@ -326,28 +443,111 @@ class ServiceCatalogStack(Stack):
         Returns:
             [str]: path of the CFN template
         """
-        processed_path = template_full_path.replace('.json', '_processed.json')
-        with open(template_full_path, "r") as f:
-            template = f.read()
-
-        template = template.replace(f":{self.act_id}:", ":{{resolve:ssm:/mlops/dev/account_id}}:")
-        template = template.replace(f":policy/{get_act_name_from_id(self.act_id)}-pol_PlatformUserBoundary", ":policy/{{resolve:ssm:/mlops/dev/account_name}}-pol_PlatformUserBoundary")
-
-        cdk_bootstrap_bucket_name = f'cdk-hnb659fds-assets-{self.act_id}-{DEFAULT_DEPLOYMENT_REGION}'
-        template = template.replace(cdk_bootstrap_bucket_name, get_code_bucket_name(self.act_id))
-
-        json_template = json.loads(template)
-        for item in json_template['Resources'].values():
-            if item['Type'] == 'AWS::Lambda::Function':
-                if 'Description' in item['Properties'] and 'AWS CDK resource provider framework - onEvent' in item['Properties']['Description']:
-                    # cdk generate a dynamic guid for the custom resource provider, which breaks the service catalog stack,
-                    # we replace it with a fixed name
-                    item['Properties']['Code']['S3Key'] = 'custom-resource-provider-onevent.zip'
-                continue
-
-        template = json.dumps(json_template, indent=4)
-
-        with open(processed_path, "w") as f:
-            f.write(template)
-
-        return processed_path
\ No newline at end of file
+        return post_process_template(template_full_path, self.act_id)
+
+
+def get_synth_workers(scope):
+    '''
+    number of processes used to synthesize the product templates, from the MLOPS_SYNTH_WORKERS env var
+    or the 'mlops:synth_workers' context, 0 means one per cpu. Defaults to 1, i.e. synthesize in process.
+    '''
+    workers = environ.get('MLOPS_SYNTH_WORKERS', scope.node.try_get_context('mlops:synth_workers'))
+    workers = int(workers) if workers is not None else 1
+    return workers if workers > 0 else (cpu_count() or 1)
+
+
+def synthesize_stack(stack_class, stack_name, version, act_id, boundary_arn, outdir=None, context=None, **kwargs):
+    '''
+    synthesize stack_class in its own CDK app, and return the path of the post processed template
+
+    the app writes to outdir, or to a new folder of the scratch space (see scratch), with the CDK context
+    of the app synthesizing the product (e.g. its VPC lookups), which a synth process doesn't inherit
+    '''
+    stage = aws_cdk.App(outdir=outdir or scratch_mkdtemp(f'cdk-{stack_name}-', 'cdk.out'), context=context)
+    stack = stack_class(stage, stack_name, version, **kwargs)
+    # stack = stack(stage, stack_name, synthesizer=aws_cdk.BootstraplessSynthesizer(), **kwargs)        
+    # the stack is complete, only its roles are visited (see role_boundary)
+    manifest = apply_permission_boundary(stack, boundary_arn)
+
+    assembly = stage.synth()
+    template_full_path = assembly.stacks[0].template_full_path
+
+    processed_path = post_process_template(template_full_path, act_id)
+    write_manifest(processed_path, manifest)
+    missing = missing_context(assembly)
+    if len(missing) > 0:
+        # the template holds dummy values for the missing lookups, it is not cached (see synth_cache)
+        write_missing_context(processed_path, missing)
+    return processed_path
+
+
+def import_template_class(templates_root, template_dir):
+    '''
+    import the {template_dir}Stack class of the product
+
+    the product packages import their own modules by package name, so templates_root is put on sys.path
+    '''
+    if templates_root not in sys.path:
+        sys.path.insert(0, templates_root)
+    module = importlib.import_module(f'{template_dir}.{template_dir}Stack')
+    return getattr(module, f'{template_dir}Stack')
+
+
+def stack_class_ref(stack_class):
+    '''
+    return the sys.path root and the 'module:qualname' reference the stack class is imported back from
+    '''
+    root = path.abspath(inspect.getfile(stack_class))
+    for _ in stack_class.__module__.split('.'):
+        root = path.dirname(root)
+    return root, f'{stack_class.__module__}:{stack_class.__qualname__}'
+
+
+def import_stack_class(root, ref):
+    '''
+    import the stack class referenced by stack_class_ref
+    '''
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    module_name, qualname = ref.split(':')
+    stack_class = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        stack_class = getattr(stack_class, attr)
+    return stack_class
+
+
+def synthesize_product(job):
+    '''
+    synth process / warm worker entry point: synthesize one product template described by job (see synthesize_templates)
+
+    the job names the product folder (template_dir), or any stack class (stack_class, see stack_class_ref),
+    and optionally the output folder (outdir) and the context (context) of the CDK app
+    '''
+    if 'stack_class' in job:
+        template_class = import_stack_class(job['templates_root'], job['stack_class'])
+    else:
+        template_class = import_template_class(job['templates_root'], job['template_dir'])
+
+    print (f"Generating CFN template for stack: {job['stack_name']} in process {getpid()}")
+    env = aws_cdk.Environment(account=job['account'], region=job['region'])
+    with phase('synthesize_product', job['stack_name']):
+        return synthesize_stack(template_class, job['stack_name'], job['version'], job['act_id'], job['boundary_arn'],
+                               outdir=job.get('outdir'), context=job.get('context'), env=env)
+
+
+def post_process_template(template_full_path: str, act_id: str):
+    """
+        Post processing of the CFN template, see ServiceCatalogStack.post_processing
+
+    Args:
+        template_full_path (str): path of the CFN template
+        act_id (str): account the template was generated in
+
+    Returns:
+        [str]: path of the CFN template
+    """
+    processed_path = template_full_path.replace('.json', '_processed.json')
+
+    with phase('post_processing', path.basename(template_full_path)):
+        transformer = cross_account_transformer(act_id, get_act_name_from_id(act_id), get_code_bucket_name(act_id), DEFAULT_DEPLOYMENT_REGION)
+        return transformer.transform_file(template_full_path, processed_path)
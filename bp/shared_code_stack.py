@@ -11,26 +11,40 @@ from aws_cdk import (
 )
 import aws_cdk
 import shutil
-from os import path, listdir
+from os import path, listdir, environ, cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
 from constructs import Construct
 from pathlib import Path
 
 from mlops_sm_project_template_rt.permission_boundary import PermissionBoundaryAspect
+from mlops_sm_project_template_rt.config.aws_clients import get_client
+from mlops_sm_project_template_rt.zip_builder import archive_dir, build_nested_zip
+from mlops_sm_project_template_rt.s3_transfer import download_into_zip
+from mlops_sm_project_template_rt.synth_profiler import profiled, propagate
+from mlops_sm_project_template_rt.release_planner import DEPLOYED, REUSE, SEED_DIR, SKIP, get_release_planner
 from mlops_sm_project_template_rt.config.constants import (
     PIPELINE_ACCOUNT,
     FEATURE_DEV_ACCOUNT,
-    get_code_bucket_name, 
-    get_sc_prod_version, 
-    get_local_prod_version
+    get_code_bucket_name
 )
 
+def get_archive_workers():
+    '''
+    number of archives built / downloaded concurrently, from MLOPS_ARCHIVE_WORKERS
+    '''
+    workers = environ.get('MLOPS_ARCHIVE_WORKERS')
+    if workers is not None and int(workers) > 0:
+        return int(workers)
+    return min(8, (cpu_count() or 1) + 4)
+
 class SharedCodeStack(Stack):
     """
     Pipeline Stack
     Pipeline stack which provisions code pipeline for CICD deployments for the project resources.
     """
 
+    @profiled('SharedCodeStack')
     def __init__(
         self,
         scope: Construct,
@@ -51,37 +65,46 @@ class SharedCodeStack(Stack):
         root_dir = str(Path(__file__).parents[1])
         lambda_code_dir = f'{root_dir}/lambda_code'
 
-        zips = []
+        # the archives are built / downloaded on a thread pool (see build_archives), jobs are
+        # (function, args, kwargs) and their results come back in the order of the jobs
+        jobs = []
         for subdir in listdir(lambda_code_dir):
             if path.isdir(path.join(lambda_code_dir, subdir)):
-                ret = self.create_zip_in_s3(lambda_code_dir, subdir)
-                zips.append(ret)
+                jobs.append((self.create_zip_in_s3, (lambda_code_dir, subdir), {}))
+        lambda_job_count = len(jobs)
 
-        root_dir_templates = f'{root_dir}/templates' # search for */template_name/seed_code sub folders
-        self.zips_app = []
-        for template_dir in listdir(root_dir_templates):
+        # search for */template_name/seed_code sub folders
+        root_dir_templates = environ.get('MLOPS_TEMPLATES_ROOT', f'{root_dir}/templates')
+        planner = get_release_planner(self, root_dir_templates, self.act_id, self.region)
+        # the version file goes with the seed code, copy it before the seed code is planned (hashed)
+        for template_dir in planner.product_dirs():
             template_root = path.join(root_dir_templates, template_dir)
-            if not path.isdir(template_root):
-                continue
-            if not path.isfile(path.join(template_root, f'{template_dir}Stack.py')):
-                continue
-            for seeddir in listdir(template_root):
-                if seeddir != 'seed_code':
-                    continue
-                seed_code_dir = path.join(root_dir_templates, template_dir, seeddir)
-                cur_version = get_sc_prod_version(template_dir)
-                new_version = get_local_prod_version(root_dir_templates, template_dir)
+            seed_code_dir = path.join(template_root, SEED_DIR)
+            if path.isdir(seed_code_dir) and path.isfile(path.join(template_root, '__version__.py')):
                 for subdir in listdir(seed_code_dir):
-                    if path.isfile(path.join(template_root, '__version__.py')):
-                        shutil.copy(path.join(template_root, '__version__.py'), path.join(seed_code_dir, subdir))
+                    shutil.copy(path.join(template_root, '__version__.py'), path.join(seed_code_dir, subdir))
+
+        seeds = []
+        for plan in planner.plan_seeds(release_all=self.act_id in [PIPELINE_ACCOUNT, FEATURE_DEV_ACCOUNT]):
+            if plan.seed_action == SKIP:
+                continue
+            seed_code_dir = path.join(root_dir_templates, plan.name, SEED_DIR)
+            for subdir in listdir(seed_code_dir):
+                seeds.append((plan, subdir))
+                if plan.seed_action == DEPLOYED:
+                    jobs.append((self.load_zip_from_s3, (seed_code_dir, subdir), {'prefix': plan.name}))
+                elif plan.seed_action == REUSE:
+                    jobs.append((self.reuse_zip, (plan.seed_archives[subdir],), {}))
+                else:
+                    jobs.append((self.create_zip_in_s3, (seed_code_dir, subdir), {'prefix': plan.name}))
 
-                    if self.act_id in [PIPELINE_ACCOUNT, FEATURE_DEV_ACCOUNT]:
-                        ret = self.create_zip_in_s3(seed_code_dir, subdir, prefix=template_dir)
-                    elif new_version <= cur_version:
-                        ret = self.load_zip_from_s3(seed_code_dir, subdir, prefix=template_dir)
-                    else:
-                        ret = self.create_zip_in_s3(seed_code_dir, subdir, prefix=template_dir)
-                    self.zips_app.append(ret)
+        archives = self.build_archives(jobs)
+        zips = archives[:lambda_job_count]
+        self.zips_app = archives[lambda_job_count:]
+        for (plan, subdir), archive in zip(seeds, self.zips_app):
+            if plan.seed_action != DEPLOYED:
+                planner.record_seed_archive(plan, subdir, archive)
+        planner.save()
 
         code_zip = s3_deployment.BucketDeployment(self, id=f"{subdir}",
                                                   destination_bucket=code_bucket,
@@ -89,39 +112,55 @@ class SharedCodeStack(Stack):
 
         pass
 
+    def build_archives(self, jobs):
+        '''
+        run the archive jobs on a bounded thread pool, zlib and S3 downloads release the GIL
+
+        Args:
+            jobs (list): (function, args, kwargs) building or downloading one archive each
+
+        Returns:
+            [list]: paths of the archives, in the order of the jobs
+        '''
+        if len(jobs) == 0:
+            return []
+        max_workers = min(get_archive_workers(), len(jobs))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='archive') as executor:
+            # the api calls of the jobs count for the enclosing phase
+            futures = [executor.submit(propagate(fn), *args, **kwargs) for fn, args, kwargs in jobs]
+            return [f.result() for f in futures]
+
+    @profiled('create_zip_in_s3', 'subdir')
     def create_zip_in_s3(self, root_dir, subdir, prefix=''):
         '''
         zip the file twice as Cdk always unzip it when upload, while lambda requires a zip file
         so after one unzip, the zip remains. 
+
+        the archives are deterministic, and reused when the code has not changed (see zip_builder)
         '''
         root_dir = path.join(root_dir, subdir)
 
         fn = f'{prefix}-{subdir}' if len(prefix)> 0 else subdir
-        zip_file_path = shutil.make_archive(base_name=f'tmp/{fn}',
-                            format='zip',
-                            root_dir=root_dir,
-                            base_dir=None)
-        zip_file_path1 = shutil.make_archive(base_name=f'tmp/{prefix}{subdir}-tmp',
-                            format='zip',
-                            root_dir=path.dirname(zip_file_path),
-                            base_dir=f'{fn}.zip')   
-        return zip_file_path1
+        return build_nested_zip(root_dir, f'{fn}.zip', path.join(archive_dir(), f'{prefix}{subdir}-tmp.zip'))
     
+    def reuse_zip(self, archive_path):
+        '''
+        the seed code has not changed since archive_path was built (see release_planner)
+        '''
+        print(f'Reusing unchanged archive: {archive_path}')
+        return archive_path
+
+    @profiled('load_zip_from_s3', 'subdir')
     def load_zip_from_s3(self, root_dir, subdir, prefix=''):
         '''
         if no newer version available, use the already deployed version
+
+        the deployed zip is kept locally, and only downloaded again when it changed (see s3_transfer)
         '''
         assert len(prefix) > 0
         key = f'{prefix}-{subdir}.zip'
 
-        #download the zip file from s3
-        import boto3
-        s3 = boto3.resource('s3')
-        zip_file_path = f'tmp/{key}'
-        s3.Bucket(get_code_bucket_name(self.act_id)).download_file(key, zip_file_path)
-      
-        zip_file_path1 = shutil.make_archive(base_name=f'tmp/{prefix}{subdir}-tmp',
-                            format='zip',
-                            root_dir=path.dirname(zip_file_path),
-                            base_dir=key)   
-        return zip_file_path1
\ No newline at end of file
+        #download the zip file from s3, straight into the outer zip
+        return download_into_zip(get_client('s3'), get_code_bucket_name(self.act_id), key,
+                                 cache_path=path.join(archive_dir(), 'deployed', key),
+                                 outer_path=path.join(archive_dir(), f'{prefix}{subdir}-deployed.zip'))
\ No newline at end of file
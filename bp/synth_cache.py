@@ -0,0 +1,200 @@
+'''
+Persistent on-disk cache for generated Service Catalog product templates.
+
+A product template only depends on the source of its template directory, the shared
+constructs it imports, the version it is released as, the target account and the
+permission boundary applied to it, the CDK libraries generating it and the CDK context of
+the synth (cdk.json, cdk.context.json and -c values). The cache key is a hash of all of
+these, so an unchanged product can reuse the `_processed.json` of a previous synth instead
+of spinning up a new CDK app for it.
+
+A template whose synth reported missing context (e.g. a VPC lookup not in cdk.context.json,
+which yields a dummy VPC) is not cached: the next synth, once the context is there, has to
+generate it again.
+
+The cache lives in `.synth_cache` under the project root (kept between CodeBuild runs
+via the local cache), or in the folder given by MLOPS_SYNTH_CACHE_DIR. Set
+MLOPS_SYNTH_CACHE=0 to always re-synthesize.
+'''
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import stat
+from importlib import metadata
+from os import path
+from pathlib import Path
+
+from mlops_sm_project_template_rt.role_boundary import manifest_path
+
+CACHE_ENV_DIR = 'MLOPS_SYNTH_CACHE_DIR'
+CACHE_ENV_SWITCH = 'MLOPS_SYNTH_CACHE'
+
+# bump when the layout of the cached files, or the way they are generated, changes
+CACHE_FORMAT_VERSION = '2'
+
+# libraries whose version changes the generated templates
+CDK_DISTRIBUTIONS = ('aws-cdk-lib', 'constructs', 'jsii')
+
+_IGNORED_DIRS = {'__pycache__', '.pytest_cache', 'cdk.out'}
+
+
+def cache_root():
+    '''
+    root folder of all persistent synth caches, created on first use
+    '''
+    root = os.environ.get(CACHE_ENV_DIR) or path.join(str(Path(__file__).parents[1]), '.synth_cache')
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def cache_enabled():
+    return os.environ.get(CACHE_ENV_SWITCH, '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+@functools.lru_cache(maxsize=None)
+def cdk_version():
+    '''
+    installed versions of the CDK libraries, e.g. 'aws-cdk-lib==2.100.0 constructs==10.3.0 jsii==1.90.0',
+    as loaded by this process
+    '''
+    return read_cdk_version()
+
+
+def read_cdk_version():
+    '''
+    installed versions of the CDK libraries, read again from their package metadata
+    '''
+    versions = []
+    for name in CDK_DISTRIBUTIONS:
+        try:
+            versions.append(f'{name}=={metadata.version(name)}')
+        except metadata.PackageNotFoundError:
+            versions.append(f'{name}==')
+    return ' '.join(versions)
+
+
+def missing_context_path(template_path):
+    '''
+    path of the lookups missing from the context of the synth, kept next to the template when there are any
+    '''
+    return f'{path.splitext(template_path)[0]}.missing.json'
+
+
+def write_missing_context(template_path, missing):
+    target = missing_context_path(template_path)
+    with open(target, 'w') as f:
+        json.dump(missing, f, indent=2)
+    return target
+
+
+def list_tree_files(root_dir):
+    '''
+    return the (relative posix path, full path) of the files under root_dir, in a stable order
+    '''
+    ret = []
+    for cur_dir, dirs, files in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in _IGNORED_DIRS)
+        for file_name in sorted(files):
+            if file_name.endswith('.pyc'):
+                continue
+            file_path = path.join(cur_dir, file_name)
+            ret.append((path.relpath(file_path, root_dir).replace(os.sep, '/'), file_path))
+    return ret
+
+
+def hash_tree(digest, root_dir):
+    '''
+    feed the relative path, permissions and content of every file under root_dir into digest, in a stable order
+    '''
+    hash_files(digest, list_tree_files(root_dir))
+
+
+def hash_files(digest, files):
+    '''
+    feed the (relative path, full path) files into digest, as hash_tree does
+    '''
+    for rel_path, file_path in files:
+        digest.update(rel_path.encode('utf-8'))
+        digest.update(b'\0')
+        # the archives keep the executable bit of the files (see zip_builder)
+        digest.update(f'{stat.S_IMODE(os.stat(file_path).st_mode):o}'.encode('ascii'))
+        digest.update(b'\0')
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+
+
+class SynthCache:
+    '''
+    content-addressed store of processed CFN templates, one file per cache key
+    '''
+
+    def __init__(self, cache_dir=None, enabled=None):
+        self.enabled = cache_enabled() if enabled is None else enabled
+        self.cache_dir = cache_dir or path.join(cache_root(), 'templates')
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, source_dirs, stack_name, version, act_id, boundary_arn, region=None, context=None):
+        '''
+        compute the cache key of a product template
+
+        Args:
+            source_dirs (list): folders whose content the generated template depends on
+            stack_name (str): name of the synthesized stack
+            version (str): product version the template is generated for
+            act_id (str): account the template is generated in
+            boundary_arn (str): arn of the permission boundary applied to the roles
+            region (str): region the template is generated for
+            context (dict): CDK context of the synth, see Node.get_all_context
+
+        Returns:
+            [str]: hex digest identifying the template
+        '''
+        digest = hashlib.sha256()
+        context = json.dumps(context or {}, sort_keys=True, default=str)
+        for item in (CACHE_FORMAT_VERSION, cdk_version(), stack_name, version, act_id, boundary_arn, region or '', context):
+            digest.update(str(item).encode('utf-8'))
+            digest.update(b'\0')
+        for source_dir in source_dirs:
+            hash_tree(digest, source_dir)
+        return digest.hexdigest()
+
+    def _entry_path(self, stack_name, key):
+        # keep the stack name in the file name, get_generated_template looks templates up by name
+        return path.join(self.cache_dir, f'{stack_name}-{key[:24]}_processed.json')
+
+    def get(self, stack_name, key):
+        '''
+        return the path of the cached template, or None on a cache miss
+        '''
+        if not self.enabled:
+            return None
+        entry = self._entry_path(stack_name, key)
+        return entry if path.isfile(entry) else None
+
+    def put(self, stack_name, key, template_path):
+        '''
+        store a processed template under key, and return the path of the cached copy
+
+        a template synthesized with missing context is not stored, its own path is returned
+        '''
+        if not self.enabled:
+            return template_path
+        if path.isfile(missing_context_path(template_path)):
+            print(f'Not caching the CFN template of stack: {stack_name}, its synth reported missing context')
+            return template_path
+        entry = self._entry_path(stack_name, key)
+        # copy then rename, so concurrent synths never see a half written template
+        for source, target in [(manifest_path(template_path), manifest_path(entry)), (template_path, entry)]:
+            # the role manifest of the template, if any, is kept with it
+            if source != template_path and not path.isfile(source):
+                continue
+            tmp_entry = f'{target}.{os.getpid()}.tmp'
+            shutil.copyfile(source, tmp_entry)
+            os.replace(tmp_entry, target)
+        return entry
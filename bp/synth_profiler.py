@@ -0,0 +1,295 @@
+'''
+Opt-in profiling of the synth phases of the MLOps CDK app.
+
+Enable it with the MLOPS_SYNTH_PROFILE=1 env var, or the 'mlops:profile' context
+(cdk synth -c mlops:profile=true). Each instrumented phase (stack construction, template generation,
+post processing, AWS lookups, ...) records its wall time, the cpu time of the thread running it, the
+peak RSS of the process and of its children (the jsii node runtime), and the AWS API calls made
+while it runs, per product.
+
+At the end of the synth a JSON report is written to MLOPS_SYNTH_PROFILE_REPORT (default
+synth-profile.json) and a summary is printed, by the process that enabled the profiler only: the
+child processes (e.g. the synth process pool) inherit the env var, but don't overwrite the report.
+They send their profile back to the parent instead, which merges it into its own (see merge).
+
+The phases are per thread. Work handed to a thread pool is measured within the phases of the
+submitting thread when it is wrapped with propagate: its wall time and API calls count for them, its
+cpu time only for the phases of the pool thread.
+'''
+
+import atexit
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PROFILE_ENV = 'MLOPS_SYNTH_PROFILE'
+REPORT_ENV = 'MLOPS_SYNTH_PROFILE_REPORT'
+PROFILE_CONTEXT = 'mlops:profile'
+# pid of the process writing the report, inherited by its child processes
+OWNER_ENV = 'MLOPS_SYNTH_PROFILE_OWNER'
+
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class PhaseStats:
+    '''
+    accumulated measurements of one (phase, product)
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.peak_rss_mb = 0.0
+        self.peak_children_rss_mb = 0.0
+        self.api_calls = defaultdict(int)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'wall_s': round(self.wall_s, 3),
+            'cpu_s': round(self.cpu_s, 3),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'peak_children_rss_mb': round(self.peak_children_rss_mb, 1),
+            'api_calls': dict(sorted(self.api_calls.items())),
+        }
+
+
+class SynthProfiler:
+
+    def __init__(self):
+        self.enabled = _is_true(os.environ.get(PROFILE_ENV, '0'))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = defaultdict(PhaseStats)
+        self._api_calls = defaultdict(int)
+        self._started = time.perf_counter()
+        self._report_registered = False
+        if self.enabled:
+            self._register_report()
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self._started = time.perf_counter()
+        self._register_report()
+
+    def disable(self):
+        self.enabled = False
+
+    def _register_report(self):
+        os.environ.setdefault(OWNER_ENV, str(os.getpid()))
+        if not self._report_registered:
+            self._report_registered = True
+            atexit.register(self._report_at_exit)
+
+    def _report_at_exit(self):
+        if os.environ.get(OWNER_ENV) == str(os.getpid()):
+            self.report()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def phase(self, name, product=None):
+        '''
+        measure the enclosed code as the phase name of product
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        key = (name, product or '')
+        calls = defaultdict(int)
+        stack = self._stack()
+        stack.append(calls)
+        # the cpu time of this thread, the other threads of the process run their own phases
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            stack.pop()
+            with self._lock:
+                stats = self._stats[key]
+                stats.count += 1
+                stats.wall_s += wall
+                stats.cpu_s += cpu
+                stats.peak_rss_mb = max(stats.peak_rss_mb, _peak_rss_mb(resource.RUSAGE_SELF))
+                stats.peak_children_rss_mb = max(stats.peak_children_rss_mb, _peak_rss_mb(resource.RUSAGE_CHILDREN))
+                for call, n in calls.items():
+                    stats.api_calls[call] += n
+                # nested phases are inclusive: the calls also count for the enclosing phase
+                if len(stack) > 0:
+                    for call, n in calls.items():
+                        stack[-1][call] += n
+
+    def propagate(self, func):
+        '''
+        wrap func, to be run in another thread, so it is measured within the phases enclosing this call
+        '''
+        if not self.enabled:
+            return func
+        # the enclosing phases are shared with the thread, their calls are updated under the lock
+        parent = list(self._stack())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            saved = getattr(self._local, 'stack', None)
+            self._local.stack = list(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = saved
+        return wrapper
+
+    def count_api_call(self, service_name, operation_name):
+        if not self.enabled:
+            return
+        call = f'{service_name}.{operation_name}'
+        stack = self._stack()
+        with self._lock:
+            if len(stack) > 0:
+                stack[-1][call] += 1
+            self._api_calls[call] += 1
+
+    def merge(self, report):
+        '''
+        add the phases and API calls of the report of a child process (see to_dict), e.g. a synth process,
+        the calls also count for the phases enclosing this call
+        '''
+        if not self.enabled or report is None:
+            return
+        stack = self._stack()
+        with self._lock:
+            for p in report['phases']:
+                stats = self._stats[(p['phase'], p['product'])]
+                stats.count += p['count']
+                stats.wall_s += p['wall_s']
+                stats.cpu_s += p['cpu_s']
+                # the child process is a child of this one
+                stats.peak_children_rss_mb = max(stats.peak_children_rss_mb, p['peak_rss_mb'], p['peak_children_rss_mb'])
+                for call, n in p['api_calls'].items():
+                    stats.api_calls[call] += n
+            for call, n in report['api_calls'].items():
+                self._api_calls[call] += n
+                if len(stack) > 0:
+                    stack[-1][call] += n
+
+    def to_dict(self):
+        with self._lock:
+            phases = [dict(phase=name, product=product, **stats.to_dict()) for (name, product), stats in self._stats.items()]
+            return {
+                'wall_s': round(time.perf_counter() - self._started, 3),
+                'peak_rss_mb': round(_peak_rss_mb(resource.RUSAGE_SELF), 1),
+                'peak_children_rss_mb': round(_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+                'api_calls': dict(sorted(self._api_calls.items())),
+                'phases': sorted(phases, key=lambda p: p['wall_s'], reverse=True),
+            }
+
+    def report(self, report_path=None):
+        '''
+        write the JSON report and print a summary, returns the report
+        '''
+        if not self.enabled:
+            return None
+        report = self.to_dict()
+        report_path = report_path or os.environ.get(REPORT_ENV, 'synth-profile.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        print(f"\nsynth profile ({report['wall_s']}s, peak rss {report['peak_rss_mb']} MB, "
+              f"children {report['peak_children_rss_mb']} MB), report: {report_path}")
+        print(f"{'phase':<32} {'product':<24} {'n':>3} {'wall s':>8} {'cpu s':>8} {'api':>5}")
+        for p in report['phases']:
+            print(f"{p['phase'][:32]:<32} {p['product'][:24]:<24} {p['count']:>3} {p['wall_s']:>8.2f} "
+                  f"{p['cpu_s']:>8.2f} {sum(p['api_calls'].values()):>5}")
+        for call, n in report['api_calls'].items():
+            print(f"  {call}: {n}")
+        return report
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._api_calls.clear()
+            self._started = time.perf_counter()
+
+
+profiler = SynthProfiler()
+
+
+def phase(name, product=None):
+    return profiler.phase(name, product)
+
+
+def propagate(func):
+    return profiler.propagate(func)
+
+
+def merge(report):
+    profiler.merge(report)
+
+
+def enable_from_scope(scope):
+    '''
+    enable the profiler when the 'mlops:profile' context is set on the app
+    '''
+    if not profiler.enabled and _is_true(scope.node.try_get_context(PROFILE_CONTEXT)):
+        profiler.enable()
+
+
+def profiled(name, product_arg=None):
+    '''
+    decorator measuring the function as phase name, product_arg names the argument holding the product
+
+    when the function is a construct's __init__, the 'mlops:profile' context of its scope is honoured
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        has_scope = 'scope' in signature.parameters
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if has_scope and not profiler.enabled:
+                scope = signature.bind_partial(*args, **kwargs).arguments.get('scope')
+                if scope is not None:
+                    enable_from_scope(scope)
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+
+            product = signature.bind_partial(*args, **kwargs).arguments.get(product_arg) if product_arg else None
+            with profiler.phase(name, str(product) if product is not None else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_client(client):
+    '''
+    count the API calls made with the boto3 client
+    '''
+    service_name = client.meta.service_model.service_name
+
+    def before_call(model, **kwargs):
+        profiler.count_api_call(service_name, model.name)
+
+    # first, on the event the Stubber uses: a before-call handler returning a response ends the event,
+    # the calls it answers would not be counted otherwise
+    client.meta.events.register_first('before-call.*.*', before_call, unique_id='mlops-synth-profiler')
+    return client
@@ -0,0 +1,322 @@
+'''
+Warm synth worker: a long lived process that synthesizes product templates on request.
+
+Every synth otherwise starts a cold Python interpreter, imports the CDK libraries and boots the
+jsii Node runtime before the first template, which takes seconds. The worker pays that once, then
+serves synth jobs (see synthesize_product) over a unix socket, one at a time in the same jsii kernel.
+
+Start it from the project root, and point the synths to it with MLOPS_SYNTH_WORKER (1 for the
+default socket, or the socket path):
+
+    python -m mlops_sm_project_template_rt.synth_worker &
+    MLOPS_SYNTH_WORKER=1 cdk synth
+
+The modules of the product are dropped after each job, so an edited template is imported again by
+the next one. So is the CDK output folder of the job: the worker sends the processed template (and
+its role manifest) back, and the synth writes them to its own scratch space. A change to this
+package or an upgrade of the CDK libraries can't be reloaded safely: the worker then exits, and the
+synths fall back to synthesizing in their own process, as they do when no worker is running.
+
+The worker was not started by cdk synth, so it doesn't see the CDK context of the synth (e.g. the
+VPC lookups of cdk.context.json): each job carries the context of the app that sent it.
+
+The same module runs the one-off synths of the process pool (see synthesize_isolated):
+
+    python -m mlops_sm_project_template_rt.synth_worker --job job.json --reply reply.json
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from importlib import invalidate_caches
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from os import path
+
+from mlops_sm_project_template_rt.role_boundary import manifest_path
+from mlops_sm_project_template_rt.scratch import scratch_mkdtemp
+from mlops_sm_project_template_rt.synth_cache import list_tree_files, missing_context_path, read_cdk_version
+from mlops_sm_project_template_rt.synth_profiler import PROFILE_ENV, merge, profiler
+
+WORKER_ENV = 'MLOPS_SYNTH_WORKER'
+
+_PACKAGE_DIR = path.dirname(path.abspath(__file__))
+
+
+class SynthWorkerUnavailable(Exception):
+    '''
+    no worker answers on the socket
+    '''
+
+
+def default_address():
+    return path.join(tempfile.gettempdir(), f'mlops-synth-worker-{os.getuid()}.sock')
+
+
+def worker_address():
+    '''
+    socket of the worker the synths are sent to, None when they run in process
+    '''
+    address = os.environ.get(WORKER_ENV, '')
+    if address.lower() in ('', '0', 'false', 'no', 'off'):
+        return None
+    if address.lower() in ('1', 'true', 'yes', 'on'):
+        return default_address()
+    return address
+
+
+def _key_path(address):
+    return f'{address}.key'
+
+
+def package_signature():
+    '''
+    modification times of the package source and versions of the CDK libraries, the worker is stale
+    once they change
+    '''
+    # the installed distributions are looked up again
+    invalidate_caches()
+    return (read_cdk_version(), sorted((rel, os.stat(full).st_mtime_ns) for rel, full in list_tree_files(_PACKAGE_DIR)))
+
+
+def job_source_dir(job):
+    '''
+    folder of the product modules imported by the job, see synthesize_product
+    '''
+    if 'stack_class' in job:
+        return path.join(job['templates_root'], job['stack_class'].split(':')[0].split('.')[0])
+    return path.join(job['templates_root'], job['template_dir'])
+
+
+def purge_modules(source_dir):
+    '''
+    drop the modules loaded from source_dir, so they are imported again from their current source
+    '''
+    source_dir = path.join(path.abspath(source_dir), '')
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None)
+        if module_file is not None and path.abspath(module_file).startswith(source_dir):
+            del sys.modules[name]
+    invalidate_caches()
+
+
+def read_outputs(processed_path):
+    '''
+    the processed template, its role manifest (see role_boundary) and missing context (see synth_cache):
+    file name -> content
+    '''
+    outputs = {}
+    for output_path in (processed_path, manifest_path(processed_path), missing_context_path(processed_path)):
+        if path.isfile(output_path):
+            with open(output_path, 'r') as f:
+                outputs[path.basename(output_path)] = f.read()
+    return outputs
+
+
+def write_outputs(job, reply):
+    '''
+    write the outputs sent back by the worker to the scratch space of this process
+
+    Returns:
+        [str]: path of the processed template
+    '''
+    outdir = scratch_mkdtemp(f"cdk-{job['stack_name']}-", 'cdk.out')
+    for name, content in reply['outputs'].items():
+        with open(path.join(outdir, name), 'w') as f:
+            f.write(content)
+    return path.join(outdir, reply['name'])
+
+
+def synthesize_isolated(job):
+    '''
+    synthesize the job in a new Python process, one-off worker of the synth process pool
+
+    The process runs this module rather than a multiprocessing child: spawn (and forkserver) import the
+    __main__ of the parent again, i.e. the app.py of cdk synth, which builds the whole app and starts
+    the pool once more while the child is bootstrapping.
+
+    Returns:
+        [str]: path of the processed template, in the scratch space of this process
+    '''
+    job_dir = scratch_mkdtemp(f"job-{job['stack_name']}-", 'jobs')
+    job_path, reply_path = path.join(job_dir, 'job.json'), path.join(job_dir, 'reply.json')
+    try:
+        with open(job_path, 'w') as f:
+            json.dump(job, f)
+        # the child imports the modules from the same folders, and inherits the scratch root with the env
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(p for p in sys.path if p)}
+        if profiler.enabled:
+            # also when enabled by the context, the child sends its profile back with the reply
+            env[PROFILE_ENV] = '1'
+        subprocess.run([sys.executable, '-m', __spec__.name, '--job', job_path, '--reply', reply_path], env=env, check=True)
+        with open(reply_path, 'r') as f:
+            reply = json.load(f)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    merge(reply.get('profile'))
+    if 'error' in reply:
+        raise RuntimeError(f"synth process failed on {job['stack_name']}:\n{reply['error']}")
+    return write_outputs(job, reply)
+
+
+def run_isolated(job_path, reply_path, synthesize=None):
+    '''
+    entry point of the process started by synthesize_isolated
+    '''
+    if synthesize is None:
+        from mlops_sm_project_template_rt.service_catalog_stack import synthesize_product as synthesize
+
+    with open(job_path, 'r') as f:
+        job = json.load(f)
+    reply = _run_job(job, synthesize)
+    if profiler.enabled:
+        reply['profile'] = profiler.to_dict()
+    with open(reply_path, 'w') as f:
+        json.dump(reply, f)
+
+
+def _run_job(job, synthesize):
+    # the worker outlives its scratch space, the output folder goes as soon as the outputs are read
+    outdir = scratch_mkdtemp(f"cdk-{job['stack_name']}-", 'cdk.out')
+    try:
+        processed_path = synthesize({**job, 'outdir': outdir})
+        return {'name': path.basename(processed_path), 'outputs': read_outputs(processed_path)}
+    except Exception:
+        return {'error': traceback.format_exc()}
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+        purge_modules(job_source_dir(job))
+
+
+def serve(address=None, synthesize=None):
+    '''
+    serve synth jobs on the unix socket address until a shutdown request, or until the package changes
+
+    Args:
+        address (str): socket path, see default_address
+        synthesize (callable): job -> path of the processed template, written under job['outdir'],
+            defaults to synthesize_product
+    '''
+    if synthesize is None:
+        # loads the CDK and boots the jsii runtime once, before the first job
+        from mlops_sm_project_template_rt.service_catalog_stack import synthesize_product as synthesize
+
+    address = address or default_address()
+    if path.exists(address):
+        # left over by a worker that was killed
+        os.unlink(address)
+    authkey = os.urandom(32)
+    fd = os.open(_key_path(address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+
+    signature = package_signature()
+    print(f'synth worker {os.getpid()} listening on {address}', flush=True)
+    try:
+        with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    print(f'synth worker: rejected connection: {e!r}', flush=True)
+                    continue
+                with conn:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        continue
+                    op = request.get('op')
+                    if op == 'ping':
+                        conn.send({'pid': os.getpid()})
+                    elif op == 'shutdown':
+                        conn.send({'pid': os.getpid()})
+                        break
+                    elif package_signature() != signature:
+                        conn.send({'stale': True})
+                        print('synth worker: the package source changed, exiting', flush=True)
+                        break
+                    else:
+                        print(f"synth worker: synthesizing {request['job']['stack_name']}", flush=True)
+                        conn.send(_run_job(request['job'], synthesize))
+    finally:
+        for leftover in (address, _key_path(address)):
+            if path.exists(leftover):
+                os.unlink(leftover)
+
+
+def request(message, address=None):
+    '''
+    send message to the worker and return its reply, raises SynthWorkerUnavailable when no worker answers
+    '''
+    address = address or default_address()
+    try:
+        with open(_key_path(address), 'rb') as f:
+            authkey = f.read()
+        with Client(address, family='AF_UNIX', authkey=authkey) as conn:
+            conn.send(message)
+            return conn.recv()
+    except (OSError, EOFError, AuthenticationError) as e:
+        raise SynthWorkerUnavailable(f'no synth worker on {address}: {e!r}') from e
+
+
+def wait_for_worker(address=None, timeout=30):
+    '''
+    wait until the worker answers, e.g. right after starting it
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return request({'op': 'ping'}, address)
+        except SynthWorkerUnavailable:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def synthesize_warm(job, address=None, fallback=None):
+    '''
+    synthesize the job in the warm worker, or in process when no worker is available
+
+    Returns:
+        [str]: path of the processed template
+    '''
+    address = address or worker_address()
+    if address is not None:
+        try:
+            reply = request({'op': 'synth', 'job': job}, address)
+            if 'outputs' in reply:
+                return write_outputs(job, reply)
+            if not reply.get('stale'):
+                raise RuntimeError(f"synth worker failed on {job['stack_name']}:\n{reply['error']}")
+            print(f"synth worker on {address} is stale, restart it; synthesizing {job['stack_name']} in process")
+        except SynthWorkerUnavailable as e:
+            print(f"{e}; synthesizing {job['stack_name']} in process")
+
+    if fallback is None:
+        from mlops_sm_project_template_rt.service_catalog_stack import synthesize_product as fallback
+    return fallback(job)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='serve product template synths from a warm CDK process')
+    parser.add_argument('--address', default=None, help=f'unix socket path, defaults to {default_address()}')
+    parser.add_argument('--shutdown', action='store_true', help='stop the worker listening on the address')
+    parser.add_argument('--job', default=None, help='synthesize the job of this JSON file once, rather than serve')
+    parser.add_argument('--reply', default=None, help='JSON file the reply to --job is written to')
+    args = parser.parse_args(argv)
+    if args.job is not None:
+        run_isolated(args.job, args.reply)
+    elif args.shutdown:
+        print(request({'op': 'shutdown'}, args.address))
+    else:
+        serve(args.address)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+Rewrite rules applied to the generated product templates before they are added to Service Catalog.
+
+The template is parsed once, and walked once: string rules rewrite every string value (e.g. replace
+the account id with a dynamic reference for cross-account sharing), and resource rules patch whole
+resources (e.g. give the custom resource provider a fixed S3 key). The result is written as compact
+JSON, or minified JSON when it would otherwise exceed the template size limit.
+'''
+
+import json
+import os
+from abc import ABC, abstractmethod
+
+# CloudFormation limit of a template stored in S3
+TEMPLATE_SIZE_LIMIT = 1024 * 1024
+MINIFY_ENV = 'MLOPS_MINIFY_TEMPLATES'
+
+
+class StringReplaceRule:
+    '''
+    replace a substring in every string of the template
+    '''
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def apply(self, value: str) -> str:
+        return value.replace(self.old, self.new) if self.old in value else value
+
+    def __repr__(self):
+        return f'StringReplaceRule({self.old!r} -> {self.new!r})'
+
+
+class ResourceRule(ABC):
+    '''
+    base class of the rules patching a resource, applies to the resources of resource_type
+    '''
+    resource_type = None
+
+    def matches(self, logical_id: str, resource: dict) -> bool:
+        return resource.get('Type') == self.resource_type
+
+    @abstractmethod
+    def apply(self, logical_id: str, resource: dict):
+        '''
+        patch the matching resource in place
+        '''
+
+
+class CustomResourceProviderKeyRule(ResourceRule):
+    '''
+    cdk generate a dynamic guid for the custom resource provider, which breaks the service catalog stack,
+    we replace it with a fixed name
+    '''
+    resource_type = 'AWS::Lambda::Function'
+    description = 'AWS CDK resource provider framework - onEvent'
+    s3_key = 'custom-resource-provider-onevent.zip'
+
+    def matches(self, logical_id, resource):
+        return super().matches(logical_id, resource) and self.description in resource['Properties'].get('Description', '')
+
+    def apply(self, logical_id, resource):
+        resource['Properties']['Code']['S3Key'] = self.s3_key
+
+
+class TemplateTransformer:
+    '''
+    apply the string and resource rules to a template in a single walk
+    '''
+
+    def __init__(self, string_rules=None, resource_rules=None):
+        self.string_rules = list(string_rules or [])
+        self.resource_rules = list(resource_rules or [])
+
+    def transform(self, template: dict) -> dict:
+        '''
+        rewrite the template in place, and return it
+        '''
+        for key, value in template.items():
+            if key == 'Resources':
+                for logical_id, resource in value.items():
+                    value[logical_id] = self._walk(resource)
+                    for rule in self.resource_rules:
+                        if rule.matches(logical_id, resource):
+                            rule.apply(logical_id, resource)
+            else:
+                template[key] = self._walk(value)
+        return template
+
+    def _walk(self, node):
+        if isinstance(node, str):
+            for rule in self.string_rules:
+                node = rule.apply(node)
+            return node
+        if isinstance(node, dict):
+            for key, value in node.items():
+                node[key] = self._walk(value)
+        elif isinstance(node, list):
+            for i, value in enumerate(node):
+                node[i] = self._walk(value)
+        return node
+
+    def transform_file(self, template_full_path: str, processed_path: str, minify=None):
+        '''
+        transform the template file into processed_path
+
+        Args:
+            template_full_path (str): path of the generated CFN template
+            processed_path (str): path of the transformed CFN template
+            minify (bool): drop all whitespace, defaults to MLOPS_MINIFY_TEMPLATES, and to True when the
+                compact template exceeds the template size limit
+
+        Returns:
+            [str]: processed_path
+        '''
+        with open(template_full_path, 'r') as f:
+            template = self.transform(json.load(f))
+
+        if minify is None:
+            minify = os.environ.get(MINIFY_ENV, '0').lower() in ('1', 'true', 'yes', 'on')
+        content = dump_template(template, minify)
+        if not minify and len(content) > TEMPLATE_SIZE_LIMIT:
+            content = dump_template(template, True)
+
+        with open(processed_path, 'w') as f:
+            f.write(content)
+        return processed_path
+
+
+def dump_template(template: dict, minify=False) -> str:
+    if minify:
+        return json.dumps(template, separators=(',', ':'))
+    return json.dumps(template)
+
+
+def cross_account_transformer(act_id, act_name, code_bucket_name, region):
+    '''
+    rules to make a template generated in act_id deployable from any account the portfolio is shared with
+
+    Args:
+        act_id (str): account the template was generated in
+        act_name (str): name of the account, used in the permission boundary name
+        code_bucket_name (str): bucket holding the shared code, replaces the cdk bootstrap bucket
+        region (str): region of the cdk bootstrap bucket
+    '''
+    return TemplateTransformer(
+        string_rules=[
+            StringReplaceRule(f":{act_id}:", ":{{resolve:ssm:/mlops/dev/account_id}}:"),
+            StringReplaceRule(f":policy/{act_name}-pol_PlatformUserBoundary", ":policy/{{resolve:ssm:/mlops/dev/account_name}}-pol_PlatformUserBoundary"),
+            StringReplaceRule(f'cdk-hnb659fds-assets-{act_id}-{region}', code_bucket_name),
+        ],
+        resource_rules=[
+            CustomResourceProviderKeyRule(),
+        ],
+    )
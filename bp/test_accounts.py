@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize("pipeline_type", ['DEV', 'FEATURE', 'STAGING'])
+def test_client_accounts(pipeline_type):
+    '''
+    verify the client accounts, automation roles and code buckets of each pipeline type
+    '''
+    from mlops_sm_project_template_rt.config import accounts
+
+    stages = accounts.CLIENT_ACCOUNTS[pipeline_type]
+    assert list(stages) == ['dev', 'preprod', 'prod']
+    assert accounts.get_client_dev_act_id(pipeline_type) == accounts.get_client_act_id(pipeline_type, 'dev') == stages['dev']
+    assert accounts.get_client_preprod_act_id(pipeline_type) == stages['preprod']
+    assert accounts.get_client_prod_act_id(pipeline_type) == stages['prod']
+
+    # distinct, in stage order, without the accounts not configured yet
+    act_ids = accounts.get_client_act_ids(pipeline_type)
+    assert act_ids == list(dict.fromkeys(a for a in stages.values() if a != 'TBD'))
+    for act_id in act_ids:
+        assert accounts.get_automation_role_arn(act_id) == f'arn:aws:iam::{act_id}:role/bootstrap-from-mgmt'
+
+    with pytest.raises(AssertionError):
+        accounts.get_client_act_id(pipeline_type.lower(), 'dev')
+
+
+def test_code_bucket_accounts():
+    from mlops_sm_project_template_rt.config import accounts
+
+    for act_id in accounts.CODE_BUCKET_ACCOUNTS:
+        assert accounts.get_code_bucket_name(act_id) == f'ml-ops-shared-code-{act_id}'
+        assert accounts.get_act_name_from_id(act_id) == accounts.ACCOUNT_NAMES[act_id]
+    with pytest.raises(AssertionError):
+        accounts.get_code_bucket_name(accounts.CLIENT_DEV_ACCOUNT)
+
+
+def test_constants_without_cdk():
+    '''
+    verify importing the constants doesn't load the CDK or boto3
+    '''
+    script = (
+        'import sys\n'
+        'import mlops_sm_project_template_rt.config.constants\n'
+        'assert "aws_cdk" not in sys.modules, "aws_cdk loaded"\n'
+        'assert "boto3" not in sys.modules, "boto3 loaded"\n'
+    )
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(p for p in sys.path if p)}
+    result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+
+class FakeCatalog:
+    '''
+    servicecatalog client serving paginated portfolios and products, recording the calls
+    '''
+
+    def __init__(self, portfolio_names, product_names):
+        self.portfolios = [{'Id': f'port-{i}', 'DisplayName': n} for i, n in enumerate(portfolio_names)]
+        self.products = [{'ProductId': f'prod-{i}', 'Name': n} for i, n in enumerate(product_names)]
+        self.calls = []
+
+    def get_paginator(self, operation_name):
+        return SimpleNamespace(paginate=lambda **kwargs: self._pages(operation_name, **kwargs))
+
+    def _pages(self, operation_name, **kwargs):
+        self.calls.append(operation_name)
+        if operation_name == 'list_portfolios':
+            for i in range(0, len(self.portfolios), 2):
+                yield {'PortfolioDetails': self.portfolios[i:i + 2]}
+        elif operation_name == 'search_products_as_admin':
+            text = kwargs.get('Filters', {}).get('FullTextSearch', [''])[0]
+            yield {'ProductViewDetails': [{'ProductViewSummary': p} for p in self.products if text in p['Name']]}
+        else:
+            yield {'LaunchPathSummaries': [{'Id': f"lpv-{kwargs['ProductId']}"}]}
+
+
+def test_catalog_index():
+    '''
+    verify the lookups page through the listings once, and refresh on a missing name or after the ttl
+    '''
+    from utils.catalog_index import CatalogIndex
+
+    client = FakeCatalog(['Shared 1', 'Shared 2', 'Shared 3', 'SageMaker Organization Templates'], ['Abalone', 'Arima'])
+    now = [0.0]
+    catalog = CatalogIndex(client, ttl=300, miss_refresh=5, clock=lambda: now[0])
+
+    assert catalog.portfolio_id('SageMaker Organization Templates') == 'port-3'
+    assert catalog.product_id('Arima') == 'prod-1'
+    assert catalog.launch_paths('prod-1') == [{'Id': 'lpv-prod-1'}]
+    assert catalog.product_id('Abalone') == 'prod-0'
+    assert catalog.launch_paths('prod-1') == [{'Id': 'lpv-prod-1'}]
+    assert client.calls == ['list_portfolios', 'search_products_as_admin', 'list_launch_paths']
+
+    # a product released after the listing is searched for on its own
+    client.products.append({'ProductId': 'prod-2', 'Name': 'FNA'})
+    assert catalog.product_id('FNA') == 'prod-2'
+    assert client.calls[-1] == 'search_products_as_admin'
+
+    now[0] = 301
+    assert catalog.portfolios('SageMaker Organization Templates')[0]['Id'] == 'port-3'
+    assert client.calls[-1] == 'list_portfolios'
+
+
+def test_catalog_index_shared_client(monkeypatch):
+    '''
+    verify the index uses the shared servicecatalog client by default
+    '''
+    import boto3
+    from mlops_sm_project_template_rt.config import aws_clients
+    from utils.catalog_index import CatalogIndex
+
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    aws_clients.clear()
+    try:
+        client = boto3.session.Session(
+            aws_access_key_id='testing', aws_secret_access_key='testing', region_name='eu-west-1'
+        ).client('servicecatalog')
+        aws_clients.register_client('servicecatalog', client)
+        assert CatalogIndex().client is client
+    finally:
+        aws_clients.clear()
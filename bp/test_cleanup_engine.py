@@ -0,0 +1,63 @@
+import json
+import time
+from types import SimpleNamespace
+
+
+class FakeVersionedS3:
+    '''
+    versioned bucket listing its object versions 1000 per page
+    '''
+
+    def __init__(self, bucket, count, delete_s=0):
+        self.bucket = bucket
+        self.versions = [{'Key': f'model/{i:05d}.tar.gz', 'VersionId': f'v{i}'} for i in range(count)]
+        self.delete_calls = []
+        self.delete_s = delete_s
+        # keys listed and not deleted yet, at each delete call
+        self.listed = 0
+        self.ahead = []
+
+    def get_paginator(self, operation_name):
+        return SimpleNamespace(paginate=self._list_object_versions)
+
+    def _list_object_versions(self, Bucket, KeyMarker=None, VersionIdMarker=None, PaginationConfig=None):
+        remaining = [v for v in self.versions if KeyMarker is None or v['Key'] > KeyMarker]
+        for i in range(0, len(remaining), 1000):
+            page = remaining[i:i + 1000]
+            truncated = i + 1000 < len(remaining)
+            self.listed += len(page)
+            yield {'Versions': page, 'IsTruncated': truncated,
+                   'NextKeyMarker': page[-1]['Key'], 'NextVersionIdMarker': page[-1]['VersionId']}
+
+    def delete_objects(self, Bucket, Delete):
+        time.sleep(self.delete_s)
+        self.ahead.append(self.listed - sum(self.delete_calls))
+        self.delete_calls.append(len(Delete['Objects']))
+        deleted = {o['Key'] for o in Delete['Objects']}
+        self.versions = [v for v in self.versions if v['Key'] not in deleted]
+        return {}
+
+
+def test_cleanup_engine_checkpoint():
+    '''
+    verify buckets are emptied with batched deletes, and the cleanup resumes from its checkpoint
+    '''
+    from lambda_code.lambda_cleanup_code.cleanup_engine import CleanupEngine
+
+    s3 = FakeVersionedS3('mlops-autotest-prj1', 2500)
+    time_left = iter([-1])
+    engine = CleanupEngine(s3_client=s3, sm_client=object(), max_workers=1, time_left=lambda: next(time_left, 1))
+    checkpoint = engine.run(bucket_names=[s3.bucket])
+    assert checkpoint == {'buckets': {s3.bucket: {'KeyMarker': 'model/00999.tar.gz', 'VersionIdMarker': 'v999'}}, 'model_packages': {}}
+    assert s3.delete_calls == [1000]
+
+    engine = CleanupEngine(s3_client=s3, sm_client=object(), time_left=lambda: 1)
+    assert engine.run(checkpoint=json.loads(json.dumps(checkpoint))) is None
+    assert s3.delete_calls == [1000, 1000, 500]
+    assert len(s3.versions) == 0 and engine.deleted == 1500
+
+    # the listing doesn't run ahead of slow deletes by more than two batches per worker
+    s3 = FakeVersionedS3('mlops-autotest-prj2', 10000, delete_s=0.01)
+    engine = CleanupEngine(s3_client=s3, sm_client=object(), max_workers=1, time_left=lambda: 1)
+    assert engine.run(bucket_names=[s3.bucket]) is None
+    assert len(s3.versions) == 0 and max(s3.ahead) <= 3 * 1000
@@ -1,3 +1,4 @@
+import pytest
 import aws_cdk as cdk
 from unittest.mock import patch
 from pathlib import Path
@@ -11,6 +12,7 @@ from aws_cdk import assertions
 import json
 import zipfile
 import os
+from types import SimpleNamespace
 from pathlib import Path
 
 template_name = 'Arima'
@@ -37,31 +39,19 @@ def test_no_version_file():
 
     assert version == '0.0.1'
 
-def test_newer_version_available():
+# mock get_local_prod_version to return 5.1.2
+# mock get_sc_prod_version to return 1.0
+@pytest.mark.parametrize('service_catalog_build', [{'local_version': '5.1.2', 'sc_version': '1.0'}], indirect=True)
+def test_newer_version_available(service_catalog_build):
 
-    # mock get_local_prod_version to return 5.0
-    # mock get_sc_prod_version to return 1.0
-
-    pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-    stage = cdk.App()
-
-    new_version = '5.1.2'
-    with patch('mlops_sm_project_template_rt.config.constants.get_local_prod_version') as mock_local:
-        mock_local.return_value = new_version
-        with patch('mlops_sm_project_template_rt.config.constants.get_sc_prod_version') as mock_sc:
-            mock_sc.return_value = '1.0'
-            stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-
-    template = assertions.Template.from_stack(stack)        
-    res = template.to_json()['Resources']
+    new_version = service_catalog_build.config['local_version']
+    res = service_catalog_build.resources()
 
     the_stack = [res[sc] for sc in res if res[sc]['Type'] == 'AWS::ServiceCatalog::CloudFormationProduct' and res[sc]['Properties']['Name']==template_name][0]
     assert the_stack['Properties']['ProvisioningArtifactParameters'][0]['Name'] == new_version
 
 
-    generated_template_path = stack.get_generated_template(template_name)
-
-    res = json.loads(open(generated_template_path).read())['Resources']
+    res = json.loads(service_catalog_build.generated_template(template_name))['Resources']
 
     versions = [res[sc]['Properties']['Tags'][2]['Value'] for sc in res if 'Tags' in res[sc]['Properties']]
     for v in versions:
@@ -70,32 +60,20 @@ def test_newer_version_available():
     pass
 
 
-def test_newer_version_unavailable_dev():
+@pytest.mark.parametrize('service_catalog_build', [{'local_version': '0.1.2', 'sc_version': '1.2.7'}], indirect=True)
+def test_newer_version_unavailable_dev(service_catalog_build):
 
     '''
     verify that when no newer version but the stack should still be deployed because it is in dev
     '''
 
-    pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-    stage = cdk.App()
-
-    new_version = '0.1.2'
-    cur_version = '1.2.7'
-    with patch('mlops_sm_project_template_rt.config.constants.get_local_prod_version') as mock_local:
-        mock_local.return_value = new_version
-        with patch('mlops_sm_project_template_rt.config.constants.get_sc_prod_version') as mock_sc:
-            mock_sc.return_value = cur_version
-            stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-
-    template = assertions.Template.from_stack(stack)        
-    res = template.to_json()['Resources']
+    new_version = service_catalog_build.config['local_version']
+    res = service_catalog_build.resources()
 
     the_stack = [res[sc] for sc in res if res[sc]['Type'] == 'AWS::ServiceCatalog::CloudFormationProduct' and res[sc]['Properties']['Name']==template_name][0]
     assert the_stack['Properties']['ProvisioningArtifactParameters'][0]['Name'] == new_version
 
-    generated_template_path = stack.get_generated_template(template_name)
-
-    res = json.loads(open(generated_template_path).read())['Resources']
+    res = json.loads(service_catalog_build.generated_template(template_name))['Resources']
 
     versions = [res[sc]['Properties']['Tags'][2]['Value'] for sc in res if 'Tags' in res[sc]['Properties']]
     for v in versions:
@@ -104,59 +82,638 @@ def test_newer_version_unavailable_dev():
     pass
 
 
-def test_nothing_ready_to_release():
+@pytest.mark.parametrize('service_catalog_build', [
+    {'account': STAGING_PIPELINE_ACCOUNT, 'local_version': '0.1.2', 'sc_version': '1.2.7'}
+], indirect=True)
+def test_nothing_ready_to_release(service_catalog_build):
 
     '''
     verify that when no version >= 1.0, nothing should be released to staging
     '''
 
-    pipeline_env = cdk.Environment(account=STAGING_PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-    stage = cdk.App()
-
-    new_version = '0.1.2'
-    cur_version = '1.2.7'
-    with patch('mlops_sm_project_template_rt.config.constants.get_local_prod_version') as mock_local:
-        mock_local.return_value = new_version
-        with patch('mlops_sm_project_template_rt.config.constants.get_sc_prod_version') as mock_sc:
-            mock_sc.return_value = cur_version
-            stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-
-    template = assertions.Template.from_stack(stack)        
-    res = template.to_json()['Resources']
+    res = service_catalog_build.resources()
 
     the_stack = [res[sc] for sc in res if res[sc]['Type'] == 'AWS::ServiceCatalog::CloudFormationProduct' and res[sc]['Properties']['Name']==template_name]
     assert len(the_stack) == 0
 
-def test_code_stack_dev():
+def test_code_stack_dev(core_stage_build, tmp_path):
     '''
     when on dev, regardless newer version is available, the code stack use the local version
     '''
-    pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-
-    stage = CoreStage(cdk.App(), "DEV", env = pipeline_env)
-    template = assertions.Template.from_stack(stage.shared_code_stack)
+    template = core_stage_build.template('shared_code_stack')
     template.resource_count_is("AWS::S3::Bucket", 1)
     template.resource_count_is("Custom::CDKBucketDeployment", 1)
 
-    res = template.to_json()['Resources']
-
-    zip_path = [f for f in stage.shared_code_stack.zips_app if template_name in f][0]
+    zip_path = [f for f in core_stage_build.stack.shared_code_stack.zips_app if template_name in f][0]
 
     # load the zip file, unzip it, and verify __version__.py exists
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall('/tmp')
-        with zipfile.ZipFile(f'/tmp/{template_name}-build_app.zip', 'r') as zip_ref:
-            zip_ref.extractall(f'/tmp/{template_name}-tmp')
+        zip_ref.extractall(tmp_path)
+        with zipfile.ZipFile(tmp_path / f'{template_name}-build_app.zip', 'r') as zip_ref:
+            zip_ref.extractall(tmp_path / f'{template_name}-tmp')
 
-    assert os.path.exists(f'/tmp/{template_name}-tmp/__version__.py')
+    assert os.path.exists(tmp_path / f'{template_name}-tmp' / '__version__.py')
     
     # verify the extracted version in __version__.py is the same as the version in the folder
     template_path = f'{Path(__file__).parents[2]}/templates'
     new_version = get_local_prod_version(template_path, template_name)
-    with open(f'/tmp/{template_name}-tmp/__version__.py', 'r') as f:
+    with open(tmp_path / f'{template_name}-tmp' / '__version__.py', 'r') as f:
         content = f.read()
         assert new_version in content
 
     pass
 
 
+
+
+class FakeServiceCatalog:
+    '''
+    minimal service catalog client with two products in the templates portfolio and one in another
+    portfolio, recording the api calls
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def get_paginator(self, name):
+        self.calls.append(name)
+        if name == 'list_portfolios':
+            pages = [{'PortfolioDetails': [{'Id': 'port-1', 'DisplayName': 'Shared'},
+                                           {'Id': 'port-2', 'DisplayName': 'SageMaker Organization Templates'}]}]
+            return SimpleNamespace(paginate=lambda **kwargs: iter(pages))
+        pages = {
+            'port-1': [{'ProductViewDetails': [{'ProductViewSummary': {'Name': 'Other', 'ProductId': 'prod-3'}}]}],
+            'port-2': [
+                {'ProductViewDetails': [{'ProductViewSummary': {'Name': 'Arima', 'ProductId': 'prod-1'}}]},
+                {'ProductViewDetails': [{'ProductViewSummary': {'Name': 'Abalone', 'ProductId': 'prod-2'}}]},
+            ],
+        }
+        return SimpleNamespace(paginate=lambda PortfolioId: iter(pages[PortfolioId]))
+
+    def list_provisioning_artifacts(self, ProductId):
+        self.calls.append('list_provisioning_artifacts')
+        artifacts = [
+            {'Id': f'{ProductId}-pa-1', 'Name': '1.0.0', 'CreatedTime': 1, 'Active': True},
+            {'Id': f'{ProductId}-pa-2', 'Name': '1.2.7', 'CreatedTime': 2, 'Active': True},
+        ]
+        if ProductId == 'prod-2':
+            # listed newest first, after a newer artifact that is not active anymore
+            artifacts = [{'Id': f'{ProductId}-pa-3', 'Name': '2.0.0', 'CreatedTime': 3, 'Active': False}] + artifacts[::-1]
+        return {'ProvisioningArtifactDetails': artifacts}
+
+
+def test_sc_version_resolver():
+    '''
+    verify the versions of the products of the portfolio are resolved in one sweep, and served from the
+    snapshot afterwards
+
+    the current version is the active artifact created last, whatever the listing order
+    '''
+    from mlops_sm_project_template_rt.config.sc_version_resolver import ScVersionResolver
+
+    client = FakeServiceCatalog()
+    resolver = ScVersionResolver(client_factory=lambda: client)
+
+    assert resolver.get_version('Arima') == '1.2.7'
+    assert resolver.get('Arima').artifact_id == 'prod-1-pa-2'
+    assert resolver.get('Abalone').artifact_id == 'prod-2-pa-2'
+    assert resolver.get_version('FNA') == '0.0.0'
+    assert resolver.get('Other') is None
+    assert client.calls == ['search_products_as_admin', 'list_portfolios', 'list_provisioning_artifacts', 'list_provisioning_artifacts']
+
+
+def test_scratch_per_worker(monkeypatch, tmp_path):
+    '''
+    verify each xdist worker gets its own scratch root, inherited by its child processes and removed on cleanup
+    '''
+    from mlops_sm_project_template_rt import scratch
+
+    monkeypatch.setenv(scratch.SCRATCH_ENV_DIR, str(tmp_path))
+    monkeypatch.delenv(scratch.SCRATCH_ENV_ROOT, raising=False)
+    monkeypatch.setenv("PYTEST_XDIST_WORKER", "gw1")
+    scratch.cleanup()
+    try:
+        root = scratch.scratch_root()
+        assert os.path.basename(root).startswith('mlops-scratch-gw1-') and os.path.dirname(root) == str(tmp_path)
+        assert scratch.scratch_dir('cdk.out') == os.path.join(root, 'cdk.out')
+        assert os.environ[scratch.SCRATCH_ENV_ROOT] == root
+
+        # the root set by the controller is not shared with another worker
+        monkeypatch.setenv("PYTEST_XDIST_WORKER", "gw2")
+        other = scratch.scratch_root()
+        assert other != root and os.path.basename(other).startswith('mlops-scratch-gw2-')
+    finally:
+        scratch.cleanup()
+    assert not os.path.exists(root) and not os.path.exists(other)
+    assert scratch.SCRATCH_ENV_ROOT not in os.environ
+
+
+def test_shared_aws_clients(monkeypatch):
+    '''
+    verify the clients are created once per service / region / credential set
+    '''
+    from mlops_sm_project_template_rt.config.aws_clients import get_client
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    monkeypatch.delenv("AWS_REGION", raising=False)
+
+    _sc = get_client('servicecatalog')
+    assert get_client('servicecatalog') is _sc
+    assert get_client('servicecatalog', region_name='us-east-1') is not _sc
+    assert _sc.meta.config.retries['mode'] == 'adaptive'
+
+
+def test_assumed_role_clients(monkeypatch):
+    '''
+    verify a role is assumed once, outside the lock of the registry, its clients are shared and its credentials
+    are refreshed before they expire
+    '''
+    import threading
+    import boto3
+    from botocore.stub import Stubber
+    from datetime import datetime, timedelta, timezone
+    from mlops_sm_project_template_rt.config import aws_clients
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    monkeypatch.delenv("AWS_REGION", raising=False)
+    aws_clients.clear()
+
+    role_arn = 'arn:aws:iam::111111111111:role/bootstrap-from-mgmt'
+    sts = boto3.session.Session(
+        aws_access_key_id='testing', aws_secret_access_key='testing', region_name='eu-west-1'
+    ).client('sts')
+    stubber = Stubber(sts)
+    # the first credentials expire within the refresh window, the next ones don't
+    for access_key, expires_in in [('AKIAFIRST0000000', timedelta(minutes=5)), ('AKIASECOND000000', timedelta(hours=1))]:
+        stubber.add_response('assume_role', {'Credentials': {
+            'AccessKeyId': access_key, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + expires_in,
+        }}, {'RoleArn': role_arn, 'RoleSessionName': aws_clients.ASSUME_ROLE_SESSION_NAME,
+             'DurationSeconds': aws_clients.ASSUME_ROLE_DURATION_S})
+    stubber.activate()
+
+    # the other threads get their clients while the role is assumed
+    acquired = []
+    def try_lock():
+        acquired.append(aws_clients._lock.acquire(timeout=5))
+        if acquired[-1]:
+            aws_clients._lock.release()
+    def check_lock(**kwargs):
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+    sts.meta.events.register('before-parameter-build.sts.AssumeRole', check_lock)
+    aws_clients.register_client('sts', sts)
+    try:
+        _s3 = aws_clients.get_client('s3', role_arn=role_arn)
+        assert aws_clients.get_client('s3', role_arn=role_arn) is _s3
+        assert aws_clients.get_client('s3') is not _s3
+        assert aws_clients.get_client('servicecatalog', role_arn=role_arn).meta.region_name == 'eu-west-1'
+
+        # the role is assumed when its credentials are first used, then refreshed as they expire soon
+        session = aws_clients.get_role_session(role_arn)
+        assert session.get_credentials().get_frozen_credentials().access_key == 'AKIAFIRST0000000'
+        assert session.get_credentials().get_frozen_credentials().access_key == 'AKIASECOND000000'
+        assert session.get_credentials().get_frozen_credentials().access_key == 'AKIASECOND000000'
+        stubber.assert_no_pending_responses()
+        assert acquired == [True, True]
+
+        # the clients requested without a role get the default role, e.g. set by client_automation_role
+        monkeypatch.setenv(aws_clients.ROLE_ENV, role_arn)
+        assert aws_clients.get_client('s3') is _s3
+    finally:
+        aws_clients.clear()
+
+
+class FakeEc2:
+    '''
+    minimal ec2 client describing one VPC with a public and two private subnets
+    '''
+    def __init__(self):
+        self.calls = []
+        self.responses = {
+            'describe_vpcs': {'Vpcs': [{'VpcId': 'vpc-0abc', 'CidrBlock': '10.0.0.0/16', 'OwnerId': '111111111111'}]},
+            'describe_route_tables': {'RouteTables': [
+                {'RouteTableId': 'rtb-main', 'Associations': [{'Main': True}],
+                 'Routes': [{'DestinationCidrBlock': '0.0.0.0/0', 'TransitGatewayId': 'tgw-1'}]},
+                {'RouteTableId': 'rtb-pub', 'Associations': [{'SubnetId': 'subnet-pub'}],
+                 'Routes': [{'DestinationCidrBlock': '0.0.0.0/0', 'GatewayId': 'igw-1'}]},
+            ]},
+            'describe_subnets': {'Subnets': [
+                {'SubnetId': 'subnet-b', 'CidrBlock': '10.0.2.0/24', 'AvailabilityZone': 'eu-west-1b'},
+                {'SubnetId': 'subnet-a', 'CidrBlock': '10.0.1.0/24', 'AvailabilityZone': 'eu-west-1a'},
+                {'SubnetId': 'subnet-pub', 'CidrBlock': '10.0.0.0/24', 'AvailabilityZone': 'eu-west-1a',
+                 'Tags': [{'Key': 'aws-cdk:subnet-name', 'Value': 'Ingress'}]},
+            ]},
+        }
+
+    def get_paginator(self, operation_name):
+        calls, response = self.calls, self.responses[operation_name]
+        return SimpleNamespace(paginate=lambda **kwargs: calls.append(operation_name) or [response])
+
+    def describe_vpn_gateways(self, Filters):
+        self.calls.append('describe_vpn_gateways')
+        return {'VpnGateways': []}
+
+
+def test_vpc_context_prewarm(tmp_path):
+    '''
+    verify the missing VPC lookups are resolved once, written to the context file, and reused by the next synths
+    '''
+    from mlops_sm_project_template_rt.config import vpc_context
+
+    key = 'vpc-provider:account=111111111111:filter.tag:aws:cloudformation:logical-id=ConnectedTgwVPC:region=eu-west-1:returnAsymmetricSubnets=true'
+    lookup = {'key': key, 'provider': vpc_context.VPC_PROVIDER, 'props': {
+        'account': '111111111111', 'region': 'eu-west-1', 'returnAsymmetricSubnets': True,
+        'filter': {'tag:aws:cloudformation:logical-id': 'ConnectedTgwVPC'},
+        'lookupRoleArn': 'arn:${AWS::Partition}:iam::111111111111:role/cdk-hnb659fds-lookup-role-111111111111-eu-west-1',
+    }}
+    # the synth of the throwaway app: the lookup is missing until it is in the context
+    collect = lambda build, context: [] if key in context else [lookup]
+    ec2 = FakeEc2()
+    context_path = tmp_path / 'cdk.context.json'
+    context_path.write_text(json.dumps({'acknowledged-issue-numbers': [1]}))
+
+    resolved = vpc_context.prewarm(None, str(context_path), client_factory=lambda props: ec2, collect=collect)
+    context = json.loads(context_path.read_text())
+    assert list(resolved) == [key] and context[key] == resolved[key]
+    assert context['acknowledged-issue-numbers'] == [1]
+    assert context[key]['vpcId'] == 'vpc-0abc'
+    assert context[key]['subnetGroups'] == [
+        {'name': 'Private', 'type': 'Private', 'subnets': [
+            {'subnetId': 'subnet-a', 'cidr': '10.0.1.0/24', 'availabilityZone': 'eu-west-1a', 'routeTableId': 'rtb-main'},
+            {'subnetId': 'subnet-b', 'cidr': '10.0.2.0/24', 'availabilityZone': 'eu-west-1b', 'routeTableId': 'rtb-main'},
+        ]},
+        {'name': 'Ingress', 'type': 'Public', 'subnets': [
+            {'subnetId': 'subnet-pub', 'cidr': '10.0.0.0/24', 'availabilityZone': 'eu-west-1a', 'routeTableId': 'rtb-pub'},
+        ]},
+    ]
+
+    # pre-warmed: nothing left to look up
+    assert vpc_context.prewarm(None, str(context_path), client_factory=lambda props: ec2, collect=collect) == {}
+    assert ec2.calls.count('describe_vpcs') == 1
+
+    # the lookups that can't be pre-warmed are reported
+    other = {'key': 'hosted-zone:account=111111111111', 'provider': 'hosted-zone', 'props': {}}
+    with pytest.raises(vpc_context.MissingContextError):
+        vpc_context.prewarm(None, str(context_path), collect=lambda build, context: [other])
+
+
+@pytest.mark.parametrize("subnet, routes, subnet_type", [
+    ({'Tags': [{'Key': 'aws-cdk:subnet-type', 'Value': 'Isolated'}], 'MapPublicIpOnLaunch': True}, [{'GatewayId': 'igw-1'}], 'Isolated'),
+    ({'MapPublicIpOnLaunch': True}, [], 'Public'),
+    ({}, [{'GatewayId': 'local'}, {'GatewayId': 'igw-1'}], 'Public'),
+    ({}, [{'NatGatewayId': 'nat-1'}], 'Private'),
+    ({}, [{'TransitGatewayId': 'tgw-1'}], 'Private'),
+    ({}, [{'GatewayId': 'local'}, {'VpcPeeringConnectionId': 'pcx-1'}], 'Isolated'),
+])
+def test_vpc_subnet_type(subnet, routes, subnet_type):
+    '''
+    verify the subnets are typed as by the CDK VPC context provider
+    '''
+    from mlops_sm_project_template_rt.config.vpc_context import resolve_vpc
+
+    ec2 = FakeEc2()
+    ec2.responses['describe_route_tables'] = {'RouteTables': [
+        {'RouteTableId': 'rtb-main', 'Associations': [{'Main': True}], 'Routes': routes},
+    ]}
+    ec2.responses['describe_subnets'] = {'Subnets': [
+        {'SubnetId': 'subnet-a', 'CidrBlock': '10.0.1.0/24', 'AvailabilityZone': 'eu-west-1a', **subnet},
+    ]}
+    props = {'account': '111111111111', 'region': 'eu-west-1', 'returnAsymmetricSubnets': True, 'filter': {'isDefault': 'false'}}
+    groups = resolve_vpc(props, ec2)['subnetGroups']
+    assert [(g['name'], g['type']) for g in groups] == [(subnet_type, subnet_type)]
+
+
+class FakeS3:
+    '''
+    minimal s3 client serving one object, extra are the other fields of its get_object response
+    '''
+    def __init__(self, content, etag, **extra):
+        self.content = content
+        self.etag = etag
+        self.extra = extra
+        self.downloads = 0
+
+    def get_object(self, Bucket, Key, ChecksumMode=None):
+        self.downloads += 1
+        content = self.content
+        body = type('Body', (), {'iter_chunks': lambda self, size: iter([content[i:i + size] for i in range(0, len(content), size)])})()
+        return {'ETag': f'"{self.etag}"', 'ContentLength': len(content), 'Body': body, **self.extra}
+
+
+def test_existing_template_download(tmp_path):
+    '''
+    verify the released template is verified against its etag or checksum, and only downloaded once per artifact
+    '''
+    import base64
+    import hashlib
+    import pytest
+    from mlops_sm_project_template_rt.artifact_cache import TemplateArtifactCache
+
+    content = b'{"Resources": {}}'
+    url = 'https://s3.amazonaws.com/sc-bucket/template.json'
+    cache = TemplateArtifactCache(cache_dir=str(tmp_path), enabled=True)
+
+    s3 = FakeS3(content, hashlib.md5(content).hexdigest())
+    template_path = cache.fetch(s3, url, 'pa-123', template_name)
+    assert template_name in template_path
+    assert open(template_path, 'rb').read() == content
+    assert cache.fetch(s3, url, 'pa-123', template_name) == template_path
+    assert s3.downloads == 1
+
+    with pytest.raises(ValueError):
+        cache.fetch(FakeS3(content, '0' * 32), url, 'pa-456', template_name)
+    assert cache.get('pa-456', template_name) is None
+
+    # the etag of a KMS encrypted object is not its md5, its sha256 checksum is verified when there is one
+    assert open(cache.fetch(FakeS3(content, '1' * 32, ServerSideEncryption='aws:kms'), url, 'pa-789', template_name), 'rb').read() == content
+    checksum = base64.b64encode(hashlib.sha256(content).digest()).decode('ascii')
+    kms_s3 = FakeS3(content, '2' * 32, ServerSideEncryption='aws:kms', ChecksumSHA256=checksum)
+    assert open(cache.fetch(kms_s3, url, 'pa-790', template_name), 'rb').read() == content
+    with pytest.raises(ValueError):
+        cache.fetch(FakeS3(content, '3' * 32, ServerSideEncryption='aws:kms', ChecksumSHA256='A' * 43 + '='), url, 'pa-791', template_name)
+
+
+def test_seed_bundle_download(tmp_path):
+    '''
+    verify the bundle is wrapped into the outer zip, downloaded again only once it changed, and not kept when it
+    was replaced during its download
+    '''
+    import io
+    import stat
+    import boto3
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    from mlops_sm_project_template_rt.s3_transfer import download_into_zip
+
+    bucket, key = 'code-bucket', 'seed_code/abalone.zip'
+    cache_path, outer_path = str(tmp_path / 'cache' / 'abalone.zip'), str(tmp_path / 'abalone-outer.zip')
+    s3 = boto3.session.Session(
+        aws_access_key_id='testing', aws_secret_access_key='testing', region_name='eu-west-1'
+    ).client('s3')
+    stubber = Stubber(s3)
+
+    with stubber:
+        head = {'ETag': '"v1"', 'ContentLength': 9}
+        stubber.add_response('head_object', head, {'Bucket': bucket, 'Key': key})
+        # the head and get of the transfer itself, their arguments depend on the s3transfer version
+        stubber.add_response('head_object', head)
+        stubber.add_response('get_object', {**head, 'Body': StreamingBody(io.BytesIO(b'bundle v1'), 9)})
+        stubber.add_response('head_object', head, {'Bucket': bucket, 'Key': key, 'IfMatch': '"v1"'})
+        assert download_into_zip(s3, bucket, key, cache_path, outer_path) == outer_path
+        with zipfile.ZipFile(outer_path) as zf:
+            assert zf.namelist() == [key] and zf.read(key) == b'bundle v1'
+            assert zf.getinfo(key).external_attr >> 16 == stat.S_IFREG | 0o644
+        assert open(cache_path, 'rb').read() == b'bundle v1'
+
+        # unchanged: only the conditional head
+        stubber.add_client_error('head_object', '304', http_status_code=304,
+                                 expected_params={'Bucket': bucket, 'Key': key, 'IfNoneMatch': '"v1"'})
+        assert download_into_zip(s3, bucket, key, cache_path, outer_path) == outer_path
+
+        # replaced by v3 while v2 was downloading
+        stubber.add_response('head_object', {'ETag': '"v2"', 'ContentLength': 9},
+                             {'Bucket': bucket, 'Key': key, 'IfNoneMatch': '"v1"'})
+        stubber.add_response('head_object', {'ETag': '"v2"', 'ContentLength': 9})
+        stubber.add_response('get_object', {'ETag': '"v2"', 'ContentLength': 9, 'Body': StreamingBody(io.BytesIO(b'bundle v2'), 9)})
+        stubber.add_client_error('head_object', '412', http_status_code=412,
+                                 expected_params={'Bucket': bucket, 'Key': key, 'IfMatch': '"v2"'})
+        with pytest.raises(RuntimeError):
+            download_into_zip(s3, bucket, key, cache_path, outer_path)
+        stubber.assert_no_pending_responses()
+
+    with zipfile.ZipFile(outer_path) as zf:
+        assert zf.read(key) == b'bundle v1'
+    assert open(cache_path, 'rb').read() == b'bundle v1'
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['abalone.zip', 'abalone.zip.etag']
+
+
+def test_deterministic_seed_archive(tmp_path):
+    '''
+    verify the seed code archives are byte identical for the same tree, and reused when the tree is unchanged
+    '''
+    from mlops_sm_project_template_rt.zip_builder import build_nested_zip
+
+    src_dir = tmp_path / 'build_app'
+    (src_dir / 'pipelines').mkdir(parents=True)
+    (src_dir / 'pipelines' / 'run.py').write_text('print("train")')
+    (src_dir / '__version__.py').write_text('version = "1.0.0"')
+
+    first = build_nested_zip(str(src_dir), f'{template_name}-build_app.zip', str(tmp_path / 'first.zip'))
+    os.utime(src_dir / '__version__.py', (0, 0))
+    second = build_nested_zip(str(src_dir), f'{template_name}-build_app.zip', str(tmp_path / 'second.zip'))
+    assert open(first, 'rb').read() == open(second, 'rb').read()
+
+    mtime = os.path.getmtime(first)
+    assert build_nested_zip(str(src_dir), f'{template_name}-build_app.zip', first) == first
+    assert os.path.getmtime(first) == mtime
+
+    with zipfile.ZipFile(first, 'r') as zip_ref:
+        assert zip_ref.namelist() == [f'{template_name}-build_app.zip']
+        with zipfile.ZipFile(zip_ref.open(f'{template_name}-build_app.zip'), 'r') as inner:
+            assert inner.namelist() == ['__version__.py', 'pipelines/run.py']
+
+    # the executable bit is kept in the archive, so a chmod rebuilds it
+    os.chmod(src_dir / 'pipelines' / 'run.py', 0o755)
+    assert build_nested_zip(str(src_dir), f'{template_name}-build_app.zip', first) == first
+    with zipfile.ZipFile(first, 'r') as zip_ref:
+        with zipfile.ZipFile(zip_ref.open(f'{template_name}-build_app.zip'), 'r') as inner:
+            assert inner.getinfo('pipelines/run.py').external_attr >> 16 & 0o777 == 0o755
+
+
+def test_synth_profiler(tmp_path, monkeypatch):
+    '''
+    verify the profiler records nested phases per product, with the api calls made while they run, also on a
+    thread pool and in child processes, and leaves the report to the process that enabled it
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from mlops_sm_project_template_rt.synth_profiler import OWNER_ENV, REPORT_ENV, SynthProfiler
+
+    # as set by enable in the process running the synth
+    monkeypatch.setenv(OWNER_ENV, str(os.getpid()))
+    profiler = SynthProfiler()
+    profiler.enable()
+    try:
+        with profiler.phase('ServiceCatalogStack'):
+            with profiler.phase('get_existing_template', template_name):
+                profiler.count_api_call('servicecatalog', 'DescribeProvisioningArtifact')
+                profiler.count_api_call('s3', 'GetObject')
+
+        def load_zip(i):
+            with profiler.phase('load_zip_from_s3', str(i)):
+                profiler.count_api_call('s3', 'HeadObject')
+
+        with profiler.phase('SharedCodeStack'):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(profiler.propagate(load_zip), range(4)))
+
+        report = profiler.report(str(tmp_path / 'synth-profile.json'))
+        phases = {(p['phase'], p['product']): p for p in report['phases']}
+        assert phases[('get_existing_template', template_name)]['api_calls'] == {'s3.GetObject': 1, 'servicecatalog.DescribeProvisioningArtifact': 1}
+        assert sum(phases[('ServiceCatalogStack', '')]['api_calls'].values()) == 2
+        assert phases[('SharedCodeStack', '')]['api_calls'] == {'s3.HeadObject': 4}
+        assert json.loads((tmp_path / 'synth-profile.json').read_text())['api_calls']['s3.GetObject'] == 1
+
+        # the profile of a synth process counts for the phase running it, and keeps its own phases per product
+        child = SynthProfiler()
+        child.enable()
+        with child.phase('synthesize_product', template_name):
+            child.count_api_call('servicecatalog', 'ListPortfolios')
+        with profiler.phase('synthesize_templates'):
+            profiler.merge(json.loads(json.dumps(child.to_dict())))
+        child.disable()
+        phases = {(p['phase'], p['product']): p for p in profiler.to_dict()['phases']}
+        assert phases[('synthesize_product', template_name)]['count'] == 1
+        assert phases[('synthesize_templates', '')]['api_calls'] == {'servicecatalog.ListPortfolios': 1}
+        assert profiler.to_dict()['api_calls']['servicecatalog.ListPortfolios'] == 1
+
+        # a child process inherits the owner from its parent, which writes the report
+        assert os.environ[OWNER_ENV] == str(os.getpid())
+        monkeypatch.setenv(OWNER_ENV, str(os.getppid()))
+        monkeypatch.setenv(REPORT_ENV, str(tmp_path / 'child-profile.json'))
+        profiler._report_at_exit()
+        assert not (tmp_path / 'child-profile.json').exists()
+    finally:
+        profiler.disable()
+
+
+def test_profiler_counts_stubbed_calls():
+    '''
+    verify the calls answered by a Stubber are counted, whether the client is instrumented before or after it
+    '''
+    import boto3
+    from botocore.stub import Stubber
+    from mlops_sm_project_template_rt.synth_profiler import instrument_client, profiler
+
+    client = boto3.session.Session(
+        aws_access_key_id='testing', aws_secret_access_key='testing', region_name='eu-west-1'
+    ).client('servicecatalog')
+    stubber = Stubber(client)
+    stubber.add_response('list_portfolios', {'PortfolioDetails': []})
+    stubber.add_response('list_portfolios', {'PortfolioDetails': []})
+
+    profiler.enable()
+    profiler.reset()
+    try:
+        with stubber:
+            instrument_client(client)
+            client.list_portfolios()
+            # instrumenting again, e.g. on register_client, doesn't count the calls twice
+            instrument_client(client)
+            client.list_portfolios()
+        assert profiler.to_dict()['api_calls'] == {'servicecatalog.ListPortfolios': 2}
+    finally:
+        profiler.disable()
+        profiler.reset()
+
+
+def test_version_index(tmp_path):
+    '''
+    verify versions are read from __version__.py without executing it, and compared semantically
+    '''
+    from mlops_sm_project_template_rt.config.versions import VersionIndex, is_newer, parse_version
+
+    assert is_newer('10.0', '9.9')
+    assert not is_newer('1.0', '1.0.0')
+    assert parse_version('1.0') == '1.0.0'
+    assert parse_version('1.0.0rc1') < '1.0.0'
+    assert parse_version('0.9.12') < '1.0'
+    assert parse_version('1.0.0rc2') < '1.0.0rc10' and parse_version('1.0.0rc10') < '1.0.0'
+    # only versions and strings compare with a version
+    assert parse_version('1.0') != None and parse_version('1.0') != 1.0
+    assert parse_version('1.0') in [None, '1.0.0']
+    with pytest.raises(TypeError):
+        parse_version('1.0') < 2
+    # a deployed artifact name that is not a version is older than any version
+    assert is_newer('0.0.1', 'initial release')
+    with pytest.raises(ValueError):
+        is_newer('initial release', '0.0.1')
+
+    version_file = tmp_path / '__version__.py'
+    version_file.write_text('raise RuntimeError("must not run")\nversion = "1.2.3"\n')
+    index = VersionIndex()
+    assert index.get(str(version_file)) == '1.2.3'
+
+    version_file.write_text('version = "1.10.0"  # bumped\n')
+    assert index.get(str(version_file)) == '1.10.0'
+
+    version_file.write_text('version = get_version()\n')
+    with pytest.raises(ValueError):
+        VersionIndex().get(str(version_file))
+
+
+def test_release_planner(tmp_path):
+    '''
+    verify unchanged products are reused on the dev accounts, and the deployed version is kept when not newer
+    '''
+    from mlops_sm_project_template_rt.release_planner import ReleasePlanner, SYNTH, REUSE, DEPLOYED, SKIP
+    from mlops_sm_project_template_rt.zip_builder import build_nested_zip
+
+    templates = tmp_path / 'templates'
+    for name, version in [('Abalone', '1.0.0'), ('Arima', '0.9.0')]:
+        (templates / name / 'seed_code' / 'build_app').mkdir(parents=True)
+        (templates / name / f'{name}Stack.py').write_text(f'# {name}')
+        (templates / name / '__version__.py').write_text(f'version = "{version}"')
+        (templates / name / 'seed_code' / 'build_app' / 'run.py').write_text('print("train")')
+    template_path = tmp_path / 'Abalone-dev_processed.json'
+    template_path.write_text('{}')
+    archive_path = tmp_path / 'Abalonebuild_app-tmp.zip'
+    seed_dir = templates / 'Abalone' / 'seed_code' / 'build_app'
+    build_nested_zip(str(seed_dir), 'Abalone-build_app.zip', str(archive_path))
+
+    def planner():
+        return ReleasePlanner(str(templates), PIPELINE_ACCOUNT, DEFAULT_DEPLOYMENT_REGION, cache_dir=str(tmp_path), enabled=True)
+
+    with patch('mlops_sm_project_template_rt.config.constants.get_sc_prod_version') as mock_sc:
+        mock_sc.return_value = '1.0'
+
+        first = planner()
+        plans = {p.name: p for p in first.plan_templates('dev', release_all=True)}
+        assert plans['Abalone'].template_action == SYNTH
+        first.record_template(plans['Abalone'], 'Abalone-dev', str(template_path))
+        seeds = {p.name: p for p in first.plan_seeds(release_all=True)}
+        assert seeds['Abalone'].seed_action == SYNTH
+        first.record_seed_archive(seeds['Abalone'], 'build_app', str(archive_path))
+        first.save()
+
+        second = planner()
+        plans = {p.name: p for p in second.plan_templates('dev', release_all=True)}
+        assert plans['Abalone'].template_action == REUSE
+        assert plans['Abalone'].template_path('Abalone-dev') == str(template_path)
+        assert {p.name: p.seed_action for p in second.plan_seeds(release_all=True)}['Abalone'] == REUSE
+
+        # the synth of another account rebuilt the shared archive from other seed code
+        other_seed_dir = tmp_path / 'other' / 'build_app'
+        other_seed_dir.mkdir(parents=True)
+        (other_seed_dir / 'run.py').write_text('print("edited")')
+        build_nested_zip(str(other_seed_dir), 'Abalone-build_app.zip', str(archive_path))
+        assert {p.name: p.seed_action for p in planner().plan_seeds(release_all=True)}['Abalone'] == SYNTH
+
+        (templates / 'Abalone' / 'AbaloneStack.py').write_text('# Abalone changed')
+        plans = {p.name: p for p in planner().plan_templates('dev', release_all=True)}
+        assert plans['Abalone'].template_action == SYNTH
+
+        staging = planner()
+        plans = {p.name: p.template_action for p in staging.plan_templates('dev', release_all=False)}
+        assert plans == {'Abalone': DEPLOYED}
+        assert staging.products()['Arima'].template_action == SKIP
+
+    # one planner per app, dropped with it
+    import gc
+    from mlops_sm_project_template_rt.release_planner import _planners, get_release_planner
+
+    class App:
+        def __init__(self):
+            self.node = SimpleNamespace(root=self)
+
+    app = App()
+    shared = get_release_planner(app, str(templates), PIPELINE_ACCOUNT)
+    assert get_release_planner(SimpleNamespace(node=SimpleNamespace(root=app)), str(templates), PIPELINE_ACCOUNT) is shared
+    assert get_release_planner(App(), str(templates), PIPELINE_ACCOUNT) is not shared
+    gc.collect()
+    count = len(_planners)
+    del app
+    gc.collect()
+    assert len(_planners) == count - 1
@@ -14,6 +14,7 @@ from aws_cdk import (
 )
 
 import sys, os, inspect, json
+import pytest
 from unittest.mock import patch
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))  # type: ignore
@@ -24,7 +25,7 @@ sys.path.insert(0, parentdir)
 
 from templates.Abalone.AbaloneStack import AbaloneStack
 from mlops_sm_project_template_rt.pipeline_stack import CoreStage, PipelineStack, ServiceCatalogStack, GovernanceStack, PipelineCustomTriggerStack
-from mlops_sm_project_template_rt.permission_boundary import PermissionBoundaryAspect
+from mlops_sm_project_template_rt.role_boundary import apply_permission_boundary
 from mlops_sm_project_template_rt.config.constants import (
     DEFAULT_DEPLOYMENT_REGION,
     PIPELINE_ACCOUNT,
@@ -95,76 +96,60 @@ def test_generate_template():
     # stack = AbaloneStack(stage, "test-mlops-stack", synthesizer=cdk.BootstraplessSynthesizer(), env=pipeline_env)        
     stack = AbaloneStack(stage, "test-mlops-stack", env=pipeline_env)        
 
-    Aspects.of(stage).add(
-        PermissionBoundaryAspect(
-            f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
-        )
-    )
+    boundary_arn = f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
+    manifest = apply_permission_boundary(stage, boundary_arn)
 
     assembly = stage.synth()
 
-    for stack in assembly.stacks:
-        template_path = stack.template_full_path
-        res = json.loads(open(template_path).read())['Resources']
-        roles = [item for item in res.items() if item[1]['Type'] == 'AWS::IAM::Role']
-        for role in roles:
-            assert "-pol_PlatformUserBoundary" in json.dumps(role), f"Role {role[0]} does not have permission boundary"    
+    # the visitor found every role of the template, and only them
+    res = json.loads(open(assembly.get_stack_by_name("test-mlops-stack").template_full_path).read())['Resources']
+    roles = sorted(name for name, item in res.items() if item['Type'] == 'AWS::IAM::Role')
+    assert len(roles) > 0
+    assert sorted(role['logical_id'] for role in manifest['roles']) == roles
+    for role in roles:
+        assert res[role]['Properties']['PermissionsBoundary'] == boundary_arn, f"Role {role} does not have permission boundary"
 
 
-def test_servicecatalog_permission_boundary():
+def test_servicecatalog_permission_boundary(synthesized_stacks):
     '''
     create a service catalog stack, verify no permission boundary is added,
-    Then use Aspect applies a visitor, and verify the permission boundary is added
+    Then apply the boundary visitor, and verify the permission boundary is added
     
     '''
-    pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-    # pipeline_env = cdk.Environment(account=STAGING_PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-
-    stage = cdk.App()
-    stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-    template = assertions.Template.from_stack(stack)    
-    res = template.to_json()['Resources']
-    roles = [item for item in res.values() if item['Type'] == 'AWS::IAM::Role']
+    build = synthesized_stacks.service_catalog()
+    roles = [item for item in build.resources().values() if item['Type'] == 'AWS::IAM::Role']
     for role in roles:
         assert "-pol_PlatformUserBoundary" not in json.dumps(role)    
 
-
-    stage = cdk.App()
-    stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-    cdk.Aspects.of(stack).add(
-        PermissionBoundaryAspect(
-            f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
-        )
+    build = synthesized_stacks.service_catalog(
+        boundary_arn=f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
     )
-    # after apply Aspect, verify the Permission Boundary is added
-    template = assertions.Template.from_stack(stack)        
-    res = template.to_json()['Resources']
-    roles = [item for item in res.values() if item['Type'] == 'AWS::IAM::Role']
+    # after applying the visitor, verify the Permission Boundary is added to every role, all in the manifest
+    res = build.resources()
+    roles = sorted(name for name, item in res.items() if item['Type'] == 'AWS::IAM::Role')
+    assert sorted(role['logical_id'] for role in build.boundary_manifest['roles']) == roles
     for role in roles:
-        assert "-pol_PlatformUserBoundary" in json.dumps(role)    
-
-    generated_template_path = stack.get_generated_template('Abalone')
-    res = json.loads(open(generated_template_path).read())['Resources']
-    roles = [item for item in res.items() if item[1]['Type'] == 'AWS::IAM::Role']
+        assert "-pol_PlatformUserBoundary" in json.dumps(res[role]['Properties']['PermissionsBoundary'])
+
+    # same for the generated template, see test_generate_template
+    res = json.loads(build.generated_template('Abalone'))['Resources']
+    roles = sorted(name for name, item in res.items() if item['Type'] == 'AWS::IAM::Role')
+    manifest = build.stack.get_boundary_manifest('Abalone')
+    assert len(roles) > 0
+    assert sorted(role['logical_id'] for role in manifest['roles']) == roles
     for role in roles:
-        assert "-pol_PlatformUserBoundary" in json.dumps(role), f"Role {role[0]} does not have permission boundary"    
+        assert "-pol_PlatformUserBoundary" in json.dumps(res[role]), f"Role {role} does not have permission boundary"
 
     pass
 
 
-def test_servicecatalog_dynamic_account():
+def test_servicecatalog_dynamic_account(service_catalog_build):
     '''
     create a service catalog stack, verify no permission boundary is added,
     Then use Aspect applies a visitor, and verify the permission boundary is added
 
     '''
-    pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
-
-    stage = cdk.App()
-    stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-    generated_template_path = stack.get_generated_template('Abalone')
-
-    res = open(generated_template_path).read()
+    res = service_catalog_build.generated_template('Abalone')
     assert f'resolve:ssm:/mlops/dev/account_id' in res
 
     res = json.loads(res)['Resources']
@@ -190,28 +175,22 @@ def test_servicecatalog_dynamic_account():
             pass
     pass
 
-def test_servicecatalog_kms():
+def test_servicecatalog_kms(service_catalog_build):
     '''
     create a service catalog stack, verify no permission boundary is added,
     Then use Aspect applies a visitor, and verify the permission boundary is added
     
     '''
-    stage = cdk.App()
-    stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-    generated_template_path = stack.get_generated_template('Abalone')
-
-    res = open(generated_template_path).read()
-    res = json.loads(res)['Resources']
+    res = json.loads(service_catalog_build.generated_template('Abalone'))['Resources']
     kms_list = [item for item in res.values() if item['Type'] == 'AWS::KMS::Key']
     assert len(kms_list) == 1
 
-def test_code_stack():
-    stage = CoreStage(cdk.App(), "DEV", env = pipeline_env)
-    template = assertions.Template.from_stack(stage.shared_code_stack)
+def test_code_stack(core_stage_build):
+    template = core_stage_build.template('shared_code_stack')
     template.resource_count_is("AWS::S3::Bucket", 1)
     template.resource_count_is("Custom::CDKBucketDeployment", 1)
 
-    res = template.to_json()['Resources']
+    res = core_stage_build.resources('shared_code_stack')
     for item in res.values():
         if item['Type'] == 'AWS::IAM::Role':
             #lambda will use pipeline account
@@ -219,12 +198,180 @@ def test_code_stack():
 
     pass
 
-def test_gov_stack():
+def test_gov_stack(core_stage_build):
     """
     Verify dynamo db table is created in governance stack
 
     """
-    stage = CoreStage(cdk.App(), "DEV", env=pipeline_env) 
-    template = assertions.Template.from_stack(stage.governance_stack)
+    template = core_stage_build.template('governance_stack')
     template.resource_count_is("AWS::DynamoDB::Table", 1)
-    pass
\ No newline at end of file
+    pass
+
+def test_servicecatalog_synth_cache(monkeypatch, tmp_path):
+    '''
+    synthesize the service catalog twice, verify the second synth reuses the cached product templates
+    '''
+    monkeypatch.setenv("MLOPS_SYNTH_CACHE_DIR", str(tmp_path))
+
+    stack = ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=pipeline_env)
+    first_path = stack.get_generated_template('Abalone')
+    assert first_path.startswith(str(tmp_path))
+
+    with patch('aws_cdk.App.synth') as mock_synth:
+        stack = ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=pipeline_env)
+        mock_synth.assert_not_called()
+
+    assert stack.get_generated_template('Abalone') == first_path
+
+
+def test_servicecatalog_parallel_synth(monkeypatch):
+    '''
+    synthesize the product templates in a process pool, verify the products are added in a deterministic order
+    and the generated templates are post processed
+    '''
+    monkeypatch.setenv("MLOPS_SYNTH_CACHE", "0")
+    monkeypatch.setenv("MLOPS_SYNTH_WORKERS", "2")
+
+    stack = ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=pipeline_env)
+    res = assertions.Template.from_stack(stack).to_json()['Resources']
+    names = [item['Properties']['Name'] for item in res.values() if item['Type'] == 'AWS::ServiceCatalog::CloudFormationProduct']
+    assert names == sorted(names)
+
+    generated_template_path = stack.get_generated_template('Abalone')
+    assert 'resolve:ssm:/mlops/dev/account_id' in open(generated_template_path).read()
+
+    # the other stack kwargs can't be sent to the synth processes
+    with pytest.raises(ValueError):
+        ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=pipeline_env, description='service catalog')
+
+
+def test_synth_worker(monkeypatch, tmp_path):
+    '''
+    verify the warm worker serves the synth jobs, picks up an edited template, removes the output folder of
+    each job, and that the synth falls back in process when no worker answers
+    '''
+    import threading
+    from mlops_sm_project_template_rt import synth_worker
+
+    templates_root = tmp_path / 'templates'
+    (templates_root / 'Demo').mkdir(parents=True)
+    (templates_root / 'Demo' / '__init__.py').write_text('')
+    (templates_root / 'Demo' / 'DemoStack.py').write_text('VERSION = "1"\n')
+    monkeypatch.syspath_prepend(str(templates_root))
+
+    outdirs = []
+    def fake_synthesize(job):
+        import importlib
+        module = importlib.import_module(f"{job['template_dir']}.{job['template_dir']}Stack")
+        outdirs.append(job['outdir'])
+        processed_path = os.path.join(job['outdir'], f"{job['stack_name']}_processed.json")
+        with open(processed_path, 'w') as f:
+            f.write(module.VERSION)
+        return processed_path
+
+    address = str(tmp_path / 'w.sock')
+    worker = threading.Thread(target=synth_worker.serve, args=(address, fake_synthesize), daemon=True)
+    worker.start()
+    synth_worker.wait_for_worker(address)
+
+    job = {'templates_root': str(templates_root), 'template_dir': 'Demo', 'stack_name': 'Demo-dev'}
+    def in_process(job):
+        raise AssertionError('synthesized in process')
+
+    processed_path = synth_worker.synthesize_warm(job, address, fallback=in_process)
+    assert os.path.basename(processed_path) == 'Demo-dev_processed.json'
+    assert open(processed_path).read() == '1'
+    (templates_root / 'Demo' / 'DemoStack.py').write_text('VERSION = "22"\n')
+    assert open(synth_worker.synthesize_warm(job, address, fallback=in_process)).read() == '22'
+    assert len(outdirs) == 2 and not any(os.path.exists(outdir) for outdir in outdirs)
+
+    # the one-off synth processes of the pool reply through a file
+    job_path, reply_path = tmp_path / 'job.json', tmp_path / 'reply.json'
+    job_path.write_text(json.dumps(job))
+    synth_worker.run_isolated(str(job_path), str(reply_path), fake_synthesize)
+    assert json.loads(reply_path.read_text())['outputs'] == {'Demo-dev_processed.json': '22'}
+    synth_worker.run_isolated(str(job_path), str(reply_path), in_process)
+    assert 'synthesized in process' in json.loads(reply_path.read_text())['error']
+    # and send their profile back with it when profiling
+    monkeypatch.setattr(synth_worker.profiler, 'enabled', True)
+    synth_worker.run_isolated(str(job_path), str(reply_path), fake_synthesize)
+    assert 'phases' in json.loads(reply_path.read_text())['profile']
+
+    synth_worker.request({'op': 'shutdown'}, address)
+    worker.join(timeout=10)
+    assert not os.path.exists(address)
+    assert synth_worker.synthesize_warm(job, address, fallback=lambda job: 'in-process.json') == 'in-process.json'
+
+
+def test_synth_worker_stale():
+    '''
+    verify the worker goes stale after an upgrade of the CDK libraries
+    '''
+    from mlops_sm_project_template_rt import synth_worker
+
+    signature = synth_worker.package_signature()
+    assert synth_worker.package_signature() == signature
+    with patch.object(synth_worker, 'read_cdk_version', return_value='aws-cdk-lib==0.0.0 constructs==0.0.0 jsii==0.0.0'):
+        assert synth_worker.package_signature() != signature
+
+
+def test_synthesize_product_context(tmp_path):
+    '''
+    verify a product synthesized outside of the cdk synth process gets the CDK context of the job
+    '''
+    from mlops_sm_project_template_rt.service_catalog_stack import synthesize_product
+
+    templates_root = tmp_path / 'templates'
+    (templates_root / 'Ctx').mkdir(parents=True)
+    (templates_root / 'Ctx' / '__init__.py').write_text('')
+    (templates_root / 'Ctx' / 'CtxStack.py').write_text(
+        'from aws_cdk import Stack, aws_ssm as ssm\n'
+        '\n'
+        '\n'
+        'class CtxStack(Stack):\n'
+        '    def __init__(self, scope, construct_id, version="0.0.1", **kwargs):\n'
+        '        super().__init__(scope, construct_id, **kwargs)\n'
+        '        ssm.StringParameter(self, "Vpc", string_value=self.node.try_get_context("mlops:test_vpc") or "none")\n'
+    )
+    job = {
+        'templates_root': str(templates_root),
+        'template_dir': 'Ctx',
+        'stack_name': 'Ctx-dev',
+        'version': '1.0.0',
+        'act_id': PIPELINE_ACCOUNT,
+        'account': PIPELINE_ACCOUNT,
+        'region': DEFAULT_DEPLOYMENT_REGION,
+        'boundary_arn': f'arn:aws:iam::{PIPELINE_ACCOUNT}:policy/boundary',
+        'context': {'mlops:test_vpc': 'vpc-0abc'},
+        'outdir': str(tmp_path / 'cdk.out'),
+    }
+    assert 'vpc-0abc' in open(synthesize_product(job)).read()
+
+
+def test_template_rules():
+    '''
+    verify the cross account rules rewrite the account, boundary and bootstrap bucket, and fix the provider S3 key
+    '''
+    from mlops_sm_project_template_rt.template_rules import cross_account_transformer
+
+    template = {
+        'Parameters': {'Boundary': {'Default': f'arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary'}},
+        'Resources': {
+            'Provider': {
+                'Type': 'AWS::Lambda::Function',
+                'Properties': {
+                    'Description': 'AWS CDK resource provider framework - onEvent (stack/provider)',
+                    'Code': {'S3Bucket': f'cdk-hnb659fds-assets-{PIPELINE_ACCOUNT}-{DEFAULT_DEPLOYMENT_REGION}', 'S3Key': 'abc123.zip'},
+                    'Role': {'Fn::Join': ['', ['arn:aws:iam:', f':{PIPELINE_ACCOUNT}:', 'role/x']]},
+                },
+            },
+        },
+    }
+
+    transformer = cross_account_transformer(PIPELINE_ACCOUNT, PIPELINE_ACCOUNT_NAME, get_code_bucket_name(PIPELINE_ACCOUNT), DEFAULT_DEPLOYMENT_REGION)
+    res = transformer.transform(template)
+
+    assert res['Parameters']['Boundary']['Default'] == 'arn:aws:iam::{{resolve:ssm:/mlops/dev/account_id}}:policy/{{resolve:ssm:/mlops/dev/account_name}}-pol_PlatformUserBoundary'
+    props = res['Resources']['Provider']['Properties']
+    assert props['Code'] == {'S3Bucket': get_code_bucket_name(PIPELINE_ACCOUNT), 'S3Key': 'custom-resource-provider-onevent.zip'}
+    assert props['Role']['Fn::Join'][1][1] == ':{{resolve:ssm:/mlops/dev/account_id}}:'
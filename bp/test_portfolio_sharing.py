@@ -0,0 +1,77 @@
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeSharingCatalog:
+    '''
+    servicecatalog client of a portfolio owner, sharing with accounts
+    '''
+
+    def __init__(self, shared):
+        self.shares = dict(shared)
+        self.calls = []
+        # shares not listed yet
+        self.hidden = set()
+
+    def describe_portfolio_shares(self, PortfolioId, Type, PageToken=None):
+        self.calls.append('describe_portfolio_shares')
+        accounts = sorted(a for a in self.shares if a not in self.hidden)
+        start = int(PageToken or 0)
+        page = {'PortfolioShareDetails': [{'PrincipalId': a, 'Type': Type, 'Accepted': self.shares[a]}
+                                          for a in accounts[start:start + 2]]}
+        if start + 2 < len(accounts):
+            page['NextPageToken'] = str(start + 2)
+        return page
+
+    def create_portfolio_share(self, PortfolioId, AccountId, ShareTagOptions):
+        self.calls.append('create_portfolio_share')
+        if AccountId == '555555555555':
+            raise ClientError({'Error': {'Code': 'InvalidParametersException', 'Message': 'not in the organization'}}, 'CreatePortfolioShare')
+        if AccountId in self.shares:
+            raise ClientError({'Error': {'Code': 'DuplicateResourceException', 'Message': 'already shared'}}, 'CreatePortfolioShare')
+        self.shares[AccountId] = False
+        # account shares are synchronous, only organization node shares return a PortfolioShareToken
+        return {}
+
+
+def test_portfolio_sharing():
+    '''
+    verify the shares are created once, a failed share doesn't stop the others, and only the new shares are accepted
+    '''
+    from utils.portfolio_sharing import PortfolioSharing
+
+    owner = FakeSharingCatalog({'111111111111': True, '222222222222': False, '333333333333': True})
+    accepted = []
+
+    class AcceptClient:
+        def __init__(self, account):
+            self.account = account
+
+        def accept_portfolio_share(self, PortfolioId, PortfolioShareType):
+            assert PortfolioShareType == 'IMPORTED'
+            accepted.append(self.account)
+
+    sharing = PortfolioSharing(owner, accept_client=AcceptClient)
+    with pytest.raises(ValueError):
+        sharing.share('port-1', ['111111111111', 'ou-abcd'])
+    assert owner.calls == []
+
+    accounts = ['111111111111', '222222222222', '444444444444', '555555555555', '444444444444']
+    results = sharing.share('port-1', accounts)
+
+    assert list(results) == ['111111111111', '222222222222', '444444444444', '555555555555']
+    assert [r.share for r in results.values()] == ['existing', 'existing', 'created', None]
+    assert [r.succeeded and r.accepted for r in results.values()] == [True, True, True, False]
+    assert results['555555555555'].error.response['Error']['Code'] == 'InvalidParametersException'
+    assert sorted(accepted) == ['222222222222', '444444444444']
+    assert owner.calls.count('create_portfolio_share') == 2
+    accounts.remove('555555555555')
+
+    # sharing again only accepts what is left, a share not listed yet counts as shared
+    owner.calls, accepted[:] = [], []
+    owner.shares = {a: True for a in owner.shares}
+    owner.shares['444444444444'] = False
+    owner.hidden = {'444444444444'}
+    results = sharing.share('port-1', accounts)
+    assert all(r.succeeded for r in results.values())
+    assert results['444444444444'].share == 'existing' and accepted == ['444444444444']
@@ -0,0 +1,28 @@
+def test_provision_harness():
+    '''
+    verify the product lifecycles run concurrently, and a failed stage stops its product only
+    '''
+    import threading
+    from utils.provision_harness import ProvisionHarness
+
+    # the first stages only get past the barrier when the three products run at the same time
+    barrier = threading.Barrier(3, timeout=10)
+
+    def provision():
+        barrier.wait()
+
+    def fail():
+        barrier.wait()
+        raise AssertionError("cfn creation completed")
+
+    harness = ProvisionHarness(max_concurrency=3)
+    runs = harness.run({
+        "autotest-prj1": [("provision_product", provision), ("wait_cfn", lambda: None)],
+        "autotest-arima": [("provision_product", provision), ("wait_cfn", lambda: None)],
+        "autotest-fna": [("provision_product", fail), ("wait_cfn", lambda: None)],
+    })
+    report = harness.report(runs)
+
+    assert [r.succeeded for r in runs] == [True, True, False]
+    assert [s.stage for s in runs[2].stages] == ["provision_product"]
+    assert [len(p['stages']) for p in report['products']] == [2, 2, 1]
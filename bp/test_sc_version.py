@@ -14,7 +14,7 @@ root = Path(__file__).parents[2]
 sys.path.insert(0, str(root))
 
 from mlops_sm_project_template_rt.pipeline_stack import CoreStage, ServiceCatalogStack
-from mlops_sm_project_template_rt.permission_boundary import PermissionBoundaryAspect
+from mlops_sm_project_template_rt.role_boundary import apply_permission_boundary
 from mlops_sm_project_template_rt.config.constants import (
     DEFAULT_DEPLOYMENT_REGION,
     PIPELINE_ACCOUNT,
@@ -88,23 +88,25 @@ def test_sc_stack(mgmt_dev_env):
 
     stage = cdk.App()
     stack = ServiceCatalogStack(stage, "MLOpsServiceCatalog", env=pipeline_env)
-    cdk.Aspects.of(stack).add(
-        PermissionBoundaryAspect(
-            f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
-        )
+    manifest = apply_permission_boundary(
+        stack, f"arn:aws:iam::{PIPELINE_ACCOUNT}:policy/{PIPELINE_ACCOUNT_NAME}-pol_PlatformUserBoundary"
     )
-    # after apply Aspect, verify the Permission Boundary is added
+    # after applying the visitor, verify the Permission Boundary is added to every role, all in the manifest
     template = assertions.Template.from_stack(stack)        
     res = template.to_json()['Resources']
-    roles = [item for item in res.values() if item['Type'] == 'AWS::IAM::Role']
+    roles = sorted(name for name, item in res.items() if item['Type'] == 'AWS::IAM::Role')
+    assert sorted(role['logical_id'] for role in manifest['roles']) == roles
     for role in roles:
-        assert "-pol_PlatformUserBoundary" in json.dumps(role)    
+        assert "-pol_PlatformUserBoundary" in json.dumps(res[role]['Properties']['PermissionsBoundary'])
 
     generated_template_path = stack.get_generated_template('Abalone')
     res = json.loads(open(generated_template_path).read())['Resources']
-    roles = [item for item in res.items() if item[1]['Type'] == 'AWS::IAM::Role']
+    roles = sorted(name for name, item in res.items() if item['Type'] == 'AWS::IAM::Role')
+    manifest = stack.get_boundary_manifest('Abalone')
+    assert len(roles) > 0
+    assert sorted(role['logical_id'] for role in manifest['roles']) == roles
     for role in roles:
-        assert "-pol_PlatformUserBoundary" in json.dumps(role), f"Role {role[0]} does not have permission boundary"    
+        assert "-pol_PlatformUserBoundary" in json.dumps(res[role]), f"Role {role} does not have permission boundary"
 
     pass
 
@@ -227,7 +229,7 @@ def new_get_sc_prod_version(name):
     else:
         return '0.0.1'
 
-def test_code_stack_staging_no_new_version(mgmt_staging_env):
+def test_code_stack_staging_no_new_version(mgmt_staging_env, tmp_path):
     '''
     when on dev, regardless newer version is available, the code stack use the local version
     '''
@@ -249,16 +251,16 @@ def test_code_stack_staging_no_new_version(mgmt_staging_env):
 
     # load the zip file, unzip it, and verify __version__.py exists
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall('/tmp')
-        with zipfile.ZipFile(f'/tmp/{template_name}-build_app.zip', 'r') as zip_ref:
-            zip_ref.extractall(f'/tmp/{template_name}-tmp')
+        zip_ref.extractall(tmp_path)
+        with zipfile.ZipFile(tmp_path / f'{template_name}-build_app.zip', 'r') as zip_ref:
+            zip_ref.extractall(tmp_path / f'{template_name}-tmp')
 
-    assert os.path.exists(f'/tmp/{template_name}-tmp/__version__.py')
+    assert os.path.exists(tmp_path / f'{template_name}-tmp' / '__version__.py')
     
     # verify the extracted version in __version__.py is the same as the version in the folder
     template_path = f'{Path(__file__).parents[2]}/templates'
     new_version = get_local_prod_version(template_path, template_name)
-    with open(f'/tmp/{template_name}-tmp/__version__.py', 'r') as f:
+    with open(tmp_path / f'{template_name}-tmp' / '__version__.py', 'r') as f:
         content = f.read()
         assert new_version in content
 
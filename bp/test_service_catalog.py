@@ -24,9 +24,15 @@ from mlops_sm_project_template_rt.config.constants import (
     DEV_ACCOUNT,
     get_code_bucket_name,
     CLIENT_DEV_ACCOUNT,
+    get_automation_role_arn,
 )
+from mlops_sm_project_template_rt.config.aws_clients import get_client
 
 from utils.shared import wait_for_pipeline
+from utils.waiters import wait_for, wait_for_stack, wait_for_pipeline_execution
+from utils.provision_harness import ProvisionHarness
+from utils.catalog_index import get_catalog_index
+from utils.portfolio_sharing import share_portfolio
 
 pp_name = "autotest-prj1"
 
@@ -50,14 +56,8 @@ def test_sgmkr_service_catalog_portfilio(mgmt_dev_env):
     """
     verify the Service Catalog portfilio is deployed to the dev account
     """
-    client = boto3.client("servicecatalog")
-
-    portfolios = client.list_portfolios()
-    pf_list = [
-        f
-        for f in portfolios["PortfolioDetails"]
-        if f["DisplayName"] == "SageMaker Organization Templates"
-    ]
+    catalog = get_catalog_index(get_client("servicecatalog"))
+    pf_list = catalog.portfolios("SageMaker Organization Templates")
 
     assert len(pf_list) == 1
 
@@ -78,6 +78,10 @@ def test_service_catalog_visible_to_sgmkr_studio(mgmt_dev_env):
     pass
 
 
+# provisioned next to pp_name (Abalone), see test_mgmt_provision_service_catalog
+E2E_PRODUCTS = ["autotest-arima", "autotest-fna"]
+
+
 def test_mgmt_provision_service_catalog(mgmt_dev_env):
     """
     provision the service catalog, and verify:
@@ -91,96 +95,138 @@ def test_mgmt_provision_service_catalog(mgmt_dev_env):
         f"--------------------------------------------------------------------------------"
     )
     print(f"1. test provision service catalog", flush=True)
-    caller_id = boto3.client("sts").get_caller_identity()
+    runs = provision_products([pp_name])
+    assert runs[0].succeeded, f"{pp_name} provisioning failed: {runs[0].error!r}"
+
+
+def test_mgmt_provision_all_products(mgmt_dev_env):
+    """
+    provision Arima and FNA concurrently, and verify each of them as
+    test_mgmt_provision_service_catalog does for Abalone
+    """
+    runs = provision_products(E2E_PRODUCTS)
+    failed = [f"{r.product}: {r.error!r}" for r in runs if not r.succeeded]
+    assert len(failed) == 0, f"provisioning failed: {failed}"
+
+
+def provision_products(pp_names, max_concurrency=3):
+    """
+    run the provisioning lifecycle of each product concurrently, and report the latency of each stage
+    """
+    caller_id = get_client("sts").get_caller_identity()
     caller_arn = caller_id.get("Arn")
     role = caller_arn.split("/")[1]
     act_id = caller_id.get("Account")
     caller_role_arn = f"arn:aws:iam::{act_id}:role/{role}"
 
-    print(f"2. {datetime.now()}: delete provisioned service catalog {pp_name}", flush=True)
-    status = delete_provisioned_sc(pp_name, act_id)
-
-    print(f"3. {datetime.now()}: delete {pp_name} complete, status = {status}", flush=True)
-    sc_client = boto3.client("servicecatalog")
-
-    portfolios = sc_client.list_portfolios()
-    pf_list = [
-        f
-        for f in portfolios["PortfolioDetails"]
-        if f["DisplayName"] == "SageMaker Organization Templates"
-    ]
+    catalog = get_catalog_index(get_client("servicecatalog"))
+    pf_list = catalog.portfolios("SageMaker Organization Templates")
     assert len(pf_list) == 1
     portfolio_id = pf_list[0]["Id"]
 
-    print(
-        f"4. {datetime.now()}: associating principal {caller_role_arn} to portfolio {portfolio_id}",
-        flush=True,
-    )
-    sc_prod, path_id = associate_principal(portfolio_id, caller_role_arn)
-    prod_id = sc_prod["ProductViewSummary"]["ProductId"]
+    harness = ProvisionHarness(max_concurrency=max_concurrency)
+    runs = harness.run({
+        name: provision_lifecycle(name, act_id, portfolio_id, caller_role_arn) for name in pp_names
+    })
+    harness.report(runs)
+    return runs
 
-    print(f"5. {datetime.now()}: start provision product {pp_name}", flush=True)
-    ret = sc_client.provision_product(
-        ProductId=prod_id,
-        ProvisionedProductName=pp_name,
-        ProvisioningArtifactId=sc_prod["ProvisioningArtifacts"][0]["Id"],
-        PathId=path_id,
-        ProvisioningParameters=[
-            {"Key": "SageMakerProjectId", "Value": pp_name},
-            {"Key": "SageMakerProjectName", "Value": pp_name},
-        ],
-    )
-    assert ret["RecordDetail"]["ProvisionedProductName"] == pp_name
-    assert ret["RecordDetail"]["ProvisionedProductType"] == "CFN_STACK"
-    pp_id = ret["RecordDetail"]["ProvisionedProductId"]
 
-    cfn_name = f"SC-{act_id}-{pp_id}"
-    status = wait_for_final_cfn_status(cfn_name)
-    print(
-        f"6. {datetime.now()}: cloudformation provision complete: ProvisionedProductId = {pp_id}, status = {status}",
-        flush=True,
-    )
-    assert status in [
-        "CREATE_COMPLETE",
-        "UPDATE_COMPLETE",
-        "IMPORT_COMPLETE",
-    ], "cfn creation completed"
-
-    status = wait_for_pipeline(f'{pp_name}-master', stage_name='TrainPipeline') #continue when train pipeline is deployed
-    assert status == 'Succeeded', 'master pipeline job completed'
-
-    status = wait_for_pipeline(f'{pp_name}-train', stage_name='RunSMPipeline')
-    print(f"7. {datetime.now()}: initial training job pipeline complete: status = {status}", flush=True)
-    if status != "Succeeded":
-        # the first time run is triggered by cfn provisioning, may fail as permissions not set yet, so retry
-        time.sleep(20)
-        pipeline_client = boto3.client("codepipeline")
-        pipeline_client.start_pipeline_execution(name=f"{pp_name}-train")
-        status = wait_for_pipeline(f"{pp_name}-train")
+def provision_lifecycle(pp_name, act_id, portfolio_id, caller_role_arn):
+    """
+    stages provisioning pp_name and verifying its pipelines, run in order by the ProvisionHarness
+    """
+    sc_client = get_client("servicecatalog")
+    state = {}
+
+    def delete_previous():
+        status = delete_provisioned_sc(pp_name, act_id)
+        print(f"   - {datetime.now()}: delete {pp_name} complete, status = {status}", flush=True)
+
+    def associate():
+        print(f"   - {datetime.now()}: associating principal {caller_role_arn} to portfolio {portfolio_id}", flush=True)
+        state["sc_prod"], state["path_id"] = associate_principal(portfolio_id, caller_role_arn, pp_name)
+
+    def provision():
+        sc_prod = state["sc_prod"]
+        ret = sc_client.provision_product(
+            ProductId=sc_prod["ProductViewSummary"]["ProductId"],
+            ProvisionedProductName=pp_name,
+            ProvisioningArtifactId=sc_prod["ProvisioningArtifacts"][0]["Id"],
+            PathId=state["path_id"],
+            ProvisioningParameters=[
+                {"Key": "SageMakerProjectId", "Value": pp_name},
+                {"Key": "SageMakerProjectName", "Value": pp_name},
+            ],
+        )
+        assert ret["ResponseMetadata"]["HTTPStatusCode"] == 200
+        assert ret["RecordDetail"]["ProvisionedProductName"] == pp_name
+        assert ret["RecordDetail"]["ProvisionedProductType"] == "CFN_STACK"
+        state["pp_id"] = ret["RecordDetail"]["ProvisionedProductId"]
+
+    def wait_cfn():
+        cfn_name = f"SC-{act_id}-{state['pp_id']}"
+        status = wait_for_final_cfn_status(cfn_name)
+        print(
+            f"   - {datetime.now()}: cloudformation provision complete: ProvisionedProductId = {state['pp_id']}, status = {status}",
+            flush=True,
+        )
+        assert status in [
+            "CREATE_COMPLETE",
+            "UPDATE_COMPLETE",
+            "IMPORT_COMPLETE",
+        ], "cfn creation completed"
+
+    def wait_master_pipeline():
+        status = wait_for_pipeline(f'{pp_name}-master', stage_name='TrainPipeline') #continue when train pipeline is deployed
+        assert status == 'Succeeded', 'master pipeline job completed'
+
+    def wait_train_pipeline():
+        status = wait_for_pipeline(f'{pp_name}-train', stage_name='RunSMPipeline')
+        print(f"   - {datetime.now()}: {pp_name} initial training job pipeline complete: status = {status}", flush=True)
+        if status != "Succeeded":
+            # the first time run is triggered by cfn provisioning, may fail as permissions not set yet, so retry
+            time.sleep(20)
+            pipeline_client = get_client("codepipeline")
+            pipeline_client.start_pipeline_execution(name=f"{pp_name}-train")
+            status = wait_for_pipeline(f"{pp_name}-train")
+            print(
+                f"   - {datetime.now()}: {pp_name} second training job pipeline complete: status = {status}", flush=True
+            )
+
+        assert status == "Succeeded", "training job completed"
+
+    def check_model_package():
+        # verify that the model package is created
+        mgp_name = f"{pp_name}-model-group"
+        sgmkr_client = get_client("sagemaker")
+        pkgs = sgmkr_client.list_model_packages(ModelPackageGroupName=mgp_name)
+        assert len(pkgs["ModelPackageSummaryList"]) == 1, "model package created"
+        pkg = sgmkr_client.describe_model_package(
+            ModelPackageName=pkgs["ModelPackageSummaryList"][0]["ModelPackageArn"]
+        )
+        assert (
+            pkg["ModelApprovalStatus"] == "PendingManualApproval"
+        ), "model package is approved"
         print(
-            f"8. {datetime.now()}: second training job pipeline complete: status = {status}", flush=True
+            f"   - {datetime.now()}: verified mpg {mgp_name} is created and is in PendingManualApproval",
+            flush=True,
         )
 
-    assert status == "Succeeded", "training job completed"
+    return [
+        ("delete_previous", delete_previous),
+        ("associate_principal", associate),
+        ("provision_product", provision),
+        ("wait_cfn", wait_cfn),
+        ("wait_master_pipeline", wait_master_pipeline),
+        ("wait_train_pipeline", wait_train_pipeline),
+        ("check_model_package", check_model_package),
+    ]
+
 
-    # verify that the model package is created
-    mgp_name = f"{pp_name}-model-group"
-    sgmkr_client = boto3.client("sagemaker")
-    pkgs = sgmkr_client.list_model_packages(ModelPackageGroupName=mgp_name)
-    assert len(pkgs["ModelPackageSummaryList"]) == 1, "model package created"
-    pkg = sgmkr_client.describe_model_package(
-        ModelPackageName=pkgs["ModelPackageSummaryList"][0]["ModelPackageArn"]
-    )
-    assert (
-        pkg["ModelApprovalStatus"] == "PendingManualApproval"
-    ), "model package is approved"
-    print(
-        f"9. {datetime.now()}: verified mpg {mgp_name} is created and is in PendingManualApproval",
-        flush=True,
-    )
 
 
-def test_client_access_seeds3(client_dev_env):
+def test_client_access_seeds3(client_dev_env, tmp_path):
     """
     verify that client account can access the seed repo in s3 in magmt account
     """
@@ -195,7 +241,7 @@ def test_client_access_seeds3(client_dev_env):
     )
     assert ret["ContentLength"] > 5000
 
-    with open("/tmp/delete-me.zip", "wb") as f:
+    with open(tmp_path / "delete-me.zip", "wb") as f:
         s3_client.download_fileobj(
             get_code_bucket_name(pipeline_account_id), file_name, f
         )
@@ -205,25 +251,23 @@ def test_client_access_seeds3(client_dev_env):
 # @pytest.mark.skip('to be completed')
 def test_service_catalog_share(mgmt_dev_env):
     """
-    test the service catalog share
-    """
-    client = boto3.client("servicecatalog")
+    test the service catalog share with the client dev account
 
-    portfolios = client.list_portfolios()
-    pf_list = [
-        f
-        for f in portfolios["PortfolioDetails"]
-        if f["DisplayName"] == "SageMaker Organization Templates"
-    ]
+    the rollout to all the client accounts is python -m utils.portfolio_sharing
+    """
+    client = get_client("servicecatalog")
+    catalog = get_catalog_index(client)
 
+    pf_list = catalog.portfolios("SageMaker Organization Templates")
     assert len(pf_list) == 1
 
-    ret = client.create_portfolio_share(
-        PortfolioId=pf_list[0]["Id"], AccountId=CLIENT_DEV_ACCOUNT, ShareTagOptions=True
-    )
+    def accept_client(act_id):
+        return get_client("servicecatalog", role_arn=get_automation_role_arn(act_id))
 
-    assert ret["ResponseMetadata"]["HTTPStatusCode"] == 200
-    pass
+    results = share_portfolio(client, pf_list[0]["Id"], [CLIENT_DEV_ACCOUNT], accept_client)
+    print(f"   - {datetime.now()}: share with {CLIENT_DEV_ACCOUNT}: {results[CLIENT_DEV_ACCOUNT].to_dict()}", flush=True)
+
+    assert results[CLIENT_DEV_ACCOUNT].succeeded
 
 
 def wait_for_final_cfn_status(cfn_name, _cfn_client=None):
@@ -233,15 +277,11 @@ def wait_for_final_cfn_status(cfn_name, _cfn_client=None):
     """
     print(f"   - {datetime.now()}: waiting for cfn {cfn_name} to complete", flush=True)
     if _cfn_client is None:
-        _cfn_client = boto3.client("cloudformation")
+        _cfn_client = get_client("cloudformation")
 
     try:
-        while True:
-            time.sleep(10)
-            res = _cfn_client.describe_stacks(StackName=cfn_name)
-            if not res["Stacks"][0]["StackStatus"].endswith("_IN_PROGRESS"):
-                break
-        ret = res["Stacks"][0]["StackStatus"]
+        # backs off between checks, and streams the stack events meanwhile
+        ret = wait_for_stack(_cfn_client, cfn_name)
     except ClientError as e:
         print(f"   - {datetime.now()} : cfn {cfn_name} exception = {e}", flush=True)
         ret = "DELETE_COMPLETE"  # Stack does not exist
@@ -256,7 +296,7 @@ def delete_provisioned_sc(pp_name, act_id):
     delete the already provisioned service catalog, so we can repeat the
     test
     """
-    sc_client = boto3.client("servicecatalog")
+    sc_client = get_client("servicecatalog")
     try:
         desc = sc_client.describe_provisioned_product(Name=pp_name)
     except sc_client.exceptions.ResourceNotFoundException as e:
@@ -297,7 +337,7 @@ def assert_child_stacks_deleted(pp_name=pp_name):
     assert that all child pipeline stacks are deleted
     '''
 
-    cfn_client = boto3.client("cloudformation")
+    cfn_client = get_client("cloudformation")
     children = ['build', 'train', 'deploy']
     for child in children:
         stack_name = f'{pp_name}-{child}-pipeline'
@@ -341,28 +381,17 @@ def delete_model_packages(pp_name, append_model_group_name=True):
 
     """
     mgp_name = f"{pp_name}-model-group" if append_model_group_name else pp_name
+    from lambda_code.lambda_cleanup_code.cleanup_engine import CleanupEngine
+
     sgmkr_client = boto3.client("sagemaker")
     print(
         f"   - delete all model packages from Model Package Group: {mgp_name}",
     )
 
-    pkgs = sgmkr_client.list_model_packages(ModelPackageGroupName=mgp_name)
-    pkgs = []
-    extra_args = {}
-    while True:
-        res = sgmkr_client.list_model_packages(
-            ModelPackageGroupName=mgp_name, **extra_args
-        )
-        pkgs += res["ModelPackageSummaryList"]
-
-        if "NextToken" in res:
-            extra_args["NextToken"] = res["NextToken"]
-        else:
-            break
-
-    for pkg in pkgs:
-        ret = sgmkr_client.delete_model_package(ModelPackageName=pkg["ModelPackageArn"])
-        pass
+    # the packages are listed page by page and deleted concurrently
+    engine = CleanupEngine(sm_client=sgmkr_client)
+    engine.run(mpg_name=mgp_name)
+    assert len(engine.errors) == 0, f"model packages not deleted: {engine.errors}"
 
     return
 
@@ -399,12 +428,11 @@ def associate_principal(portfolio_id, caller_role_arn, pp_name='Abalone'):
     """
     associate the caller role to the service catalog product
     """
-    sc_client = boto3.client("servicecatalog")
+    sc_client = get_client("servicecatalog")
 
     ret = sc_client.associate_principal_with_portfolio(
         PortfolioId=portfolio_id, PrincipalType="IAM", PrincipalARN=caller_role_arn
     )
-    time.sleep(10)
 
     if 'fna' in pp_name:
         template_name = 'FNA'
@@ -412,18 +440,16 @@ def associate_principal(portfolio_id, caller_role_arn, pp_name='Abalone'):
         template_name = 'Arima'
     else:
         template_name = 'Abalone'
-    sc_prod = sc_client.describe_product(Name=template_name)
+    catalog = get_catalog_index(sc_client)
+    sc_prod = catalog.describe_product(template_name)
     assert sc_prod is not None
     assert len(sc_prod["ProvisioningArtifacts"]) == 1
     prod_id = sc_prod["ProductViewSummary"]["ProductId"]
 
-    paginator = sc_client.get_paginator("list_launch_paths")
-    response_iterator = paginator.paginate(ProductId=prod_id)
-
-    path_list = [item for item in response_iterator]
+    # the association takes a few seconds to propagate, until then the product has no launch path
+    path_list = wait_for(lambda: catalog.launch_paths(prod_id) or None, timeout=120, initial=1, maximum=10)
     assert len(path_list) > 0
-    assert len(path_list[0]["LaunchPathSummaries"]) > 0
-    path_id = path_list[0]["LaunchPathSummaries"][0]["Id"]
+    path_id = path_list[0]["Id"]
 
     return sc_prod, path_id
 
@@ -451,14 +477,10 @@ def verify_batch_transform(sm_client=None, pp_name=pp_name, pipeline_name=None):
             PipelineName=transform_pipeline[0]["PipelineName"]
         )
         # wait for the pipeline to complete
-        while True:
-            desc = _sm.describe_pipeline_execution(
-                PipelineExecutionArn=ret["PipelineExecutionArn"]
-            )
-            if desc["PipelineExecutionStatus"] in ["Executing", "Stopping"]:
-                time.sleep(10)
-            else:
-                break
+        wait_for_pipeline_execution(_sm, ret["PipelineExecutionArn"])
+        desc = _sm.describe_pipeline_execution(
+            PipelineExecutionArn=ret["PipelineExecutionArn"]
+        )
         print(
             f"     - pipeline: {pipeline_name} result = {desc['PipelineExecutionStatus']}",
             flush=True,
@@ -539,4 +561,4 @@ def test_codepipeline_stack_deletion(client_dev_env):
 
     handler(payload, None)
 
-    pass
\ No newline at end of file
+    pass
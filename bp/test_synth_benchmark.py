@@ -0,0 +1,206 @@
+'''
+Offline synth benchmarks of ServiceCatalogStack, SharedCodeStack and CoreStage.
+
+The stacks are synthesized against synthetic template trees of 1, 10 and 50 products, with Service
+Catalog served by a botocore Stubber, so no account or credentials are needed. Each case reports
+its synth latency, peak python memory and AWS API call count, and is compared against the baseline
+committed in synth_benchmark_baseline.json.
+
+The API call counts don't depend on the machine, and are gated everywhere. They are one
+list_portfolios and one search_products_as_admin call for the sweep of the portfolio, plus one
+list_provisioning_artifacts call per product: Service Catalog has no batch listing of the artifacts.
+Latency and memory do depend on the machine, so the committed baseline leaves them out: they are
+only gated once recorded in the baseline, on the machine running the benchmarks (e.g. the CI runner).
+
+These are slow, run them with:
+    pytest test_synth_benchmark.py --run-benchmarks
+and record a new baseline with --update-benchmark-baseline. This merges the cases that ran into the
+committed baseline, the other cases (e.g. when selecting some with -k) are kept.
+'''
+
+import pytest
+import boto3
+from botocore.stub import Stubber
+from datetime import datetime
+
+import os, json, time, tracemalloc
+import aws_cdk as cdk
+from aws_cdk import assertions
+from pathlib import Path
+
+from mlops_sm_project_template_rt.pipeline_stack import CoreStage, ServiceCatalogStack
+from mlops_sm_project_template_rt.shared_code_stack import SharedCodeStack
+from mlops_sm_project_template_rt.config import aws_clients
+from mlops_sm_project_template_rt.config.sc_version_resolver import reset_version_resolver
+from mlops_sm_project_template_rt.synth_profiler import profiler
+from mlops_sm_project_template_rt.config.constants import (
+    DEFAULT_DEPLOYMENT_REGION,
+    PIPELINE_ACCOUNT,
+)
+
+pipeline_env = cdk.Environment(account=PIPELINE_ACCOUNT, region=DEFAULT_DEPLOYMENT_REGION)
+
+BASELINE_PATH = Path(__file__).parent / 'synth_benchmark_baseline.json'
+PRODUCT_COUNTS = [1, 10, 50]
+# allowed slow down against the baseline before the benchmark fails
+TOLERANCE = float(os.environ.get('MLOPS_BENCHMARK_TOLERANCE', '0.25'))
+# list_portfolios and search_products_as_admin, the calls not made per product
+SWEEP_CALLS = 2
+
+STACK_SOURCE = '''
+from aws_cdk import Stack, Tags, aws_s3 as s3, aws_iam as iam
+
+
+class {name}Stack(Stack):
+
+    @staticmethod
+    def description():
+        return "synthetic benchmark product {name}"
+
+    def __init__(self, scope, construct_id, version="0.0.1", **kwargs):
+        super().__init__(scope, construct_id, **kwargs)
+        bucket = s3.Bucket(self, "Bucket")
+        role = iam.Role(self, "Role", assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"))
+        bucket.grant_read_write(role)
+        Tags.of(self).add("version", version)
+'''
+
+pytestmark = pytest.mark.skipif("not config.getoption('run_benchmarks')", reason="run with --run-benchmarks")
+
+
+def create_template_tree(root, product_count):
+    '''
+    create product_count synthetic products, each with a stack, a version and seed code
+    '''
+    for i in range(product_count):
+        # unique names per tree size, the product packages are imported by name
+        name = f'Bench{product_count}P{i:03d}'
+        product_dir = root / name
+        (product_dir / 'seed_code' / 'build_app').mkdir(parents=True)
+        (product_dir / '__init__.py').write_text('')
+        (product_dir / f'{name}Stack.py').write_text(STACK_SOURCE.format(name=name))
+        (product_dir / '__version__.py').write_text('version = "1.0.0"\n')
+        (product_dir / 'seed_code' / 'build_app' / 'run.py').write_text(f'print("{name}")\n' * 200)
+    return root
+
+
+def stub_service_catalog(product_count):
+    '''
+    servicecatalog client answering the version sweep with the synthetic products deployed at 0.0.1
+    '''
+    client = boto3.session.Session(
+        aws_access_key_id='testing', aws_secret_access_key='testing', region_name=DEFAULT_DEPLOYMENT_REGION
+    ).client('servicecatalog')
+    stubber = Stubber(client)
+    stubber.add_response('list_portfolios', {'PortfolioDetails': [
+        {'Id': 'port-000000001', 'DisplayName': 'SageMaker Organization Templates'}
+    ]})
+    stubber.add_response('search_products_as_admin', {'ProductViewDetails': [
+        {'ProductViewSummary': {'Name': f'Bench{product_count}P{i:03d}', 'ProductId': f'prod-{i:09d}'}}
+        for i in range(product_count)
+    ]})
+    for i in range(product_count):
+        stubber.add_response('list_provisioning_artifacts', {'ProvisioningArtifactDetails': [
+            {'Id': f'pa-{i:09d}', 'Name': '0.0.1', 'CreatedTime': datetime(2023, 1, 1), 'Active': True}
+        ]})
+    stubber.activate()
+    return client
+
+
+@pytest.fixture
+def offline_aws(monkeypatch, tmp_path):
+    '''
+    isolate the benchmark from the real accounts, and from the persistent synth caches
+    '''
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    monkeypatch.delenv("AWS_REGION", raising=False)
+    monkeypatch.setenv("AWS_DEFAULT_REGION", DEFAULT_DEPLOYMENT_REGION)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("MLOPS_SYNTH_CACHE", "0")
+    monkeypatch.setenv("MLOPS_SYNTH_CACHE_DIR", str(tmp_path / 'cache'))
+    aws_clients.clear()
+    reset_version_resolver()
+    profiler.enable()
+    profiler.reset()
+    yield
+    profiler.disable()
+    profiler.reset()
+    aws_clients.clear()
+    reset_version_resolver()
+
+
+def build_service_catalog_stack():
+    stack = ServiceCatalogStack(cdk.App(), "MLOpsServiceCatalog", env=pipeline_env)
+    assertions.Template.from_stack(stack)
+
+
+def build_shared_code_stack():
+    stack = SharedCodeStack(cdk.App(), "MLOpsSharedCode", env=pipeline_env)
+    assertions.Template.from_stack(stack)
+
+
+def build_core_stage():
+    stage = CoreStage(cdk.App(), "DEV", env=pipeline_env)
+    assertions.Template.from_stack(stage.shared_code_stack)
+
+
+BUILDERS = {
+    'ServiceCatalogStack': build_service_catalog_stack,
+    'SharedCodeStack': build_shared_code_stack,
+    'CoreStage': build_core_stage,
+}
+
+
+@pytest.fixture(scope="module")
+def benchmark_results(pytestconfig):
+    '''
+    collect the results of all cases, and merge them into the baseline with --update-benchmark-baseline
+    '''
+    results = {}
+    yield results
+
+    if pytestconfig.getoption('update_benchmark_baseline') and len(results) > 0:
+        baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+        baseline.update(results)
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f'benchmark baseline written to {BASELINE_PATH}: {sorted(results)} updated')
+
+
+@pytest.mark.parametrize("product_count", PRODUCT_COUNTS)
+@pytest.mark.parametrize("stack_name", list(BUILDERS))
+def test_synth_benchmark(stack_name, product_count, offline_aws, tmp_path, monkeypatch, benchmark_results, pytestconfig):
+    templates_root = create_template_tree(tmp_path / 'templates', product_count)
+    monkeypatch.setenv("MLOPS_TEMPLATES_ROOT", str(templates_root))
+    aws_clients.register_client('servicecatalog', stub_service_catalog(product_count))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    BUILDERS[stack_name]()
+    latency = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report = profiler.to_dict()
+    result = {
+        'latency_s': round(latency, 3),
+        'peak_python_mb': round(peak / 1024 / 1024, 1),
+        'api_calls': sum(report['api_calls'].values()),
+    }
+    case = f'{stack_name}-{product_count}'
+    benchmark_results[case] = result
+    print(f'{case}: {result}')
+
+    if pytestconfig.getoption('update_benchmark_baseline'):
+        return
+    baseline = json.loads(BASELINE_PATH.read_text()).get(case) if BASELINE_PATH.exists() else None
+    if baseline is None:
+        pytest.fail(f'{case} is not in {BASELINE_PATH.name}, record it with --update-benchmark-baseline')
+    # the version sweep goes through the stub, no calls means they are not counted
+    assert 0 < result['api_calls'] <= baseline['api_calls'], f"{case}: {result['api_calls']} api calls, baseline {baseline['api_calls']}"
+    # at most one call per product, whatever the baseline says
+    assert result['api_calls'] <= product_count + SWEEP_CALLS, f"{case}: {result['api_calls']} api calls for {product_count} products"
+    if 'latency_s' in baseline:
+        assert result['latency_s'] <= baseline['latency_s'] * (1 + TOLERANCE), f"{case}: synth took {result['latency_s']}s, baseline {baseline['latency_s']}s"
+    if 'peak_python_mb' in baseline:
+        assert result['peak_python_mb'] <= baseline['peak_python_mb'] * (1 + TOLERANCE), f"{case}: peak {result['peak_python_mb']} MB, baseline {baseline['peak_python_mb']} MB"
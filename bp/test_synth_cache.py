@@ -0,0 +1,43 @@
+import json
+
+
+def test_synth_cache_key(monkeypatch, tmp_path):
+    '''
+    verify the cache key changes with the CDK libraries and the CDK context of the synth
+    '''
+    from mlops_sm_project_template_rt import synth_cache
+
+    source_dir = tmp_path / 'Demo'
+    source_dir.mkdir()
+    (source_dir / 'DemoStack.py').write_text('VERSION = "1"\n')
+    cache = synth_cache.SynthCache(cache_dir=str(tmp_path / 'cache'), enabled=True)
+
+    def key(**kwargs):
+        return cache.key([str(source_dir)], 'Demo-dev', '1.0.0', '111111111111', 'arn:boundary', 'eu-west-1', **kwargs)
+
+    context = {'vpc-provider:account=111111111111': {'vpcId': 'vpc-0abc'}, '@aws-cdk/core:flag': True}
+    assert key(context=context) == key(context=dict(reversed(context.items())))
+    assert key(context=context) != key(context={**context, 'vpc-provider:account=111111111111': {'vpcId': 'vpc-0def'}})
+    assert key() != key(context=context)
+
+    default_key = key()
+    monkeypatch.setattr(synth_cache, 'cdk_version', lambda: 'aws-cdk-lib==0.0.0 constructs==0.0.0 jsii==0.0.0')
+    assert key() != default_key
+
+
+def test_synth_cache_missing_context(tmp_path):
+    '''
+    verify a template synthesized with missing context is not cached
+    '''
+    from mlops_sm_project_template_rt.synth_cache import SynthCache, write_missing_context
+
+    cache = SynthCache(cache_dir=str(tmp_path / 'cache'), enabled=True)
+    template_path = tmp_path / 'Demo-dev_processed.json'
+    template_path.write_text(json.dumps({'Resources': {}}))
+
+    cached_path = cache.put('Demo-dev', 'a' * 64, str(template_path))
+    assert cached_path != str(template_path) and cache.get('Demo-dev', 'a' * 64) == cached_path
+
+    write_missing_context(str(template_path), [{'key': 'vpc-provider:account=111111111111', 'provider': 'vpc-provider'}])
+    assert cache.put('Demo-dev', 'b' * 64, str(template_path)) == str(template_path)
+    assert cache.get('Demo-dev', 'b' * 64) is None
@@ -0,0 +1,64 @@
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+
+
+class FakeCloudFormation:
+    '''
+    stack moving through the given (resource, status) events, one event per describe call
+    '''
+
+    def __init__(self, stack_name, events):
+        self.stack_name = stack_name
+        self.pending = list(events)
+        self.events = []
+        self.calls = []
+
+    def _advance(self):
+        if len(self.pending) > 0:
+            logical_id, status = self.pending.pop(0)
+            resource_type = 'AWS::CloudFormation::Stack' if logical_id == self.stack_name else 'AWS::S3::Bucket'
+            self.events.insert(0, {'EventId': str(len(self.events)), 'Timestamp': datetime.now(), 'LogicalResourceId': logical_id,
+                                   'ResourceType': resource_type, 'ResourceStatus': status})
+
+    def describe_stack_events(self, StackName):
+        self.calls.append('describe_stack_events')
+        self._advance()
+        return {'StackEvents': list(self.events)}
+
+    def get_paginator(self, operation_name):
+        return SimpleNamespace(paginate=lambda StackName: iter([self.describe_stack_events(StackName)]))
+
+    def describe_stacks(self, StackName):
+        self.calls.append('describe_stacks')
+        return {'Stacks': [{'StackStatus': self.events[0]['ResourceStatus'] if len(self.events) > 0 else 'CREATE_IN_PROGRESS'}]}
+
+
+def test_waiter_backoff():
+    '''
+    verify the waiter streams the stack events, backs off between checks, and gives up at the deadline
+    '''
+    from utils.waiters import Poller, WaitTimeout, stack_status_check
+
+    stack_name = 'SC-autotest'
+    cfn = FakeCloudFormation(stack_name, [(stack_name, 'CREATE_IN_PROGRESS'), ('Bucket', 'CREATE_IN_PROGRESS'),
+                                          ('Bucket', 'CREATE_COMPLETE'), (stack_name, 'CREATE_COMPLETE')])
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    printed = []
+    poller = Poller(timeout=600, clock=lambda: now[0], sleep=sleep, initial=2, maximum=8, jitter=0)
+    poller.add(stack_name, stack_status_check(cfn, stack_name, printer=printed.append))
+    assert poller.run() == {stack_name: 'CREATE_COMPLETE'}
+    assert sleeps == [2, 4, 8]
+    assert cfn.calls.count('describe_stacks') == 1
+    assert len(printed) == 3
+
+    poller = Poller(timeout=10, clock=lambda: now[0], sleep=sleep, initial=2, maximum=8, jitter=0)
+    poller.add('never', lambda: None)
+    with pytest.raises(WaitTimeout):
+        poller.run()
@@ -0,0 +1,150 @@
+'''
+Local versions of the products, and semantic comparison of versions.
+
+Each template folder holds a __version__.py with a single `version = "x.y.z"` assignment. The files
+are parsed with ast rather than imported, so no template module is executed (nor needs to be on
+sys.path) to learn its version, and a file that does not hold a plain version string is rejected.
+Parsed versions are kept in an index for the whole synth, and re-read only when the file changes.
+
+Versions compare by their numeric components, not as strings: '10.0' > '9.9', and '1.0' == '1.0.0'.
+A suffix marks a pre-release, lower than the release itself: '1.0.0rc1' < '1.0.0', its numbers
+compare as numbers too: '1.0.0rc2' < '1.0.0rc10'.
+
+The deployed versions are the names of the provisioning artifacts, which nothing validates: an
+artifact name that is not a version sorts below every valid version, rather than failing the synth.
+'''
+
+import ast
+import functools
+import os
+import re
+import threading
+
+VERSION_NAMES = ('version', '__version__')
+
+_VERSION_RE = re.compile(r'^v?(\d+(?:\.\d+)*)(.*)$')
+_SUFFIX_PART_RE = re.compile(r'\d+|[^\d.\-_]+')
+
+
+@functools.total_ordering
+class Version:
+    '''
+    a product version, e.g. '1.2.3' or '1.0.0rc1'
+
+    with strict=False, a value that is not a version is kept as an invalid version (valid is False),
+    lower than any valid one
+    '''
+
+    def __init__(self, value, strict=True):
+        self.text = str(value).strip()
+        match = _VERSION_RE.match(self.text)
+        self.valid = match is not None
+        if not self.valid:
+            if strict:
+                raise ValueError(f'invalid version: {value!r}')
+            self.release, self.suffix = (), self.text
+            return
+        release = [int(part) for part in match.group(1).split('.')]
+        # trailing zeros don't count: 1.0 == 1.0.0
+        while len(release) > 1 and release[-1] == 0:
+            release.pop()
+        self.release = tuple(release)
+        self.suffix = match.group(2).lstrip('.-_')
+
+    def _key(self):
+        # the numbers of the suffix compare as numbers: rc2 < rc10
+        suffix = tuple((1, int(p), '') if p.isdigit() else (0, 0, p) for p in _SUFFIX_PART_RE.findall(self.suffix))
+        # a release sorts after its pre-releases
+        return (self.valid, self.release, self.valid and self.suffix == '', suffix)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Version, str)):
+            return NotImplemented
+        return self._key() == parse_version(other)._key()
+
+    def __lt__(self, other):
+        if not isinstance(other, (Version, str)):
+            return NotImplemented
+        return self._key() < parse_version(other)._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'Version({self.text!r})'
+
+
+def parse_version(value, strict=True):
+    '''
+    return value as a Version, raises ValueError when it is not a version, unless strict is False
+    '''
+    return value if isinstance(value, Version) else Version(value, strict)
+
+
+def is_newer(new_version, current_version):
+    '''
+    True when new_version is strictly higher than current_version, the deployed version
+
+    a current_version that is not a version is lower than any version
+    '''
+    return parse_version(new_version) > parse_version(current_version, strict=False)
+
+
+def read_version_file(version_path):
+    '''
+    return the version string assigned in version_path, without executing the file
+
+    raises ValueError when the file has no `version = "x.y.z"` assignment, or holds an invalid version
+    '''
+    with open(version_path, 'r') as f:
+        tree = ast.parse(f.read(), filename=version_path)
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets = [node.target]
+        else:
+            continue
+        if not any(isinstance(t, ast.Name) and t.id in VERSION_NAMES for t in targets):
+            continue
+        if not isinstance(node.value, ast.Constant) or not isinstance(node.value.value, str):
+            raise ValueError(f'{version_path}: the version must be a string literal')
+        version = node.value.value
+        parse_version(version)
+        return version
+
+    raise ValueError(f'{version_path}: no version assignment found')
+
+
+class VersionIndex:
+    '''
+    versions read from the __version__.py files, cached by path and refreshed when a file changes
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, version_path):
+        st = os.stat(version_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._versions.get(version_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        version = read_version_file(version_path)
+        with self._lock:
+            self._versions[version_path] = (stamp, version)
+        return version
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+
+version_index = VersionIndex()
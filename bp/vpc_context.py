@@ -0,0 +1,271 @@
+'''
+Pre-warmed context of the VPC lookups of the product templates (see constants.get_vpc_info).
+
+Vpc.from_lookup reads the VPC from the CDK context. When cdk.context.json has no entry for it, the
+first synth returns a dummy VPC (vpc-12345) and records the lookup as missing, the CDK CLI then
+queries the account and synthesizes everything a second time. Every fresh CodeBuild container pays
+for that.
+
+Pre-warming runs the lookups of all the configured accounts in one step, before the real synth:
+
+    python -m mlops_sm_project_template_rt.config.vpc_context
+
+builds the product stacks of every account in a throwaway app, collects the missing context of its
+assembly, resolves the VPC lookups concurrently with ec2 (through the CDK lookup role of each
+account) and writes them to cdk.context.json, in the format the CDK VPC provider uses. With
+MLOPS_VPC_CONTEXT_STRICT=1 (or the 'mlops:vpc_context_strict' context), a synth then fails right
+away on a VPC lookup missing from the context, rather than falling back to the second synth.
+'''
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import path, listdir
+from pathlib import Path
+
+from mlops_sm_project_template_rt.config.accounts import CODE_BUCKET_ACCOUNTS
+
+VPC_PROVIDER = 'vpc-provider'
+# vpc id of the dummy VPC returned by Vpc.from_lookup while the lookup is missing from the context
+DUMMY_VPC_ID = 'vpc-12345'
+
+STRICT_ENV = 'MLOPS_VPC_CONTEXT_STRICT'
+STRICT_CONTEXT = 'mlops:vpc_context_strict'
+# set on the throwaway app of the pre-warm, which has to get past the missing lookups
+PREWARM_CONTEXT = 'mlops:vpc_context_prewarm'
+
+SUBNET_TYPE_TAG = 'aws-cdk:subnet-type'
+SUBNET_NAME_TAG = 'aws-cdk:subnet-name'
+
+
+class MissingContextError(RuntimeError):
+    '''
+    a lookup is missing from the CDK context, and can't be resolved
+    '''
+
+
+def is_strict(scope):
+    if scope.node.try_get_context(PREWARM_CONTEXT):
+        return False
+    strict = os.environ.get(STRICT_ENV, scope.node.try_get_context(STRICT_CONTEXT))
+    return str(strict).lower() in ('1', 'true', 'yes', 'on')
+
+
+def check_vpc_lookup(scope, vpc, description):
+    '''
+    in strict mode, fail when the VPC looked up under scope is the dummy VPC of a missing lookup
+    '''
+    if vpc.vpc_id == DUMMY_VPC_ID and is_strict(scope):
+        raise MissingContextError(
+            f'{scope.node.path}: the VPC lookup {description} is not in cdk.context.json, '
+            f'pre-warm it with: python -m mlops_sm_project_template_rt.config.vpc_context'
+        )
+
+
+def load_context(context_path):
+    if not path.isfile(context_path):
+        return {}
+    with open(context_path, 'r') as f:
+        return json.load(f)
+
+
+def save_context(context_path, context):
+    tmp_path = f'{context_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(context, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp_path, context_path)
+
+
+def missing_context(assembly):
+    '''
+    the lookups missing from the context of the synthesized cloud assembly: [{key, provider, props}]
+    '''
+    with open(path.join(assembly.directory, 'manifest.json'), 'r') as f:
+        return json.load(f).get('missing', [])
+
+
+def _tag(tags, key):
+    for tag in tags or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def _paginate(ec2_client, operation_name, key, **kwargs):
+    items = []
+    for page in ec2_client.get_paginator(operation_name).paginate(**kwargs):
+        items += page[key]
+    return items
+
+
+def _subnet_type(subnet, table):
+    # in the order of the CDK VPC context provider: tag, public IP on launch, then the routes of the subnet
+    subnet_type = _tag(subnet.get('Tags'), SUBNET_TYPE_TAG)
+    if subnet_type is not None:
+        return subnet_type
+    if subnet.get('MapPublicIpOnLaunch'):
+        return 'Public'
+    routes = table.get('Routes', []) if table is not None else []
+    if any(r.get('GatewayId', '').startswith('igw-') for r in routes):
+        return 'Public'
+    if any(r.get('NatGatewayId') is not None for r in routes):
+        return 'Private'
+    if any(r.get('TransitGatewayId') is not None for r in routes):
+        return 'Private'
+    return 'Isolated'
+
+
+def resolve_vpc(props, ec2_client):
+    '''
+    resolve a vpc-provider lookup the way the CDK VPC context provider does, with asymmetric subnets
+
+    Returns:
+        [dict]: the context value of the lookup
+    '''
+    if not props.get('returnAsymmetricSubnets'):
+        raise MissingContextError(f'only asymmetric subnet lookups are supported: {props}')
+
+    filters = [{'Name': name, 'Values': [value]} for name, value in sorted(props['filter'].items())]
+    vpcs = _paginate(ec2_client, 'describe_vpcs', 'Vpcs', Filters=filters)
+    if len(vpcs) != 1:
+        raise MissingContextError(f"found {len(vpcs)} VPCs matching {props['filter']} in {props['account']}/{props['region']}")
+    vpc = vpcs[0]
+    vpc_filter = [{'Name': 'vpc-id', 'Values': [vpc['VpcId']]}]
+
+    route_tables = _paginate(ec2_client, 'describe_route_tables', 'RouteTables', Filters=vpc_filter)
+    main_table = next((t for t in route_tables if any(a.get('Main') for a in t.get('Associations', []))), None)
+    subnet_tables = {a['SubnetId']: t for t in route_tables for a in t.get('Associations', []) if 'SubnetId' in a}
+
+    groups = {}
+    for subnet in _paginate(ec2_client, 'describe_subnets', 'Subnets', Filters=vpc_filter):
+        table = subnet_tables.get(subnet['SubnetId'], main_table)
+        subnet_type = _subnet_type(subnet, table)
+        name = _tag(subnet.get('Tags'), props.get('subnetGroupNameTag') or SUBNET_NAME_TAG) or subnet_type
+        groups.setdefault((subnet_type, name), []).append({
+            'subnetId': subnet['SubnetId'],
+            'cidr': subnet['CidrBlock'],
+            'availabilityZone': subnet['AvailabilityZone'],
+            'routeTableId': table['RouteTableId'] if table is not None else None,
+        })
+
+    value = {
+        'vpcId': vpc['VpcId'],
+        'vpcCidrBlock': vpc['CidrBlock'],
+        'ownerAccountId': vpc.get('OwnerId'),
+        'availabilityZones': [],
+        'subnetGroups': [
+            {'name': name, 'type': subnet_type, 'subnets': sorted(subnets, key=lambda s: (s['availabilityZone'], s['subnetId']))}
+            for (subnet_type, name), subnets in sorted(groups.items())
+        ],
+    }
+    vpn_gateways = ec2_client.describe_vpn_gateways(Filters=[
+        {'Name': 'attachment.vpc-id', 'Values': [vpc['VpcId']]},
+        {'Name': 'attachment.state', 'Values': ['attached']},
+        {'Name': 'state', 'Values': ['available']},
+    ])['VpnGateways']
+    if len(vpn_gateways) == 1:
+        value['vpnGatewayId'] = vpn_gateways[0]['VpnGatewayId']
+    return value
+
+
+def lookup_client(props):
+    '''
+    ec2 client of the lookup, through the CDK lookup role of its account when there is one
+    '''
+    from mlops_sm_project_template_rt.config.aws_clients import get_client
+
+    role_arn = props.get('lookupRoleArn')
+    if role_arn is not None:
+        role_arn = role_arn.replace('${AWS::Partition}', 'aws')
+    return get_client('ec2', region_name=props['region'], role_arn=role_arn)
+
+
+def collect_missing(build, context):
+    '''
+    build the stacks in a throwaway app with the context, and return the lookups missing from it
+    '''
+    import aws_cdk
+    from mlops_sm_project_template_rt.scratch import scratch_mkdtemp
+
+    app = aws_cdk.App(context={**context, PREWARM_CONTEXT: True}, outdir=scratch_mkdtemp('cdk-context-', 'cdk.out'))
+    build(app)
+    return missing_context(app.synth())
+
+
+def prewarm(build, context_path='cdk.context.json', client_factory=lookup_client, collect=collect_missing,
+            max_workers=8, max_rounds=3):
+    '''
+    resolve the VPC lookups missing from the context file for the stacks build adds to an app, and save them
+
+    Args:
+        build (callable): adds the stacks to the app it is given, see build_product_stacks
+        context_path (str): context file of the CDK app
+        client_factory (callable): lookup props -> ec2 client
+        collect (callable): (build, context) -> missing lookups, see collect_missing
+
+    Returns:
+        [dict]: context key -> value of the lookups resolved
+    '''
+    context = load_context(context_path)
+    resolved = {}
+    for _ in range(max_rounds):
+        # a stack can depend on a looked up value, and only add its own lookups once that value is known
+        missing = collect(build, context)
+        if len(missing) == 0:
+            return resolved
+        pending = [m for m in missing if m['provider'] == VPC_PROVIDER and m['key'] not in resolved]
+        if len(pending) < len(missing):
+            others = [m['key'] for m in missing if m not in pending]
+            raise MissingContextError(f'lookups that can not be pre-warmed: {others}')
+
+        print(f'resolving {len(pending)} VPC lookups')
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+            values = list(executor.map(lambda m: resolve_vpc(m['props'], client_factory(m['props'])), pending))
+        for lookup, value in zip(pending, values):
+            print(f"   - {lookup['key']}: {value['vpcId']}")
+            context[lookup['key']] = value
+            resolved[lookup['key']] = value
+        save_context(context_path, context)
+
+    raise MissingContextError(f'lookups still missing after {max_rounds} rounds')
+
+
+def product_dirs(templates_root):
+    return sorted(d for d in listdir(templates_root) if path.isfile(path.join(templates_root, d, f'{d}Stack.py')))
+
+
+def build_product_stacks(templates_root, accounts, region):
+    '''
+    builder of the product stacks of every account, for prewarm
+    '''
+    def build(app):
+        import aws_cdk
+        from mlops_sm_project_template_rt.service_catalog_stack import import_template_class
+
+        for act_id in accounts:
+            env = aws_cdk.Environment(account=act_id, region=region)
+            for template_dir in product_dirs(templates_root):
+                template_class = import_template_class(templates_root, template_dir)
+                template_class(app, f'{template_dir}-{act_id}', '0.0.0', env=env)
+    return build
+
+
+def main(argv=None):
+    from mlops_sm_project_template_rt.config.constants import DEFAULT_DEPLOYMENT_REGION
+
+    default_root = os.environ.get('MLOPS_TEMPLATES_ROOT', str(Path(__file__).parents[2] / 'templates'))
+    parser = argparse.ArgumentParser(description='resolve the VPC lookups of the product templates into cdk.context.json')
+    parser.add_argument('--templates-root', default=default_root)
+    parser.add_argument('--accounts', nargs='+', default=list(dict.fromkeys(CODE_BUCKET_ACCOUNTS)))
+    parser.add_argument('--region', default=DEFAULT_DEPLOYMENT_REGION)
+    parser.add_argument('--context-file', default='cdk.context.json')
+    args = parser.parse_args(argv)
+
+    resolved = prewarm(build_product_stacks(args.templates_root, args.accounts, args.region), args.context_file)
+    print(f'{len(resolved)} VPC lookups written to {args.context_file}')
+
+
+if __name__ == '__main__':
+    main()
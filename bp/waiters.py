@@ -0,0 +1,221 @@
+'''
+Waiting on long running AWS operations, CloudFormation stacks and SageMaker pipeline executions,
+without sleeping a fixed time between blind status checks.
+
+Each target is checked with an exponential backoff with jitter (so concurrent test runs don't poll
+in lock step and get throttled together), under a global deadline. A Poller multiplexes many
+targets in a single loop, each with its own backoff. Stack waits stream the new stack events as
+they come, and only describe the stack again when the stack itself changes status.
+'''
+
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+PIPELINE_EXECUTION_RUNNING = ('Executing', 'Stopping')
+
+
+class WaitTimeout(TimeoutError):
+    '''
+    the deadline passed before the targets reached a final status
+    '''
+
+    def __init__(self, pending, results):
+        super().__init__(f'timed out waiting for {", ".join(str(k) for k in pending)}')
+        self.pending = list(pending)
+        self.results = results
+
+
+def backoff_delays(initial=2.0, maximum=30.0, factor=2.0, jitter=0.5):
+    '''
+    endless delays growing from initial to maximum seconds, the last jitter part of each delay is random
+    '''
+    delay = initial
+    while True:
+        yield delay * (1 - jitter) + random.uniform(0, delay * jitter)
+        delay = min(delay * factor, maximum)
+
+
+def is_throttled(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLING_ERRORS
+
+
+class Poller:
+    '''
+    check many targets in a single loop until each reaches a final status
+
+    A check returns None while its target is in progress, and the final status once it is done.
+    Throttling errors count as in progress, the target just backs off further.
+    '''
+
+    def __init__(self, timeout=3600, clock=time.monotonic, sleep=time.sleep, **backoff):
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.backoff = backoff
+        self._targets = {}
+
+    def add(self, key, check, **backoff):
+        '''
+        wait for check() to return a final status, backoff overrides the delays of the poller for this target
+        '''
+        self._targets[key] = (check, backoff_delays(**{**self.backoff, **backoff}))
+        return self
+
+    def run(self):
+        '''
+        returns:
+            [dict]: key -> final status of each target, raises WaitTimeout when the deadline passes first
+        '''
+        deadline = self.clock() + self.timeout
+        results = {}
+        due = {key: self.clock() for key in self._targets}
+        while len(due) > 0:
+            now = self.clock()
+            for key in [k for k, t in due.items() if t <= now]:
+                check, delays = self._targets[key]
+                try:
+                    result = check()
+                except ClientError as e:
+                    if not is_throttled(e):
+                        raise
+                    result = None
+                if result is not None:
+                    results[key] = result
+                    del due[key]
+                else:
+                    due[key] = self.clock() + next(delays)
+
+            if len(due) == 0:
+                break
+            next_due = min(due.values())
+            if next_due > deadline:
+                raise WaitTimeout(due, results)
+            self.sleep(max(0.0, next_due - self.clock()))
+        return results
+
+
+def wait_for(check, timeout=3600, **backoff):
+    '''
+    wait until check() returns a final status (not None), and return it
+    '''
+    return Poller(timeout, **backoff).add('target', check).run()['target']
+
+
+def _missing_stack(error):
+    return error.response['Error']['Code'] == 'ValidationError' and 'does not exist' in error.response['Error']['Message']
+
+
+def format_stack_event(event):
+    reason = event.get('ResourceStatusReason')
+    return (f"     {event['Timestamp']:%H:%M:%S} {event['LogicalResourceId']} ({event['ResourceType']}): "
+            f"{event['ResourceStatus']}{f' - {reason}' if reason else ''}")
+
+
+class StackEventStream:
+    '''
+    the events of a stack, newer than the ones already seen
+    '''
+
+    def __init__(self, cfn_client, stack_name):
+        self.cfn_client = cfn_client
+        self.stack_name = stack_name
+        self.last_event_id = None
+        self.started = False
+
+    def poll(self):
+        '''
+        return the events since the previous poll, oldest first; the first poll only marks the start of the stream
+        '''
+        if not self.started:
+            self.started = True
+            page = self.cfn_client.describe_stack_events(StackName=self.stack_name)
+            if len(page['StackEvents']) > 0:
+                self.last_event_id = page['StackEvents'][0]['EventId']
+            return []
+
+        events = []
+        paginator = self.cfn_client.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=self.stack_name):
+            # newest first: stop at the last event already seen
+            ids = [e['EventId'] for e in page['StackEvents']]
+            seen = ids.index(self.last_event_id) if self.last_event_id in ids else None
+            events += page['StackEvents'][:seen]
+            if seen is not None:
+                break
+
+        if len(events) > 0:
+            self.last_event_id = events[0]['EventId']
+        return list(reversed(events))
+
+
+def stack_status_check(cfn_client, stack_name, stream_events=True, missing_status='DELETE_COMPLETE', printer=print):
+    '''
+    check function of a stack for the Poller: None while the stack is in progress, else its final status
+
+    with stream_events, the stack events are printed as they come, and the stack is only described
+    again when an event of the stack itself shows up
+    '''
+    events = StackEventStream(cfn_client, stack_name) if stream_events else None
+    state = {'described': False}
+
+    def check():
+        try:
+            if events is not None:
+                new_events = events.poll()
+                for event in new_events:
+                    printer(format_stack_event(event))
+                if state['described']:
+                    # the stack emits an event of its own when its status changes
+                    stack_events = [e for e in new_events
+                                    if e['ResourceType'] == 'AWS::CloudFormation::Stack' and e['LogicalResourceId'] == stack_name]
+                    if len(stack_events) == 0 or stack_events[-1]['ResourceStatus'].endswith('_IN_PROGRESS'):
+                        return None
+                    return stack_events[-1]['ResourceStatus']
+
+            state['described'] = True
+            status = cfn_client.describe_stacks(StackName=stack_name)['Stacks'][0]['StackStatus']
+            return None if status.endswith('_IN_PROGRESS') else status
+        except ClientError as e:
+            if missing_status is not None and _missing_stack(e):
+                return missing_status
+            raise
+
+    return check
+
+
+def wait_for_stack(cfn_client, stack_name, timeout=3 * 3600, stream_events=True, **backoff):
+    '''
+    wait until the stack reaches a final status, and return it (missing stacks are DELETE_COMPLETE)
+    '''
+    return wait_for(stack_status_check(cfn_client, stack_name, stream_events), timeout, **backoff)
+
+
+def wait_for_stacks(cfn_client, stack_names, timeout=3 * 3600, stream_events=True, **backoff):
+    '''
+    wait for many stacks in a single loop, returns stack name -> final status
+    '''
+    poller = Poller(timeout, **backoff)
+    for stack_name in stack_names:
+        poller.add(stack_name, stack_status_check(cfn_client, stack_name, stream_events))
+    return poller.run()
+
+
+def pipeline_execution_check(sm_client, execution_arn):
+    '''
+    check function of a SageMaker pipeline execution for the Poller
+    '''
+    def check():
+        status = sm_client.describe_pipeline_execution(PipelineExecutionArn=execution_arn)['PipelineExecutionStatus']
+        return None if status in PIPELINE_EXECUTION_RUNNING else status
+    return check
+
+
+def wait_for_pipeline_execution(sm_client, execution_arn, timeout=3 * 3600, **backoff):
+    '''
+    wait until the SageMaker pipeline execution completes, and return its status
+    '''
+    return wait_for(pipeline_execution_check(sm_client, execution_arn), timeout, **backoff)
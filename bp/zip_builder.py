@@ -0,0 +1,116 @@
+'''
+Deterministic, incremental zip archives of the lambda and seed code.
+
+The shared code is published with a BucketDeployment, which unzips the asset it is given. Lambdas
+and CodeCommit seeds need zip files, so each code folder is zipped, and the zip is wrapped in a
+second (outer) zip that the deployment unzips.
+
+Archives are written with fixed timestamps and in a fixed order, so the same tree always gives
+byte-identical zips and CDK asset hashes stay stable between runs. A hash of the tree is kept next
+to each archive, and an unchanged tree reuses its archive instead of compressing it again.
+'''
+
+import hashlib
+import io
+import os
+import shutil
+import stat
+import zipfile
+from os import path
+
+from mlops_sm_project_template_rt.synth_cache import cache_root, hash_tree, list_tree_files
+
+# earliest timestamp a zip file can hold
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def archive_dir():
+    '''
+    folder holding the built archives, kept between synths so unchanged archives are reused
+    '''
+    ret = path.join(cache_root(), 'archives')
+    os.makedirs(ret, exist_ok=True)
+    return ret
+
+
+def _zip_info(arcname, mode=0o644, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(arcname, date_time=FIXED_DATE_TIME)
+    info.external_attr = (stat.S_IFREG | mode) << 16
+    info.compress_type = compress_type
+    return info
+
+
+def write_tree(zf, root_dir):
+    '''
+    add the files under root_dir to the zip file, with fixed timestamps and permissions
+    '''
+    for rel_path, file_path in list_tree_files(root_dir):
+        # only keep the executable bit, so the archive doesn't depend on the umask of the build host
+        mode = 0o755 if os.stat(file_path).st_mode & stat.S_IXUSR else 0o644
+        info = _zip_info(rel_path, mode)
+        info.file_size = path.getsize(file_path)
+        with open(file_path, 'rb') as src, zf.open(info, 'w') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _replace_atomically(content_writer, target_path):
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        content_writer(tmp_path)
+        os.replace(tmp_path, target_path)
+    finally:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def archive_hash(outer_path):
+    '''
+    return the tree hash outer_path was built from (see build_nested_zip), None when it is not known
+    '''
+    hash_path = f'{outer_path}.sha256'
+    if not path.isfile(outer_path) or not path.isfile(hash_path):
+        return None
+    with open(hash_path, 'r') as f:
+        return f.read().strip()
+
+
+def build_nested_zip(src_dir, inner_name, outer_path):
+    '''
+    zip src_dir into inner_name, and wrap it into the outer zip file outer_path
+
+    The inner zip is built in memory and stored (not compressed again) in the outer zip. When the
+    tree has not changed since outer_path was built, the existing archive is reused.
+
+    Args:
+        src_dir (str): folder to zip
+        inner_name (str): name of the inner zip file, as seen once the outer zip is extracted
+        outer_path (str): path of the outer zip file
+
+    Returns:
+        [str]: outer_path
+    '''
+    digest = hashlib.sha256(inner_name.encode('utf-8'))
+    hash_tree(digest, src_dir)
+    tree_hash = digest.hexdigest()
+
+    hash_path = f'{outer_path}.sha256'
+    if archive_hash(outer_path) == tree_hash:
+        print(f'Reusing archive of {src_dir}: {outer_path}')
+        return outer_path
+
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as zf:
+        write_tree(zf, src_dir)
+
+    def write_outer(tmp_path):
+        with zipfile.ZipFile(tmp_path, 'w') as zf:
+            zf.writestr(_zip_info(inner_name, compress_type=zipfile.ZIP_STORED), inner.getvalue())
+
+    def write_hash(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write(tree_hash)
+
+    # archive first, then its hash: a reader never sees a new hash next to an old archive
+    _replace_atomically(write_outer, outer_path)
+    _replace_atomically(write_hash, hash_path)
+    return outer_path